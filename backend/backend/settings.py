@@ -50,6 +50,7 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
+    'user.middleware.ReplacedBackendSessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -133,6 +134,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # settings.py
 AUTH_USER_MODEL = 'user.User'
+AUTHENTICATION_BACKENDS = ['user.backends.RoleModelBackend']
 
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'home'
@@ -150,4 +152,94 @@ SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_SAMESITE = 'Lax'
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]  # For development
-STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')    # For production
\ No newline at end of file
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')    # For production
+
+# Shared by every worker process, so the list stats and the global report
+# snapshot one worker drops on a write are dropped for all of them (a
+# per-process LocMemCache would keep serving stale numbers until the
+# timeouts below). Its table is created by the dossier_medicale migrations;
+# django.core.cache.backends.redis.RedisCache is a drop-in alternative.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
+# Dossier list header statistics cache lifetime (seconds)
+DOSSIER_STATS_CACHE_TIMEOUT = 60
+
+# Global report snapshot refresh interval (seconds)
+GLOBAL_REPORT_CACHE_TIMEOUT = 300
+
+# MySQL innodb_ft_min_token_size: search terms shorter than this are looked
+# up in the token table, as the FULLTEXT index does not hold them
+SEARCH_FULLTEXT_MIN_TOKEN_SIZE = 3
+
+# Prefer controllers of the dossier department when auto-assigning reviews
+CONTROLLER_DEPARTMENT_AFFINITY = True
+
+# On-disk caches of generated files (archives, reports, ...), LRU-evicted
+# per cache once over its byte budget
+FILE_CACHE_ROOT = os.path.join(BASE_DIR, 'cache')
+FILE_CACHE_MAX_BYTES = {
+    'archives': 2 * 1024 ** 3,
+    'reports': 256 * 1024 ** 2,
+    'exports': 5 * 1024 ** 3,
+    'previews': 512 * 1024 ** 2,
+}
+
+# Render the PDF report into the cache as soon as a dossier is approved
+REPORT_PRERENDER_ON_APPROVE = False
+
+# Report rendering processes of export_dossiers and background exports
+# (defaults to the CPU count); exports streamed by a view render inline
+EXPORT_WORKERS = None
+
+# Background jobs (manage.py run_jobs): attempts per job, retry backoff base
+# and cap (seconds, doubling per attempt), how often a worker refreshes the
+# locks of its running jobs, and how long a lock may go unrefreshed before
+# another worker takes the job over
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BACKOFF = 30
+JOB_RETRY_BACKOFF_MAX = 3600
+JOB_HEARTBEAT_INTERVAL = 60
+JOB_LOCK_TIMEOUT = 3600
+
+# Audit log entries of a request are written in one insert when its
+# transaction commits; True spools them instead to a background job that
+# writes them (they keep the time they were recorded)
+AUDIT_LOG_ASYNC = False
+
+# Audit log retention (manage.py archive_audit_log): entries older than this
+# many days move to compressed monthly archive files, still shown in each
+# dossier's audit timeline; None keeps every entry in the database
+AUDIT_LOG_RETENTION_DAYS = 365
+AUDIT_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'audit_archive')
+
+# Chunked, resumable attachment uploads: where partial files are kept, the
+# largest file and chunk accepted, and how long an idle upload is kept
+# before manage.py purge_uploads removes it
+CHUNKED_UPLOAD_ROOT = os.path.join(BASE_DIR, 'uploads_tmp')
+CHUNKED_UPLOAD_MAX_BYTES = 4 * 1024 ** 3
+CHUNKED_UPLOAD_CHUNK_MAX_BYTES = 16 * 1024 ** 2
+CHUNKED_UPLOAD_EXPIRY_HOURS = 24
+
+# Attachment thumbnails and previews: queue their rendering on upload (they
+# are otherwise rendered on first view); PDFs need poppler's pdftoppm
+PREVIEW_ON_UPLOAD = True
+PREVIEW_PDFTOPPM = 'pdftoppm'
+PREVIEW_TIMEOUT = 30
+
+# Upload-time normalization of photographed documents (see
+# dossier_medicale/imaging.py); None leaves uploads untouched. Example:
+# UPLOAD_IMAGE_POLICY = {'max_side': 3508, 'max_dpi': 300, 'format': 'JPEG',
+#                        'quality': 82, 'keep_original': False}
+UPLOAD_IMAGE_POLICY = None
+
+# How attachment downloads are delivered: 'django' streams them from Python;
+# 'x-accel-redirect' (nginx, with an internal location mapping
+# ATTACHMENT_ACCEL_PREFIX to MEDIA_ROOT) and 'x-sendfile' (Apache/lighttpd)
+# hand the transfer to the web server once permissions are checked
+ATTACHMENT_DELIVERY = 'django'
+ATTACHMENT_ACCEL_PREFIX = '/protected-media/'
@@ -1,20 +1,69 @@
 # dossier_medicale/admin.py
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.core.exceptions import PermissionDenied
 from django.utils.translation import gettext_lazy as _
+from django.utils import timezone
 from django.utils.html import format_html
-from django.urls import reverse
+from django.urls import path, reverse
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from .forms import ImportForm
+from .imports import stage_upload
+from .jobs import enqueue, job_state
 from .models import (
     DossierMedical, 
     MedicalAttachment, 
     DossierAuditLog, 
     PieceJointe,
-    PriseEnCharge
+    PriseEnCharge,
+    Job
 )
 from user.models import User, Role
 
+class ImportAdminMixin:
+    """Adds an "Import" page (CSV/JSON/NDJSON, see imports.py) to a model's changelist."""
+    import_kind = None
+    change_list_template = 'admin/dossier_medicale/change_list_import.html'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='%s_%s_import' % info),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            # Run by a run_jobs worker; a retry would import the rows again
+            job = enqueue(
+                'import_records', user=request.user, max_attempts=1,
+                kind=self.import_kind, path=stage_upload(form.cleaned_data['file']),
+                format=form.cleaned_data['format'], user_id=request.user.pk,
+                dry_run=form.cleaned_data['dry_run'],
+            )
+            return redirect(f"{request.path}?job={job.pk}")
+        job = None
+        if request.GET.get('job', '').isdigit():
+            job = get_object_or_404(Job, pk=request.GET['job'], task='import_records', created_by=request.user)
+        context = {
+            **self.admin_site.each_context(request),
+            'title': _('Import %s') % self.model._meta.verbose_name_plural,
+            'opts': self.model._meta,
+            'form': form,
+            'job': job,
+            'job_state': job_state(job) if job else None,
+            'result': job.result if job and job.status == 'SUCCEEDED' else None,
+            'dry_run': job is not None and job.payload.get('dry_run'),
+        }
+        return TemplateResponse(request, 'admin/dossier_medicale/import.html', context)
+
+
 @admin.register(PriseEnCharge)
-class PriseEnChargeAdmin(admin.ModelAdmin):
+class PriseEnChargeAdmin(ImportAdminMixin, admin.ModelAdmin):
+    import_kind = 'pec'
     list_display = ('reference', 'patient', 'institution', 'care_type', 'status_badge')
     list_filter = ('status', 'care_type', 'institution')
     search_fields = ('reference', 'patient__full_name', 'institution')
@@ -102,7 +151,8 @@ class PieceJointeInline(admin.TabularInline):
 
 
 @admin.register(DossierMedical)
-class DossierMedicalAdmin(admin.ModelAdmin):
+class DossierMedicalAdmin(ImportAdminMixin, admin.ModelAdmin):
+    import_kind = 'dossier'
     list_display = ('reference', 'employer', 'department', 'status_badge', 'created_by')
     list_filter = ('status', 'department', 'is_confidential', 'employer')
     search_fields = ('reference', 'employer__employee_id', 'doctor', 'employer__email')
@@ -169,6 +219,21 @@ class PieceJointeAdmin(admin.ModelAdmin):
         return format_html('<a href="{}">{}</a>', url, obj.dossier.reference)
     dossier_link.short_description = _('Dossier')
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'run_at', 'created_by', 'finished_at')
+    list_filter = ('status', 'task')
+    readonly_fields = ('task', 'payload', 'attempts', 'locked_by', 'locked_at', 'progress', 'result',
+                       'error', 'created_by', 'created_at', 'finished_at')
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        count = queryset.exclude(status='RUNNING').update(
+            status='QUEUED', attempts=0, run_at=timezone.now(), error='', finished_at=None,
+        )
+        self.message_user(request, f"{count} job(s) requeued.")
+    retry_jobs.short_description = _('Requeue selected jobs')
+
 @admin.register(DossierAuditLog)
 class DossierAuditLogAdmin(admin.ModelAdmin):
     list_display = ('action', 'dossier_link', 'user', 'timestamp')
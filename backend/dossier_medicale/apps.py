@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DossierMedicaleConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dossier_medicale'
+
+    def ready(self):
+        from . import signals  # noqa: F401
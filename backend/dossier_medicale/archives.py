@@ -0,0 +1,149 @@
+"""Streaming ZIP archives of dossier attachments.
+
+``iter_zip`` yields the archive while it is being written: zipfile writes
+into a non-seekable buffer, so every entry gets a local header up front and
+a data descriptor after its data, and the buffer is drained after each
+chunk. Memory use is bounded by the chunk size, not by the archive size.
+
+Finished archives are kept in ``archive_cache`` under a hash of the
+attachments they contain, so repeated downloads of an unchanged dossier are
+served from disk without recompressing anything. An archive missing some
+files ends with a MISSING_FILES.txt entry naming them and is never cached,
+so the download is complete again once the files are restored.
+"""
+import hashlib
+import io
+import logging
+import os
+import zipfile
+
+from django.utils import timezone
+
+from .filecache import FileCache
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Bump when the archive layout changes so stale cache entries stop matching
+ARCHIVE_FORMAT = 1
+
+# Entry listing the attachments that could not be read from storage
+MISSING_FILES_NAME = 'MISSING_FILES.txt'
+
+archive_cache = FileCache('archives', default_max_bytes=2 * 1024 ** 3)
+
+# Already-compressed formats gain nothing from deflate
+STORED_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf', '.zip', '.gz', '.mp4',
+})
+
+
+class _DrainBuffer(io.RawIOBase):
+    """Write-only, non-seekable sink whose contents are handed out by drain()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _drained(buffer):
+    data = buffer.drain()
+    if data:
+        yield data
+
+
+def compress_type_for(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return zipfile.ZIP_STORED if extension in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def piece_entries(pieces):
+    """(archive name, FieldFile, modification time) for each attachment."""
+    for piece in pieces:
+        yield piece.nom_fichier, piece.chemin_storage, piece.date_upload
+
+
+def iter_zip(entries, chunk_size=CHUNK_SIZE, missing=None):
+    """Yield a ZIP archive of ``entries`` chunk by chunk.
+
+    Files missing from storage are skipped rather than aborting a response
+    that has already started: their names are appended to ``missing`` and
+    listed in a last MISSING_FILES.txt entry.
+    """
+    missing = [] if missing is None else missing
+    buffer = _DrainBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for arcname, field_file, modified in entries:
+            modified = timezone.localtime(modified) if modified else timezone.localtime()
+            info = zipfile.ZipInfo(arcname, date_time=modified.timetuple()[:6])
+            info.compress_type = compress_type_for(arcname)
+            try:
+                source = field_file.open('rb')
+            except (FileNotFoundError, ValueError):
+                logger.warning("Skipping missing attachment %s", field_file.name)
+                missing.append(arcname)
+                continue
+            with source, archive.open(info, 'w', force_zip64=True) as target:
+                for chunk in iter(lambda: source.read(chunk_size), b''):
+                    target.write(chunk)
+                    yield from _drained(buffer)
+            yield from _drained(buffer)
+        if missing:
+            note = "These attachments could not be found in storage and are not included:\n"
+            archive.writestr(MISSING_FILES_NAME, note + ''.join(f"- {name}\n" for name in missing),
+                             compress_type=zipfile.ZIP_DEFLATED)
+    yield from _drained(buffer)
+
+
+def piece_identity(piece):
+    """Fields that change whenever an attachment's file or name does."""
+    return (
+        piece.pk, piece.nom_fichier, piece.chemin_storage.name, piece.taille_ko,
+        piece.date_upload.isoformat() if piece.date_upload else '',
+    )
+
+
+def archive_key(pieces):
+    """Content address of the archive built from ``pieces``."""
+    digest = hashlib.sha256(b'archive-v%d' % ARCHIVE_FORMAT)
+    for piece in sorted(pieces, key=lambda piece: piece.pk):
+        digest.update(repr(piece_identity(piece)).encode())
+    return digest.hexdigest()
+
+
+def cache_prefix(dossier_id):
+    return f'{dossier_id}-'
+
+
+def dossier_archive(dossier_id, pieces):
+    """Return ``(path, None)`` for a cached archive, else ``(None, chunks)``.
+
+    On a miss the returned chunks stream the archive while storing it, so
+    the next download of the same attachment set is a hit, unless files were
+    missing from it.
+    """
+    pieces = list(pieces)
+    name = f'{cache_prefix(dossier_id)}{archive_key(pieces)}.zip'
+    path = archive_cache.get(name)
+    if path is not None:
+        return path, None
+    missing = []
+    chunks = iter_zip(piece_entries(pieces), missing=missing)
+    return None, archive_cache.store_stream(name, chunks, publish=lambda: not missing)
+
+
+def invalidate_dossier_archives(dossier_id):
+    archive_cache.delete_prefix(cache_prefix(dossier_id))
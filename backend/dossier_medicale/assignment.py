@@ -0,0 +1,135 @@
+"""Workload-balanced controller assignment.
+
+Each active controller has a ControllerWorkload row whose ``open_dossiers``
+counter is adjusted as dossiers are assigned, reassigned, closed or
+deleted. Picking a controller is then one indexed ``ORDER BY open_dossiers``
+lookup rather than a scan of users and dossiers. Bulk imports pick the
+controllers of a whole batch from one locked read (``assign_controllers``)
+and adjust each controller's counter once (``track_creations``).
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from .models import ControllerWorkload, DossierMedical
+
+OPEN_STATUSES = ('SUBMITTED', 'UNDER_REVIEW')
+
+# User fields sync_controller reads
+CONTROLLER_USER_FIELDS = ('is_active', 'role', 'role_id', 'department')
+
+
+def assign_controller(department=None):
+    """Return the id of the least-loaded active controller, or None.
+
+    With ``CONTROLLER_DEPARTMENT_AFFINITY`` enabled, controllers of the
+    dossier's department are preferred when there are any. Ties go to the
+    controller who was assigned least recently.
+    """
+    with transaction.atomic():
+        candidates = (
+            ControllerWorkload.objects.select_for_update()
+            .filter(is_active=True)
+            .order_by('open_dossiers', F('last_assigned_at').asc(nulls_first=True), 'id')
+        )
+        workload = None
+        if department and getattr(settings, 'CONTROLLER_DEPARTMENT_AFFINITY', True):
+            workload = candidates.filter(department=department).first()
+        if workload is None:
+            workload = candidates.first()
+        if workload is None:
+            return None
+        ControllerWorkload.objects.filter(pk=workload.pk).update(last_assigned_at=timezone.now())
+    return workload.controller_id
+
+
+def assign_controllers(departments):
+    """Ids of the controllers ``assign_controller`` would pick, in turn, for
+    new open dossiers of ``departments``.
+
+    The active workloads are locked and read once; each pick counts towards
+    the following ones, and the picked controllers are marked as assigned
+    with a single update. The counters themselves are left to
+    ``track_creations``.
+    """
+    if not departments:
+        return []
+    affinity = getattr(settings, 'CONTROLLER_DEPARTMENT_AFFINITY', True)
+    with transaction.atomic():
+        workloads = list(ControllerWorkload.objects.select_for_update().filter(is_active=True).order_by('id'))
+        if not workloads:
+            return [None] * len(departments)
+        now = timezone.now()
+        load = {workload.pk: workload.open_dossiers for workload in workloads}
+        # Never assigned first, then least recently; picks made here come last, in order
+        recency = {
+            workload.pk: (0,) if workload.last_assigned_at is None else (1, workload.last_assigned_at, 0)
+            for workload in workloads
+        }
+        picks = []
+        for turn, department in enumerate(departments, 1):
+            candidates = [w for w in workloads if w.department == department] if department and affinity else []
+            workload = min(candidates or workloads, key=lambda w: (load[w.pk], recency[w.pk], w.pk))
+            load[workload.pk] += 1
+            recency[workload.pk] = (1, now, turn)
+            picks.append(workload)
+        ControllerWorkload.objects.filter(pk__in={workload.pk for workload in picks}).update(last_assigned_at=now)
+    return [workload.controller_id for workload in picks]
+
+
+def _is_open(controller_id, status):
+    return controller_id is not None and status in OPEN_STATUSES
+
+
+def _adjust(controller_id, delta):
+    workloads = ControllerWorkload.objects.filter(controller_id=controller_id)
+    if delta < 0:
+        workloads = workloads.filter(open_dossiers__gt=0)
+    workloads.update(open_dossiers=F('open_dossiers') + delta)
+
+
+def track_transition(old_state, new_state):
+    """Update open counters for a dossier moving from ``old_state`` to ``new_state``.
+
+    States are ``(controller_id, status)`` pairs; ``(None, None)`` stands for
+    a dossier that does not exist (before creation, after deletion).
+    """
+    was_open, is_open = _is_open(*old_state), _is_open(*new_state)
+    same_controller = old_state[0] == new_state[0]
+    if was_open and not (is_open and same_controller):
+        _adjust(old_state[0], -1)
+    if is_open and not (was_open and same_controller):
+        _adjust(new_state[0], +1)
+
+
+def track_creations(states):
+    """``track_transition`` from ``(None, None)`` for each of the new
+    dossiers' ``states``, as one update per controller."""
+    opened = Counter(controller_id for controller_id, status in states if _is_open(controller_id, status))
+    for controller_id, count in opened.items():
+        _adjust(controller_id, count)
+
+
+def sync_controller(user):
+    """Create, refresh or deactivate the workload row of ``user``."""
+    if user.is_active and user.role.name == 'CONTROLLER':
+        ControllerWorkload.objects.update_or_create(
+            controller=user,
+            defaults={'department': user.department or '', 'is_active': True},
+        )
+    else:
+        ControllerWorkload.objects.filter(controller=user).update(is_active=False)
+
+
+def rebuild_workloads():
+    """Recompute every open counter from the dossier table."""
+    counts = dict(
+        DossierMedical.objects.filter(status__in=OPEN_STATUSES, controller__isnull=False)
+        .order_by().values_list('controller').annotate(n=Count('id'))
+    )
+    for workload in ControllerWorkload.objects.all():
+        workload.open_dossiers = counts.get(workload.controller_id, 0)
+        workload.save(update_fields=['open_dossiers'])
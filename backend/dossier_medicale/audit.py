@@ -0,0 +1,108 @@
+"""Batched writes of the dossier audit log.
+
+Views record events with ``record`` inside ``batch()``, a transaction that
+collects them and writes them with one ``bulk_create`` as its last statement,
+so a request that saves a dossier and N attachments inserts its 1 + N audit
+entries in a single round trip. The entries commit or roll back with the
+changes they describe: a committed change always has its audit entry, and a
+failed one leaves none. ``record`` outside a batch writes at once.
+
+With ``AUDIT_LOG_ASYNC`` the entries are spooled instead: one Job row,
+committed in the same transaction, which a ``run_jobs`` worker turns into the
+audit rows, keeping the audit table's index maintenance off the request.
+Each entry keeps the time it was recorded, not the time it was written.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from user.models import User
+
+from .jobs import enqueue, task
+from .models import DossierAuditLog, DossierMedical
+
+# Entries of the innermost open batch, or None outside any batch
+_pending = ContextVar('audit_pending', default=None)
+
+
+def spooled():
+    return getattr(settings, 'AUDIT_LOG_ASYNC', False)
+
+
+def record(dossier, action, user=None, details=None):
+    """Audit ``action`` on ``dossier`` by ``user``; written when the batch commits."""
+    entry = DossierAuditLog(
+        dossier=dossier, action=action, user=user, details=details or {}, timestamp=timezone.now(),
+    )
+    entries = _pending.get()
+    if entries is None:
+        _write([entry])
+    else:
+        entries.append(entry)
+    return entry
+
+
+@contextmanager
+def batch():
+    """Transaction collecting the entries ``record``-ed inside it.
+
+    Usable as a context manager or a view decorator. A nested batch is a
+    savepoint whose entries join the outer batch if it succeeds and are
+    dropped if it fails; entries recorded in a plain ``atomic`` block that
+    rolls back while the batch goes on are not dropped, so record them
+    after such a block succeeds.
+    """
+    parent = _pending.get()
+    entries = []
+    with transaction.atomic():
+        token = _pending.set(entries)
+        try:
+            yield
+        finally:
+            _pending.reset(token)
+        if parent is not None:
+            parent.extend(entries)
+        elif entries:
+            _write(entries)
+
+
+def _write(entries):
+    if spooled():
+        enqueue('write_audit_log', entries=[
+            {
+                'dossier': entry.dossier_id,
+                'action': entry.action,
+                'user': entry.user_id,
+                'details': entry.details,
+                'timestamp': entry.timestamp.isoformat(),
+            }
+            for entry in entries
+        ])
+    else:
+        DossierAuditLog.objects.bulk_create(entries)
+
+
+@task('write_audit_log')
+def write_spooled(job, entries):
+    # Entries of dossiers deleted since were removed with them anyway, and
+    # users deleted since are set to null, as the foreign keys would have
+    dossiers = set(
+        DossierMedical.objects.filter(id__in={entry['dossier'] for entry in entries}).values_list('id', flat=True)
+    )
+    users = set(
+        User.objects.filter(id__in={entry['user'] for entry in entries}).values_list('id', flat=True)
+    )
+    logs = [
+        DossierAuditLog(
+            dossier_id=entry['dossier'], action=entry['action'],
+            user_id=entry['user'] if entry['user'] in users else None,
+            details=entry['details'], timestamp=parse_datetime(entry['timestamp']),
+        )
+        for entry in entries if entry['dossier'] in dossiers
+    ]
+    DossierAuditLog.objects.bulk_create(logs)
+    return {'written': len(logs)}
@@ -0,0 +1,209 @@
+"""Retention of the audit log: old entries move to compressed cold storage.
+
+``archive_entries`` moves the DossierAuditLog rows older than a cutoff,
+oldest first and ``chunk_size`` at a time, into one SQLite file per month
+under AUDIT_ARCHIVE_ROOT. Each chunk is committed to its archive files
+before its rows are deleted by a statement of its own, so no transaction
+holds locks on the audit table for long. A run that stops half-way leaves
+rows in the table to be archived again; archive inserts skip ids already
+archived.
+
+``details`` are stored as raw deflate with a preset dictionary of the keys
+and values the views write, which shrinks even the short JSON objects of
+most entries. Each file keeps the dictionary it was written with, so the
+dictionary can change without making older files unreadable.
+
+``timeline`` reads a dossier's entries from the table and then from the
+archives (indexed by dossier), as DossierAuditLog instances the templates
+cannot tell apart from rows, except by their ``archived`` flag.
+"""
+import json
+import os
+import sqlite3
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+
+from user.models import User
+
+from .models import DossierAuditLog
+
+CHUNK_SIZE = 5000
+
+PARTITION_PREFIX = 'audit-'
+PARTITION_SUFFIX = '.sqlite3'
+
+# Frequent fragments of the details JSON, the most common last
+DEFAULT_DICTIONARY = (
+    b'"import":true"changes":"Dossier updated via edit form""reference":"PEC-'
+    b'"old_status":"DRAFT""REJECTED""UNDER_REVIEW""APPROVED""new_status":"SUBMITTED"'
+    b'"reference":"DM-"status":"SUBMITTED"}{"filename":"Scanned_.jpg.png.pdf",'
+    b'"type":"SCAN"}"size_kb":}'
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS entry (
+    id INTEGER PRIMARY KEY,
+    dossier_id INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    user_id INTEGER,
+    timestamp INTEGER NOT NULL,
+    details BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_dossier ON entry (dossier_id, timestamp);
+"""
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def archive_root():
+    return getattr(settings, 'AUDIT_ARCHIVE_ROOT', os.path.join(settings.BASE_DIR, 'audit_archive'))
+
+
+def partition(timestamp):
+    """Archive file name of an entry recorded at ``timestamp``: its UTC month."""
+    return f"{PARTITION_PREFIX}{timestamp.astimezone(dt_timezone.utc):%Y-%m}{PARTITION_SUFFIX}"
+
+
+def partitions(since=None):
+    """Paths of the archive files, oldest first, from the month of ``since`` on."""
+    root = archive_root()
+    try:
+        names = sorted(
+            name for name in os.listdir(root)
+            if name.startswith(PARTITION_PREFIX) and name.endswith(PARTITION_SUFFIX)
+        )
+    except FileNotFoundError:
+        return []
+    if since is not None:
+        names = [name for name in names if name >= partition(since)]
+    return [os.path.join(root, name) for name in names]
+
+
+def _micros(timestamp):
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_micros(value):
+    seconds, micros = divmod(value, 1000000)
+    return datetime.fromtimestamp(seconds, dt_timezone.utc).replace(microsecond=micros)
+
+
+def _compress(details, dictionary):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionary)
+    data = json.dumps(details, separators=(',', ':'), ensure_ascii=False).encode()
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(blob, dictionary):
+    decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    return json.loads(decompressor.decompress(blob) + decompressor.flush())
+
+
+def _open(path, create=False):
+    """(connection, dictionary) of the archive file at ``path``."""
+    if create:
+        connection = sqlite3.connect(path)
+        connection.executescript(_SCHEMA)
+        connection.execute(
+            "INSERT OR IGNORE INTO meta (key, value) VALUES ('dictionary', ?)", (DEFAULT_DICTIONARY,)
+        )
+        connection.commit()
+    else:
+        connection = sqlite3.connect(Path(path).as_uri() + '?mode=ro', uri=True)
+    dictionary = connection.execute("SELECT value FROM meta WHERE key = 'dictionary'").fetchone()[0]
+    return connection, dictionary
+
+
+def archive_entries(before, chunk_size=CHUNK_SIZE, pause=0, progress=None):
+    """Move the entries recorded before ``before`` to the archives; return how many.
+
+    ``pause`` seconds are slept between chunks to leave the database room
+    for regular traffic.
+    """
+    os.makedirs(archive_root(), exist_ok=True)
+    old = DossierAuditLog.objects.filter(timestamp__lt=before).order_by('timestamp', 'id')
+    archives = {}
+    moved = 0
+    try:
+        while True:
+            rows = list(old.values_list('id', 'dossier_id', 'action', 'user_id', 'timestamp', 'details')[:chunk_size])
+            if not rows:
+                break
+            by_partition = defaultdict(list)
+            for row in rows:
+                by_partition[partition(row[4])].append(row)
+            for name, part in by_partition.items():
+                if name not in archives:
+                    archives[name] = _open(os.path.join(archive_root(), name), create=True)
+                connection, dictionary = archives[name]
+                with connection:
+                    connection.executemany(
+                        "INSERT OR IGNORE INTO entry (id, dossier_id, action, user_id, timestamp, details) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (id, dossier_id, action, user_id, _micros(timestamp), _compress(details, dictionary))
+                            for id, dossier_id, action, user_id, timestamp, details in part
+                        ],
+                    )
+            DossierAuditLog.objects.filter(id__in=[row[0] for row in rows]).delete()
+            moved += len(rows)
+            if progress:
+                progress(moved)
+            if len(rows) < chunk_size:
+                break
+            if pause:
+                time.sleep(pause)
+    finally:
+        for connection, _ in archives.values():
+            connection.close()
+    return moved
+
+
+def archived_entries(dossier):
+    """The archived entries of ``dossier``, newest first, as unsaved DossierAuditLog."""
+    logs = []
+    # Nothing about a dossier is recorded before it was created
+    for path in partitions(since=dossier.created_at):
+        connection, dictionary = _open(path)
+        try:
+            rows = connection.execute(
+                "SELECT id, action, user_id, timestamp, details FROM entry WHERE dossier_id = ?", (dossier.pk,)
+            ).fetchall()
+        finally:
+            connection.close()
+        for id, action, user_id, timestamp, details in rows:
+            log = DossierAuditLog(
+                id=id, dossier=dossier, action=action, user_id=user_id,
+                timestamp=_from_micros(timestamp), details=_decompress(details, dictionary),
+            )
+            log.archived = True
+            logs.append(log)
+    users = User.objects.select_related('role').in_bulk({log.user_id for log in logs if log.user_id})
+    for log in logs:
+        # A user deleted since is shown as null, as the foreign key would be
+        log.user = users.get(log.user_id)
+    logs.sort(key=lambda log: (log.timestamp, log.id), reverse=True)
+    return logs
+
+
+def timeline(dossier, limit=None):
+    """The audit entries of ``dossier``, newest first, from the table then the archives.
+
+    Archived entries predate the ones in the table, so the archives are
+    only read when the table has fewer than ``limit`` entries.
+    """
+    logs = dossier.audit_logs.select_related('user__role').order_by('-timestamp', '-id')
+    logs = list(logs[:limit] if limit else logs)
+    if limit and len(logs) >= limit:
+        return logs
+    # An entry can be in both when a run stopped between archiving and deleting it
+    seen = {log.id for log in logs}
+    logs += [log for log in archived_entries(dossier) if log.id not in seen]
+    return logs[:limit] if limit else logs
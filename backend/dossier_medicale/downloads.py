@@ -0,0 +1,134 @@
+"""Serving attachment files: conditional GET, byte ranges and sendfile offload.
+
+``attachment_response`` answers a permission-checked download with an
+``ETag`` (the content hash for content-addressed files, see storage.py) and
+``Last-Modified``, so revalidations end in a 304, and honours single
+``Range`` requests for resumed downloads and PDF.js streaming.
+
+With ``ATTACHMENT_DELIVERY`` set to ``'x-accel-redirect'`` (nginx) or
+``'x-sendfile'`` (Apache mod_xsendfile, lighttpd), Django only checks
+permissions and headers; the web server reads the file, handles ranges and
+transfers the bytes, so no Python worker is tied up streaming.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from .storage import CONTENT_ADDRESSED_NAME
+
+READ_SIZE = 64 * 1024
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def delivery():
+    return getattr(settings, 'ATTACHMENT_DELIVERY', 'django')
+
+
+def file_etag(name, stat):
+    match = CONTENT_ADDRESSED_NAME.search(name)
+    if match:
+        return '"%s"' % os.path.basename(match.group(0)).split('.')[0]
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def parse_range(header, size):
+    """(start, end) inclusive of a single-range ``Range`` header.
+
+    Returns None when the header is absent or not a single byte range (the
+    whole file is served) and raises ValueError when it cannot be satisfied.
+    """
+    match = RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range outside the file")
+    return start, end
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as source:
+        source.seek(start)
+        while length:
+            data = source.read(min(READ_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
+
+def _if_range_matches(request, etag, last_modified):
+    validator = request.headers.get('If-Range')
+    if not validator:
+        return True
+    if validator.startswith('"') or validator.startswith('W/'):
+        return validator == etag  # strong comparison only
+    return parse_http_date_safe(validator) == int(last_modified)
+
+
+def attachment_response(request, field_file, filename, as_attachment=False, content_type=None):
+    """Response delivering the stored ``field_file`` under ``filename``."""
+    path = field_file.path
+    stat = os.stat(path)
+    etag = file_etag(field_file.name, stat)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _file_response(request, field_file.name, path, stat.st_size, etag, last_modified)
+        response.headers['Content-Type'] = (
+            content_type or mimetypes.guess_type(filename)[0] or mimetypes.guess_type(path)[0]
+            or 'application/octet-stream'
+        )
+        response.headers['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
+    # Private data: browsers may keep a copy but must revalidate it (a 304)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _file_response(request, name, path, size, etag, last_modified):
+    mode = delivery()
+    if mode == 'x-accel-redirect':
+        response = HttpResponse()
+        prefix = getattr(settings, 'ATTACHMENT_ACCEL_PREFIX', '/protected-media/')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(name)
+        return response
+    if mode == 'x-sendfile':
+        response = HttpResponse()
+        response.headers['X-Sendfile'] = path
+        return response
+
+    response = None
+    if _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response.headers['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(_read_range(path, start, end - start + 1), status=206)
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response.headers['Content-Length'] = str(end - start + 1)
+    if response is None:
+        response = FileResponse(open(path, 'rb'))
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
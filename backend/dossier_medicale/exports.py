@@ -0,0 +1,171 @@
+"""Bulk export of dossier reports and attachments.
+
+``iter_export`` streams one ZIP holding, for every dossier, its PDF report
+and its attachments under a ``<reference>/`` folder. Dossiers are read a
+window at a time; cached reports are streamed from the report cache and
+missing ones are rendered, written to the archive as soon as each is ready
+and stored in the cache for the next export, so memory use is bounded by
+the window rather than by the export.
+
+Reports are rendered inline unless ``workers`` asks for a pool of worker
+processes (ReportLab is pure Python, so a thread pool would serialize on
+the GIL). Only the ``export_dossiers`` command and the ``bulk_export`` job
+use a pool: forking from a view would copy the web server process.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import django
+from django.conf import settings
+from django.db.models import Prefetch
+
+from user.models import User
+
+from .archives import iter_zip
+from .filecache import FileCache
+from .jobs import set_progress, task
+from .models import DossierMedical, PieceJointe
+from .reports import render_dossier_report, report_cache, report_name
+
+# Dossiers read, and reports rendered, per round
+WINDOW = 32
+
+# Archives produced by background exports, kept until downloaded or evicted
+export_cache = FileCache('exports', default_max_bytes=5 * 1024 ** 3)
+
+
+class _MemoryFile:
+    """Just enough of a FieldFile for iter_zip to read bytes already in hand."""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def open(self, mode='rb'):
+        return io.BytesIO(self.data)
+
+
+class _CachedFile:
+    """Just enough of a FieldFile for iter_zip to read a cached report."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+
+    def open(self, mode='rb'):
+        return open(self.path, 'rb')
+
+
+def export_workers():
+    return getattr(settings, 'EXPORT_WORKERS', None) or os.cpu_count() or 1
+
+
+def export_queryset(queryset, department=None, status=None, date_from=None, date_to=None):
+    """Narrow ``queryset`` to the dossiers matching the export filters."""
+    if department:
+        queryset = queryset.filter(department=department)
+    if status:
+        queryset = queryset.filter(status=status)
+    if date_from:
+        queryset = queryset.filter(created_at__date__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(created_at__date__lte=date_to)
+    return queryset.select_related('employer').prefetch_related(
+        Prefetch('pieces_jointes', queryset=PieceJointe.objects.order_by('id'))
+    ).order_by('id')
+
+
+def _windows(dossiers, size):
+    window = []
+    for dossier in dossiers.iterator(chunk_size=size):
+        window.append(dossier)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def _reports(window, executor):
+    """(dossier, pieces, report file) for the dossiers of ``window``.
+
+    Cached reports come first; rendered ones follow in the order they
+    complete, each held in memory only until it has been written out.
+    """
+    pending = []
+    for dossier in window:
+        pieces = list(dossier.pieces_jointes.all())
+        name = report_name(dossier, pieces)
+        path = report_cache.get(name)
+        if path is None:
+            pending.append((dossier, pieces, name))
+        else:
+            yield dossier, pieces, _CachedFile(name, path)
+
+    if executor:
+        futures = {
+            executor.submit(render_dossier_report, dossier, pieces): (dossier, pieces, name)
+            for dossier, pieces, name in pending
+        }
+        rendered = ((futures.pop(future), future.result()) for future in as_completed(futures))
+    else:
+        rendered = (((dossier, pieces, name), render_dossier_report(dossier, pieces))
+                    for dossier, pieces, name in pending)
+    for (dossier, pieces, name), pdf in rendered:
+        report_cache.store(name, pdf)
+        yield dossier, pieces, _MemoryFile(name, pdf)
+
+
+def _export_entries(dossiers, workers, progress, total):
+    executor = ProcessPoolExecutor(workers, initializer=django.setup) if workers > 1 else None
+    done = 0
+    try:
+        for window in _windows(dossiers, max(WINDOW, 2 * workers)):
+            for dossier, pieces, report in _reports(window, executor):
+                folder = dossier.reference
+                yield f'{folder}/rapport_{folder}.pdf', report, dossier.updated_at
+                for piece in pieces:
+                    yield f'{folder}/{piece.nom_fichier}', piece.chemin_storage, piece.date_upload
+                done += 1
+                if progress:
+                    progress(done, total)
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_export(dossiers, workers=1, progress=None):
+    """Yield a ZIP of the reports and attachments of the ``dossiers`` queryset.
+
+    Missing reports are rendered by ``workers`` processes, inline for one.
+    ``progress(done, total)`` is called after each dossier has been written.
+    """
+    total = dossiers.count()
+    if progress:
+        progress(0, total)
+    return iter_zip(_export_entries(dossiers, workers, progress, total))
+
+
+@task('bulk_export')
+def export_job(job, user_id, date_from=None, date_to=None, **filters):
+    """Write the export into ``export_cache``; payload dates are ISO strings."""
+    user = User.objects.select_related('role').get(pk=user_id)
+    dossiers = export_queryset(
+        DossierMedical.objects.visible_to(user),
+        date_from=date.fromisoformat(date_from) if date_from else None,
+        date_to=date.fromisoformat(date_to) if date_to else None,
+        **filters,
+    )
+    counts = {}
+
+    def progress(done, total):
+        counts['total'] = total
+        set_progress(job, done, total)
+
+    name = f'export-{job.pk}.zip'
+    chunks = iter_export(dossiers, workers=export_workers(), progress=progress)
+    for _ in export_cache.store_stream(name, chunks):
+        pass
+    return {'file': name, 'dossiers': counts.get('total', 0)}
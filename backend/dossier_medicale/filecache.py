@@ -0,0 +1,135 @@
+"""Size-bounded, on-disk LRU cache for generated files.
+
+Entries are plain files named by the caller (typically ``<owner>-<hash>``).
+A hit refreshes the file's mtime, and eviction removes the least recently
+used files once the directory exceeds its byte budget. Files are written
+to a temporary name and renamed into place, so readers never see partial
+entries. Caches of many small files can set ``evict_interval`` so the
+directory is scanned at most that often per process.
+"""
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+PARTIAL_SUFFIX = '.part'
+STALE_PARTIAL_SECONDS = 3600
+
+
+class FileCache:
+    def __init__(self, name, default_max_bytes, evict_interval=0):
+        self.name = name
+        self.default_max_bytes = default_max_bytes
+        self.evict_interval = evict_interval
+        self._last_evicted = None
+
+    @property
+    def directory(self):
+        root = getattr(settings, 'FILE_CACHE_ROOT', os.path.join(settings.BASE_DIR, 'cache'))
+        return os.path.join(root, self.name)
+
+    @property
+    def max_bytes(self):
+        limits = getattr(settings, 'FILE_CACHE_MAX_BYTES', {})
+        return limits.get(self.name, self.default_max_bytes)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """Return the path of a cached entry and mark it as used, or None."""
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _temporary(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=PARTIAL_SUFFIX)
+        return os.fdopen(fd, 'wb'), tmp
+
+    def store(self, name, data):
+        """Store ``data`` under ``name`` and return its path."""
+        out, tmp = self._temporary()
+        try:
+            with out:
+                out.write(data)
+            os.replace(tmp, self.path(name))
+        except BaseException:
+            _remove(tmp)
+            raise
+        self._maybe_evict()
+        return self.path(name)
+
+    def store_stream(self, name, chunks, publish=None):
+        """Yield ``chunks`` while copying them into the cache.
+
+        The entry is only published once the stream has been fully consumed,
+        and only if ``publish()``, when given, then returns true; an
+        abandoned stream (e.g. a client disconnect) leaves nothing behind.
+        """
+        out, tmp = self._temporary()
+        published = False
+        try:
+            with out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    yield chunk
+            if publish is None or publish():
+                os.replace(tmp, self.path(name))
+                published = True
+        finally:
+            if not published:
+                _remove(tmp)
+        self._maybe_evict()
+
+    def delete_prefix(self, prefix):
+        """Remove every entry whose name starts with ``prefix``."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith(prefix) and not entry.name.endswith(PARTIAL_SUFFIX):
+                _remove(entry.path)
+
+    def _maybe_evict(self):
+        if self._last_evicted is None or time.monotonic() - self._last_evicted >= self.evict_interval:
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its budget."""
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        self._last_evicted = time.monotonic()
+        now = time.time()
+        files = []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(PARTIAL_SUFFIX):
+                if now - stat.st_mtime > STALE_PARTIAL_SECONDS:
+                    _remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,7 +1,8 @@
 from django import forms
-from .models import DossierMedical, PieceJointe, User
+from .models import DossierAuditLog, DossierMedical, PieceJointe, User
 from django.utils import timezone
 from django.core.exceptions import ValidationError
+from .imports import detect_format
 
 class MultipleFileInput(forms.ClearableFileInput):
     allow_multiple_selected = True
@@ -131,4 +132,94 @@ class PriseEnChargeForm(forms.ModelForm):
         end_date = cleaned_data.get('end_date')
         if end_date and start_date and end_date < start_date:
             raise ValidationError("La date de fin ne peut pas être antérieure à la date de début.")
-        return cleaned_data
\ No newline at end of file
+        return cleaned_data
+
+class BulkExportForm(forms.Form):
+    department = forms.CharField(
+        required=False, widget=forms.TextInput(attrs={'class': 'form-control-modern'})
+    )
+    status = forms.ChoiceField(
+        required=False, choices=[('', 'Tous')] + DossierMedical.STATUS_CHOICES,
+        widget=forms.Select(attrs={'class': 'form-select-modern'}),
+    )
+    date_from = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control-modern'})
+    )
+    date_to = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control-modern'})
+    )
+    # Build the archive in a background job instead of streaming it now
+    background = forms.BooleanField(
+        required=False, widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_to < date_from:
+            raise ValidationError("La date de fin ne peut pas être antérieure à la date de début.")
+        return cleaned_data
+
+class AuditLogFilterForm(forms.Form):
+    action = forms.ChoiceField(
+        required=False, choices=[('', 'Toutes')] + DossierAuditLog.ACTION_CHOICES,
+        widget=forms.Select(attrs={'class': 'form-select-modern'}),
+    )
+    user = forms.EmailField(
+        required=False, widget=forms.EmailInput(attrs={'class': 'form-control-modern', 'placeholder': 'E-mail'})
+    )
+    reference = forms.CharField(
+        required=False, max_length=50,
+        widget=forms.TextInput(attrs={'class': 'form-control-modern', 'placeholder': 'DM-...'}),
+    )
+    new_status = forms.ChoiceField(
+        required=False, choices=[('', 'Tous')] + DossierMedical.STATUS_CHOICES,
+        widget=forms.Select(attrs={'class': 'form-select-modern'}),
+    )
+    filename = forms.CharField(
+        required=False, max_length=255, widget=forms.TextInput(attrs={'class': 'form-control-modern'})
+    )
+    date_from = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control-modern'})
+    )
+    date_to = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={'type': 'date', 'class': 'form-control-modern'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from = cleaned_data.get('date_from')
+        date_to = cleaned_data.get('date_to')
+        if date_from and date_to and date_to < date_from:
+            raise ValidationError("La date de fin ne peut pas être antérieure à la date de début.")
+        return cleaned_data
+
+
+class UploadSessionForm(forms.Form):
+    """Opening of a chunked upload (see uploads.py)."""
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1)
+    nom_fichier = forms.CharField(max_length=255, required=False)
+    type = forms.CharField(max_length=50, required=False)
+    description = forms.CharField(required=False)
+    # Hex SHA-256 of the whole file, verified once it is complete
+    sha256 = forms.RegexField(regex=r'^[0-9a-fA-F]{64}$', required=False)
+
+
+class ImportForm(forms.Form):
+    """Bulk import file uploaded from the admin (see imports.py)."""
+    FORMAT_CHOICES = [('', "D'après l'extension"), ('csv', 'CSV'), ('json', 'JSON'), ('ndjson', 'NDJSON')]
+
+    file = forms.FileField(label="Fichier")
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False)
+    dry_run = forms.BooleanField(required=False, label="Valider sans importer")
+
+    def clean(self):
+        cleaned = super().clean()
+        upload = cleaned.get('file')
+        if upload and not cleaned.get('format'):
+            cleaned['format'] = detect_format(upload.name)
+            if cleaned['format'] is None:
+                raise ValidationError("Format inconnu : choisissez CSV, JSON ou NDJSON.")
+        return cleaned
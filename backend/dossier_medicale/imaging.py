@@ -0,0 +1,182 @@
+"""Upload-time normalization of photographed documents.
+
+Phone photos of paperwork arrive as 5-10 MB JPEGs or PNGs, at resolutions
+and qualities far beyond what reading them needs. When
+``UPLOAD_IMAGE_POLICY`` is set, ``attachment_fields`` runs the stages the
+policy enables before the file is stored:
+
+* metadata strip: EXIF (GPS position, device, ...) is dropped, after the
+  orientation it records has been applied to the pixels;
+* downscale: to at most ``max_side`` pixels and, for images declaring their
+  resolution, ``max_dpi``; the declared resolution shrinks with the pixels,
+  so the printed size stays the same;
+* re-encode: JPEGs, and PNGs that are photographs rather than scans or
+  screenshots, as ``format`` (JPEG or WEBP) at ``quality``.
+
+The normalized file replaces the upload only when it is smaller or the
+policy asked for metadata to go; the original is kept alongside
+(``PieceJointe.chemin_original``) only if ``keep_original`` is set.
+"""
+import io
+import os
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# A PNG with more distinct colours than this in a nearest-neighbour sample
+# (which keeps sensor noise, unlike a smoothing downscale) is a photo
+PHOTO_MIN_COLORS = 2048
+PHOTO_SAMPLE_SIZE = 256
+
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+# Extensions of the uploads the pipeline reads, as it writes them
+IMAGE_EXTENSIONS = {'.jpg': '.jpg', '.jpeg': '.jpg', '.png': '.png'}
+
+
+class ImagePolicy(NamedTuple):
+    strip_metadata: bool = True
+    max_side: Optional[int] = 3508   # pixels; A4 at 300 dpi
+    max_dpi: Optional[int] = 300
+    format: str = 'JPEG'             # JPEG or WEBP
+    quality: int = 82
+    png_photos: bool = True          # re-encode photographic PNGs as ``format``
+    keep_original: bool = False
+
+
+class Normalized(NamedTuple):
+    file: ContentFile
+    stages: tuple
+
+
+def upload_policy():
+    """The ImagePolicy from ``UPLOAD_IMAGE_POLICY``, or None when the pipeline is off."""
+    options = getattr(settings, 'UPLOAD_IMAGE_POLICY', None)
+    return None if options is None else ImagePolicy(**options)
+
+
+def _is_photo(image):
+    if image.mode in ('RGBA', 'LA', 'PA') and image.getchannel('A').getextrema()[0] < 255:
+        return False  # real transparency, which JPEG cannot keep
+    sample = image.resize((PHOTO_SAMPLE_SIZE, PHOTO_SAMPLE_SIZE), Image.NEAREST).convert('RGB')
+    return sample.getcolors(PHOTO_MIN_COLORS) is None
+
+
+def _scale(image, policy):
+    scale = 1.0
+    if policy.max_side:
+        scale = min(scale, policy.max_side / max(image.size))
+    dpi = image.info.get('dpi')
+    if policy.max_dpi and dpi and dpi[0] > 1:
+        scale = min(scale, policy.max_dpi / float(dpi[0]))
+    return scale
+
+
+def normalize_image(data, name, policy):
+    """Normalize the image ``data`` (named ``name``) following ``policy``.
+
+    Returns a Normalized file and the stages applied, or None when the data
+    is not a readable JPEG/PNG image or the result would not be worth storing.
+    """
+    try:
+        return _normalize(data, name, policy)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError, ValueError):
+        return None
+
+
+def _normalize(data, name, policy):
+    image = Image.open(io.BytesIO(data))
+    source_format = image.format
+    if source_format not in ('JPEG', 'PNG'):
+        return None
+    stages = []
+    metadata = bool(image.info.get('exif') or image.getexif())
+
+    scale = _scale(image, policy)
+    source_longest = max(image.size)
+    longest = max(1, round(source_longest * scale))
+    dpi = image.info.get('dpi')
+    if source_format == 'JPEG' and scale < 1:
+        # Decode straight at a reduced scale (still at least ``longest``)
+        image.draft(image.mode, (longest, longest))
+    photo = source_format == 'JPEG' or (policy.png_photos and _is_photo(image))
+
+    if policy.strip_metadata:
+        image = ImageOps.exif_transpose(image)
+        if metadata:
+            stages.append('strip')
+    if scale < 1:
+        image.thumbnail((longest, longest), Image.LANCZOS, reducing_gap=3.0)
+        if dpi:
+            factor = max(image.size) / source_longest
+            dpi = tuple(
+                min(round(value * factor), policy.max_dpi) if policy.max_dpi else round(value * factor)
+                for value in dpi
+            )
+        stages.append('downscale')
+
+    options = {}
+    if dpi:
+        options['dpi'] = dpi
+    if image.info.get('icc_profile'):
+        options['icc_profile'] = image.info['icc_profile']
+    if not policy.strip_metadata and image.info.get('exif'):
+        options['exif'] = image.info['exif']
+    if photo:
+        output_format = policy.format.upper()
+        options['quality'] = policy.quality
+        if output_format == 'JPEG':
+            options.update(optimize=True, progressive=True)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        stages.append('reencode' if source_format == 'JPEG' else 'png-to-' + output_format.lower())
+    else:
+        # Lossless: scans and screenshots stay PNG (zlib ``optimize`` costs
+        # seconds on a full page for a few percent)
+        output_format = 'PNG'
+
+    buffer = io.BytesIO()
+    image.save(buffer, output_format, **options)
+    result = buffer.getvalue()
+    if len(result) >= len(data) and 'strip' not in stages:
+        return None
+    base = os.path.splitext(os.path.basename(name))[0]
+    return Normalized(ContentFile(result, name=base + EXTENSIONS[output_format]), tuple(stages))
+
+
+def display_name(nom_fichier, stored_name):
+    """``nom_fichier`` with its image extension changed to that of ``stored_name``."""
+    base, extension = os.path.splitext(nom_fichier)
+    stored_extension = os.path.splitext(stored_name)[1]
+    if extension.lower() not in IMAGE_EXTENSIONS or IMAGE_EXTENSIONS[extension.lower()] == stored_extension:
+        return nom_fichier
+    return base + stored_extension
+
+
+def attachment_fields(upload, policy=None, nom_fichier=None):
+    """PieceJointe field values storing the uploaded file ``upload``.
+
+    ``chemin_storage`` is the normalized image when the pipeline applies,
+    otherwise ``upload`` itself; ``taille_ko`` is the size actually stored.
+    With ``nom_fichier`` the values include it, its extension following a
+    change of format.
+    """
+    policy = policy or upload_policy()
+    normalized = None
+    if policy is not None and os.path.splitext(upload.name)[1].lower() in IMAGE_EXTENSIONS:
+        upload.seek(0)
+        normalized = normalize_image(upload.read(), upload.name, policy)
+        upload.seek(0)
+    if normalized is None:
+        fields = {'chemin_storage': upload, 'taille_ko': upload.size // 1024}
+    else:
+        fields = {'chemin_storage': normalized.file, 'taille_ko': normalized.file.size // 1024}
+        if policy.keep_original:
+            fields['chemin_original'] = upload
+        if nom_fichier is not None:
+            nom_fichier = display_name(nom_fichier, normalized.file.name)
+    if nom_fichier is not None:
+        fields['nom_fichier'] = nom_fichier
+    return fields
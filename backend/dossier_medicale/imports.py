@@ -0,0 +1,347 @@
+"""Bulk import of dossiers and prises en charge from CSV, JSON or NDJSON.
+
+Rows are validated in one streaming pass against the model fields, with the
+employers/patients they name (by e-mail) resolved from a single prefetched
+map instead of a query per row. Valid rows are written ``batch_size`` at a
+time. The slow or locking steps of a batch come before its transaction:
+its block of references, its controllers (one locked read of the
+workloads) and its attachments, hashed and copied into storage. The
+transaction then only inserts: one ``bulk_create`` for the rows, their
+CREATE audit entries, attachment metadata and search entries. An invalid
+row is reported with its line and skipped; it never aborts the rest of the
+file. A batch that fails releases the attachment blobs it acquired.
+
+``bulk_create`` bypasses ``save()`` and the post_save signals, so what they
+do for a single dossier (department, controller assignment, search index,
+workload counters, cached stats) is done here once per batch or import.
+
+The admin import page runs ``import_job`` in the background with the
+uploaded file staged under CHUNKED_UPLOAD_ROOT.
+"""
+import csv
+import io
+import json
+import os
+import uuid
+from typing import NamedTuple
+
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import DatabaseError, transaction
+
+from user.models import User
+
+from . import assignment, previews, search
+from .jobs import set_progress, task
+from .models import DossierAuditLog, DossierMedical, PieceJointe, PriseEnCharge
+from .permissions import capabilities_for
+from .references import allocate_references
+from .stats import invalidate_dossier_stats, invalidate_report_snapshot
+from .storage import release_files
+from .uploads import upload_root
+
+BATCH_SIZE = 1000
+
+# Rejected rows kept in the result of an import job
+ERRORS_KEPT = 200
+
+FORMATS = ('csv', 'json', 'ndjson')
+
+# Attachment paths in a CSV cell
+ATTACHMENT_SEPARATOR = ';'
+
+
+class ImportKind(NamedTuple):
+    model: type
+    prefix: str
+    person_field: str   # the user the row is about, given by e-mail
+    fields: tuple       # columns copied onto the model
+
+
+KINDS = {
+    'dossier': ImportKind(
+        DossierMedical, 'DM', 'employer',
+        ('status', 'category', 'department', 'start_date', 'end_date', 'doctor', 'diagnosis',
+         'treatment_plan', 'comments', 'reason', 'priority', 'is_confidential'),
+    ),
+    'pec': ImportKind(
+        PriseEnCharge, 'PEC', 'patient',
+        ('status', 'institution', 'care_type', 'estimated_cost', 'coverage_percentage',
+         'start_date', 'end_date', 'diagnosis', 'physician', 'department', 'comments'),
+    ),
+}
+
+
+class RowError(NamedTuple):
+    line: int   # CSV/NDJSON line, or position in a JSON array (from 1)
+    message: str
+
+
+class ImportResult(NamedTuple):
+    rows: int
+    created: int
+    errors: list
+
+
+def detect_format(filename):
+    """'csv', 'json' or 'ndjson' from the extension of ``filename``, or None."""
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    if extension == 'jsonl':
+        return 'ndjson'
+    return extension if extension in FORMATS else None
+
+
+def read_rows(stream, format):
+    """Yield (line, row) from the binary ``stream``.
+
+    ``row`` is a dict, or a RowError for input that could not be parsed.
+    CSV and NDJSON are read incrementally; a JSON array is loaded whole.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if format == 'csv' else None)
+    if format == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'ndjson':
+        for line, data in enumerate(text, 1):
+            if data.strip():
+                yield line, _parse_json(line, data)
+    elif format == 'json':
+        try:
+            items = json.load(text)
+        except ValueError as exc:
+            yield 1, RowError(1, f"Invalid JSON: {exc}")
+            return
+        if not isinstance(items, list):
+            yield 1, RowError(1, "Expected a JSON array of objects")
+            return
+        for line, item in enumerate(items, 1):
+            yield line, item if isinstance(item, dict) else RowError(line, "Expected an object")
+    else:
+        raise ValueError(f"Unknown import format: {format}")
+
+
+def _parse_json(line, data):
+    try:
+        row = json.loads(data)
+    except ValueError as exc:
+        return RowError(line, f"Invalid JSON: {exc}")
+    return row if isinstance(row, dict) else RowError(line, "Expected an object")
+
+
+def people_by_email():
+    """Every user, by lowercased e-mail, with the fields the import and the index read."""
+    users = User.objects.only('id', 'email', 'department', 'full_name', 'first_name', 'last_name')
+    return {user.email.lower(): user for user in users.iterator(chunk_size=2000)}
+
+
+def _message(error):
+    if hasattr(error, 'error_dict'):
+        return '; '.join(
+            f"{field}: {' '.join(messages)}" for field, messages in error.message_dict.items()
+        )
+    return ' '.join(error.messages)
+
+
+def _attachment_paths(value, attachments_dir):
+    if isinstance(value, str):
+        value = [path for path in value.split(ATTACHMENT_SEPARATOR) if path.strip()]
+    if not value:
+        return []
+    if not isinstance(value, list) or not all(isinstance(path, str) for path in value):
+        raise ValidationError({'attachments': "Expected a list of file paths"})
+    if attachments_dir is None:
+        raise ValidationError({'attachments': "No attachments directory given"})
+    root = os.path.realpath(attachments_dir)
+    paths = []
+    for name in value:
+        path = os.path.realpath(os.path.join(root, name.strip()))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            raise ValidationError({'attachments': f"File not found: {name.strip()}"})
+        paths.append(path)
+    return paths
+
+
+def build_instance(kind, row, people, user, attachments_dir=None):
+    """Validated, unsaved instance for ``row`` and its attachment paths.
+
+    Raises ValidationError describing every invalid field.
+    """
+    email = str(row.get(kind.person_field) or '').strip().lower()
+    person = people.get(email)
+    if person is None:
+        raise ValidationError({kind.person_field: f"Unknown user: {email or '(empty)'}"})
+    values = {
+        field: row[field] for field in kind.fields
+        if row.get(field) not in (None, '')
+    }
+    instance = kind.model(created_by=user, **{kind.person_field: person}, **values)
+    if not instance.department:
+        instance.department = person.department or "Non spécifié"
+    # Converts the raw strings (dates, numbers, flags) in place
+    instance.clean_fields(exclude=['reference', 'created_by', 'controller', kind.person_field])
+    return instance, _attachment_paths(row.get('attachments'), attachments_dir)
+
+
+def import_rows(kind, rows, user, batch_size=BATCH_SIZE, attachments_dir=None, dry_run=False,
+                progress=None):
+    """Import the (line, row) pairs of ``rows`` as ``kind`` objects created by ``user``.
+
+    Returns an ImportResult listing every rejected row. With ``dry_run``
+    rows are only validated.
+    """
+    kind = KINDS[kind] if isinstance(kind, str) else kind
+    people = people_by_email()
+    assign = kind.model is DossierMedical and capabilities_for(user).role == 'AGENT'
+    count = created = 0
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal created
+        if not dry_run:
+            try:
+                created += _write_batch(kind, batch, user, assign)
+            except DatabaseError as exc:
+                errors.extend(RowError(line, f"Not saved: {exc}") for line, _, _ in batch)
+        else:
+            created += len(batch)
+        batch.clear()
+        if progress:
+            progress(count, created)
+
+    for line, row in rows:
+        count += 1
+        if isinstance(row, RowError):
+            errors.append(row)
+            continue
+        try:
+            instance, paths = build_instance(kind, row, people, user, attachments_dir)
+        except ValidationError as exc:
+            errors.append(RowError(line, _message(exc)))
+            continue
+        batch.append((line, instance, paths))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    if created and not dry_run:
+        if kind.model is DossierMedical:
+            transaction.on_commit(invalidate_dossier_stats)
+        transaction.on_commit(invalidate_report_snapshot)
+    return ImportResult(count, created, errors)
+
+
+def _write_batch(kind, batch, user, assign):
+    instances = [instance for _, instance, _ in batch]
+    # Reserved before the batch's transaction so the counter row is not
+    # locked while it runs; a batch that fails leaves a gap in the sequence
+    references = allocate_references(kind.model, kind.prefix, len(instances))
+    for instance, reference in zip(instances, references):
+        instance.reference = reference
+    if assign:
+        submitted = [instance for instance in instances if instance.status == 'SUBMITTED']
+        controllers = assignment.assign_controllers([instance.department for instance in submitted])
+        for instance, controller_id in zip(submitted, controllers):
+            instance.controller_id = controller_id
+    pieces = _store_files(batch, user) if kind.model is DossierMedical else []
+    try:
+        with transaction.atomic():
+            _insert_batch(kind, instances, pieces, user)
+    except BaseException:
+        release_files([piece.chemin_storage for piece in pieces])
+        raise
+    return len(instances)
+
+
+def _insert_batch(kind, instances, pieces, user):
+    references = [instance.reference for instance in instances]
+    kind.model.objects.bulk_create(instances)
+
+    # Bulk inserts do not return ids on every backend; read them back
+    ids = dict(
+        kind.model.objects.filter(reference__in=references).values_list('reference', 'id')
+    )
+    for instance in instances:
+        instance.pk = ids[instance.reference]
+        instance._state.adding = False
+    search.index_new_instances(instances)
+
+    if kind.model is DossierMedical:
+        DossierAuditLog.objects.bulk_create([
+            DossierAuditLog(
+                dossier=instance, action='CREATE', user=user,
+                details={'reference': instance.reference, 'status': instance.status, 'import': True},
+            )
+            for instance in instances
+        ])
+        assignment.track_creations([(instance.controller_id, instance.status) for instance in instances])
+        for instance in instances:
+            instance._workload_state = (instance.controller_id, instance.status)
+        _attach_files(instances, pieces)
+
+
+def _store_files(batch, user):
+    """Unsaved PieceJointe rows for the batch's attachments, their files
+    already in storage."""
+    pieces = []
+    try:
+        for _, dossier, paths in batch:
+            for path in paths:
+                name = os.path.basename(path)
+                piece = PieceJointe(
+                    dossier=dossier,
+                    nom_fichier=name,
+                    type=os.path.splitext(name)[1].lstrip('.').upper() or 'OTHER',
+                    taille_ko=os.path.getsize(path) // 1024,
+                    uploaded_by=user,
+                )
+                with open(path, 'rb') as source:
+                    piece.chemin_storage.save(name, File(source), save=False)
+                pieces.append(piece)
+    except BaseException:
+        release_files([piece.chemin_storage for piece in pieces])
+        raise
+    return pieces
+
+
+def _attach_files(dossiers, pieces):
+    if not pieces:
+        return
+    # bulk_create takes the dossier ids, set since the pieces were built
+    PieceJointe.objects.bulk_create(pieces)
+    for piece in PieceJointe.objects.filter(dossier__in=dossiers):
+        previews.queue_previews(piece)
+
+
+def stage_upload(upload):
+    """Copy the uploaded file ``upload`` to a path ``import_job`` can read."""
+    directory = os.path.join(upload_root(), 'imports')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, uuid.uuid4().hex + os.path.splitext(upload.name)[1].lower())
+    with open(path, 'wb') as out:
+        for chunk in upload.chunks():
+            out.write(chunk)
+    return path
+
+
+@task('import_records')
+def import_job(job, kind, path, format, user_id, dry_run=False):
+    """Import the staged file at ``path``, which is deleted afterwards."""
+    user = User.objects.select_related('role').get(pk=user_id)
+    try:
+        with open(path, 'rb') as stream:
+            result = import_rows(
+                kind, read_rows(stream, format), user, dry_run=dry_run,
+                progress=lambda rows, created: set_progress(job, rows, None),
+            )
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return {
+        'rows': result.rows,
+        'created': result.created,
+        'rejected': len(result.errors),
+        'errors': [{'line': error.line, 'message': error.message} for error in result.errors[:ERRORS_KEPT]],
+    }
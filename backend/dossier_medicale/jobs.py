@@ -0,0 +1,165 @@
+"""Database-backed background jobs.
+
+Views call ``enqueue`` to record a Job row; ``manage.py run_jobs`` claims due
+jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``, so several workers never
+pick the same row (SQLite falls back to a guarded UPDATE), and runs them in
+a thread or process pool. A failing job is retried with exponential backoff
+until ``max_attempts`` is reached.
+
+A worker refreshes the locks of the jobs it is running every
+JOB_HEARTBEAT_INTERVAL seconds, so only a job whose worker died sees its
+lock go stale and is handed out again. A job's outcome is only recorded
+while the job is still locked by the worker that ran it.
+
+Tasks are plain functions registered with ``@task('name')``; they receive
+the running Job followed by its payload as keyword arguments, and return a
+JSON-serializable result.
+"""
+import logging
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    """Register the decorated function as the task ``name``."""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def _load_tasks():
+    # Modules defining tasks; importing them fills TASKS
+    from . import audit, exports, imports, previews, reports  # noqa: F401
+
+
+def enqueue(name, user=None, delay=None, max_attempts=None, **payload):
+    """Queue the task ``name`` with ``payload`` and return the Job.
+
+    Inside a transaction the job only becomes visible to workers on commit,
+    so it never runs against rows the request has not committed yet.
+    """
+    return Job.objects.create(
+        task=name,
+        payload=payload,
+        created_by=user,
+        run_at=timezone.now() + (delay or timedelta()),
+        max_attempts=max_attempts or getattr(settings, 'JOB_MAX_ATTEMPTS', 3),
+    )
+
+
+def retry_delay(attempts):
+    """Backoff before attempt ``attempts + 1``: doubling, capped, with jitter."""
+    base = getattr(settings, 'JOB_RETRY_BACKOFF', 30)
+    cap = getattr(settings, 'JOB_RETRY_BACKOFF_MAX', 3600)
+    seconds = min(cap, base * 2 ** (attempts - 1))
+    return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+def _take(jobs, worker, now):
+    return jobs.update(status='RUNNING', locked_by=worker, locked_at=now, attempts=F('attempts') + 1)
+
+
+def claim(worker, limit):
+    """Lock up to ``limit`` due jobs for ``worker`` and return their ids."""
+    now = timezone.now()
+    due = Job.objects.filter(status='QUEUED', run_at__lte=now).order_by('run_at', 'id')
+    if not connection.features.has_select_for_update_skip_locked:
+        # No row locks (SQLite): take each candidate with a guarded UPDATE, so
+        # a job another worker got first simply matches no row
+        return [
+            job_id for job_id in due.values_list('id', flat=True)[:limit]
+            if _take(Job.objects.filter(pk=job_id, status='QUEUED'), worker, now)
+        ]
+    with transaction.atomic():
+        ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:limit])
+        if ids:
+            _take(Job.objects.filter(id__in=ids), worker, now)
+    return ids
+
+
+def requeue_stale():
+    """Hand jobs locked by a worker that stopped responding back to the queue."""
+    now = timezone.now()
+    stale = Job.objects.filter(
+        status='RUNNING', locked_at__lt=now - timedelta(seconds=getattr(settings, 'JOB_LOCK_TIMEOUT', 3600)),
+    )
+    stale.filter(attempts__gte=F('max_attempts')).update(
+        status='FAILED', error='Worker lost', locked_by='', locked_at=None, finished_at=now,
+    )
+    return stale.update(status='QUEUED', locked_by='', locked_at=None)
+
+
+def heartbeat(worker):
+    """Refresh the locks of the jobs ``worker`` is running."""
+    return Job.objects.filter(status='RUNNING', locked_by=worker).update(locked_at=timezone.now())
+
+
+def _finish(job, **changes):
+    # A job requeued while it ran may now belong to another worker
+    if not Job.objects.filter(pk=job.pk, status='RUNNING', locked_by=job.locked_by).update(**changes):
+        logger.warning("Job %s (%s) lost its lock; outcome not recorded", job.pk, job.task)
+
+
+def set_progress(job, done, total):
+    Job.objects.filter(pk=job.pk).update(progress={'done': done, 'total': total})
+
+
+def run(job_id):
+    """Run a claimed job and record its outcome."""
+    job = Job.objects.get(pk=job_id)
+    func = TASKS.get(job.task)
+    if func is None:
+        _load_tasks()
+        func = TASKS.get(job.task)
+    try:
+        if func is None:
+            raise LookupError(f"Unknown task {job.task!r}")
+        result = func(job, **job.payload)
+    except Exception:
+        _failed(job, traceback.format_exc())
+    else:
+        _finish(job, status='SUCCEEDED', result=result, error='', locked_by='', finished_at=timezone.now())
+
+
+def run_in_worker(job_id):
+    """``run`` for pool threads and processes, which manage their own connections."""
+    close_old_connections()
+    try:
+        run(job_id)
+    finally:
+        close_old_connections()
+
+
+def _failed(job, error):
+    logger.warning("Job %s (%s) failed on attempt %d/%d", job.pk, job.task, job.attempts, job.max_attempts)
+    if job.attempts < job.max_attempts:
+        changes = {'status': 'QUEUED', 'run_at': timezone.now() + retry_delay(job.attempts)}
+    else:
+        changes = {'status': 'FAILED', 'finished_at': timezone.now()}
+    _finish(job, error=error, locked_by='', locked_at=None, **changes)
+
+
+def job_state(job):
+    """Polling payload for ``job``."""
+    return {
+        'id': job.pk,
+        'task': job.task,
+        'status': job.status,
+        'attempts': job.attempts,
+        'progress': job.progress,
+        'result': job.result if job.status == 'SUCCEEDED' else None,
+        'error': job.error.strip().splitlines()[-1] if job.error else None,
+    }
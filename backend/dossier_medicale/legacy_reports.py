@@ -0,0 +1,114 @@
+"""Frozen copy of the report rendering generate_report did inline before
+the layout engine (reports.py), kept as the baseline of benchmark_reports.
+
+Do not update it when the report changes: it measures the old code.
+"""
+import io
+
+from django.utils import timezone
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+
+def render_inline(dossier, pieces):
+    """The report as generate_report used to build it, styles and all, per call."""
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
+    styles = getSampleStyleSheet()
+    
+    # Custom Styles
+    title_style = ParagraphStyle(
+        'TitleStyle',
+        parent=styles['Heading1'],
+        fontSize=20,
+        textColor=colors.HexColor("#0ea5e9"),
+        alignment=1,
+        spaceAfter=30
+    )
+    
+    section_style = ParagraphStyle(
+        'SectionStyle',
+        parent=styles['Heading2'],
+        fontSize=14,
+        textColor=colors.HexColor("#1e293b"),
+        spaceBefore=20,
+        spaceAfter=10,
+        borderPadding=5,
+        backgroundColor=colors.HexColor("#f1f5f9")
+    )
+
+    content = []
+
+    # Title
+    content.append(Paragraph(f"RAPPORT MÉDICAL", title_style))
+    content.append(Paragraph(f"Référence: {dossier.reference}", styles['Normal']))
+    content.append(Spacer(1, 0.2 * inch))
+
+    # General Information Table
+    data = [
+        ["INFORMATION GÉNÉRALE", ""],
+        ["Employé:", dossier.employer.full_name],
+        ["Département:", dossier.department],
+        ["Médecin:", dossier.doctor],
+        ["Date de début:", dossier.start_date.strftime('%d/%m/%Y')],
+        ["Statut:", dossier.get_status_display()],
+        ["Priorité:", dossier.get_priority_display()]
+    ]
+    
+    t = Table(data, colWidths=[1.5*inch, 4*inch])
+    t.setStyle(TableStyle([
+        ('SPAN', (0, 0), (1, 0)),
+        ('BACKGROUND', (0, 0), (1, 0), colors.HexColor("#0ea5e9")),
+        ('TEXTCOLOR', (0, 0), (1, 0), colors.whitesmoke),
+        ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
+        ('BOTTOMPADDING', (0, 0), (1, 0), 12),
+        ('BACKGROUND', (0, 1), (0, -1), colors.HexColor("#f8fafc")),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('TOPPADDING', (0, 1), (-1, -1), 8),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+        ('LEFTPADDING', (0, 0), (-1, -1), 12),
+    ]))
+    content.append(t)
+
+    # Medical Details
+    content.append(Paragraph("DÉTAILS MÉDICAUX", section_style))
+    
+    content.append(Paragraph("<b>Diagnostic:</b>", styles['Normal']))
+    content.append(Paragraph(dossier.diagnosis, styles['Normal']))
+    content.append(Spacer(1, 0.1 * inch))
+    
+    content.append(Paragraph("<b>Plan de Traitement:</b>", styles['Normal']))
+    content.append(Paragraph(dossier.treatment_plan, styles['Normal']))
+    
+    if dossier.reason:
+        content.append(Spacer(1, 0.1 * inch))
+        content.append(Paragraph("<b>Raison:</b>", styles['Normal']))
+        content.append(Paragraph(dossier.reason, styles['Normal']))
+
+    if dossier.comments:
+        content.append(Spacer(1, 0.1 * inch))
+        content.append(Paragraph("<b>Commentaires additionnels:</b>", styles['Normal']))
+        content.append(Paragraph(dossier.comments, styles['Normal']))
+
+    # Documents
+    if pieces:
+        content.append(Paragraph("PIÈCES JOINTES", section_style))
+        for piece in pieces:
+            content.append(Paragraph(f"• {piece.nom_fichier} ({piece.type})", styles['Normal']))
+
+    # Footer
+    content.append(Spacer(1, 0.5 * inch))
+    footer_text = f"Généré le {timezone.now().strftime('%d/%m/%Y à %H:%M')} - Système de Gestion Dossiers Médicaux"
+    content.append(Paragraph(footer_text, styles['Italic']))
+
+    # Build PDF
+    doc.build(content)
+    
+    pdf = buffer.getvalue()
+    buffer.close()
+    return pdf
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from dossier_medicale.audit_archive import CHUNK_SIZE, archive_entries
+
+
+class Command(BaseCommand):
+    help = "Move audit log entries past the retention period to the compressed archives"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'AUDIT_LOG_RETENTION_DAYS', None),
+                            help="Age in days after which an entry is archived")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--pause', type=float, default=0, help="Seconds to wait between chunks")
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError("No retention period: set AUDIT_LOG_RETENTION_DAYS or pass --days")
+        count = archive_entries(
+            timezone.now() - timedelta(days=options['days']),
+            chunk_size=options['chunk_size'],
+            pause=options['pause'],
+            progress=lambda moved: self.stdout.write(f"{moved} entries archived"),
+        )
+        self.stdout.write(f"{count} audit log entries archived")
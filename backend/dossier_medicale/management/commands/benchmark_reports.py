@@ -0,0 +1,101 @@
+"""Compare report rendering with the precompiled layout engine against the
+previous inline implementation (see legacy_reports), which rebuilt every
+style on each call."""
+import time
+import tracemalloc
+from contextlib import contextmanager
+from statistics import median
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dossier_medicale import reports
+from dossier_medicale.legacy_reports import render_inline
+from dossier_medicale.models import DossierMedical
+from dossier_medicale.reports import render_dossier_report, stream_encoding
+
+
+def _cpu_per_call(render, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.process_time()
+        render()
+        samples.append(time.process_time() - start)
+    return median(samples)
+
+
+def _peak_memory_per_call(render, iterations):
+    tracemalloc.start()
+    try:
+        peaks = []
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            render()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return median(peaks)
+
+
+@contextmanager
+def _stream_encoding(a85):
+    # The engine sets the encoding around its own builds; the inline renderer
+    # uses whatever ReportLab is set to
+    previous = reports.STREAM_A85
+    reports.STREAM_A85 = a85
+    try:
+        with stream_encoding(a85):
+            yield
+    finally:
+        reports.STREAM_A85 = previous
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-report CPU time and allocations of the report layout engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dossier', type=int, help="Dossier id (default: the most recent one)")
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--a85', action='store_true',
+                            help="Also compare both with ReportLab's ASCII85 stream encoding")
+
+    def handle(self, *args, **options):
+        dossiers = DossierMedical.objects.select_related('employer')
+        dossier = dossiers.filter(pk=options['dossier']).first() if options['dossier'] else dossiers.first()
+        if dossier is None:
+            raise CommandError("No dossier to render")
+        pieces = list(dossier.pieces_jointes.all())
+        iterations = options['iterations']
+
+        candidates = {
+            'inline': lambda: render_inline(dossier, pieces),
+            'engine': lambda: render_dossier_report(dossier, pieces),
+        }
+        for render in candidates.values():
+            render()  # warm up imports, fonts and the compiled styles
+
+        # Both candidates run under the same ReportLab settings, so the ratio
+        # measures the layout code; --a85 measures the stream encoding apart
+        with _stream_encoding(a85=False):
+            self._compare(candidates, iterations, '')
+        if options['a85']:
+            with _stream_encoding(a85=True):
+                self._compare(candidates, iterations, ' (ASCII85)')
+
+    def _compare(self, candidates, iterations, label):
+        results = {}
+        for name, render in candidates.items():
+            results[name] = (
+                _cpu_per_call(render, iterations),
+                _peak_memory_per_call(render, max(1, iterations // 10)),
+            )
+            cpu, peak = results[name]
+            self.stdout.write(
+                f"{name:>8}{label}: {cpu * 1000:7.2f} ms CPU, {peak / 1024:8.1f} KiB peak memory per report"
+            )
+
+        inline_cpu, inline_peak = results['inline']
+        engine_cpu, engine_peak = results['engine']
+        self.stdout.write(self.style.SUCCESS(
+            f"engine/inline{label}: {engine_cpu / inline_cpu:.2f}x CPU, {engine_peak / inline_peak:.2f}x peak memory"
+        ))
@@ -0,0 +1,109 @@
+"""Measure what the upload image policy saves on a sample corpus.
+
+Storage counts each distinct resulting file once, as the deduplicating
+attachment storage does; downloads count every file, as each reviewer
+download transfers the whole stored attachment.
+"""
+import hashlib
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dossier_medicale.imaging import ImagePolicy, normalize_image, upload_policy
+from dossier_medicale.models import PieceJointe
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def _corpus_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in os.walk(path):
+                for name in sorted(names):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield name, os.path.join(directory, name)
+        else:
+            yield os.path.basename(path), path
+
+
+def _read(path):
+    with open(path, 'rb') as source:
+        return source.read()
+
+
+def _stored_attachments(limit):
+    pieces = PieceJointe.objects.exclude(chemin_storage='').order_by('-id')
+    count = 0
+    for piece in pieces.iterator():
+        if count == limit:
+            return
+        if piece.chemin_storage.name.lower().endswith(IMAGE_EXTENSIONS):
+            count += 1
+            with piece.chemin_storage.open('rb') as stored:
+                yield piece.chemin_storage.name, stored.read()
+
+
+def _megabytes(size):
+    return f"{size / 1024 ** 2:8.2f} MB"
+
+
+class Command(BaseCommand):
+    help = "Report storage and download bytes saved by the upload image policy on a sample corpus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Image files or directories (default: stored attachments)")
+        parser.add_argument('--limit', type=int, default=200, help="Stored attachments to sample")
+        parser.add_argument('--format', choices=['JPEG', 'WEBP'])
+        parser.add_argument('--quality', type=int)
+        parser.add_argument('--max-side', type=int)
+        parser.add_argument('--max-dpi', type=int)
+        parser.add_argument('--keep-metadata', action='store_true')
+
+    def handle(self, *args, **options):
+        policy = upload_policy() or ImagePolicy()
+        overrides = {
+            'format': options['format'], 'quality': options['quality'],
+            'max_side': options['max_side'], 'max_dpi': options['max_dpi'],
+        }
+        policy = policy._replace(**{key: value for key, value in overrides.items() if value is not None})
+        if options['keep_metadata']:
+            policy = policy._replace(strip_metadata=False)
+
+        if options['paths']:
+            corpus = ((name, _read(path)) for name, path in _corpus_files(options['paths']))
+        else:
+            corpus = _stored_attachments(options['limit'])
+
+        files = 0
+        download_before = download_after = 0
+        stored_before, stored_after = {}, {}
+        cpu = 0.0
+        for name, data in corpus:
+            start = time.process_time()
+            normalized = normalize_image(data, name, policy)
+            cpu += time.process_time() - start
+            result = normalized.file.read() if normalized else data
+
+            files += 1
+            download_before += len(data)
+            download_after += len(result)
+            stored_before[hashlib.sha256(data).digest()] = len(data)
+            stored_after[hashlib.sha256(result).digest()] = len(result)
+            stages = ', '.join(normalized.stages) if normalized else 'unchanged'
+            self.stdout.write(f"{name}: {len(data) / 1024:9.1f} KB -> {len(result) / 1024:9.1f} KB ({stages})")
+
+        if not files:
+            raise CommandError("No JPEG or PNG image in the corpus")
+        storage_before, storage_after = sum(stored_before.values()), sum(stored_after.values())
+        self.stdout.write(f"Policy: {dict(policy._asdict())}")
+        self.stdout.write(f"{files} images, {cpu / files * 1000:.1f} ms CPU per image")
+        for label, before, after in (
+            ('storage', storage_before, storage_after),
+            ('downloads', download_before, download_after),
+        ):
+            saved = before - after
+            self.stdout.write(self.style.SUCCESS(
+                f"{label:>9}: {_megabytes(before)} -> {_megabytes(after)}, "
+                f"saved {_megabytes(saved).strip()} ({saved / before:.0%})"
+            ))
@@ -0,0 +1,86 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from dossier_medicale.models import AttachmentBlob, PieceJointe
+from dossier_medicale.storage import attachment_storage, is_content_addressed
+
+
+class Command(BaseCommand):
+    help = "Move attachments into content-addressed storage and recount blob references"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change")
+        parser.add_argument('--grace', type=int, default=3600,
+                            help="Seconds since a blob was last stored before it may be recounted")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        moved = missing = 0
+        legacy_names = set()
+
+        pieces = PieceJointe.objects.exclude(chemin_storage='').only('id', 'chemin_storage').order_by('id')
+        for piece in pieces.iterator():
+            name = piece.chemin_storage.name
+            if is_content_addressed(name):
+                continue
+            if not attachment_storage.exists(name):
+                missing += 1
+                self.stderr.write(f"Missing file for attachment {piece.pk}: {name}")
+                continue
+            moved += 1
+            if dry_run:
+                continue
+            with attachment_storage.open(name) as content:
+                new_name = attachment_storage.save(name, content)
+            PieceJointe.objects.filter(pk=piece.pk).update(chemin_storage=new_name)
+            legacy_names.add(name)
+
+        if dry_run:
+            self.stdout.write(f"{moved} attachments would move, {missing} missing")
+            return
+
+        # Legacy files are plain files: remove them directly once unused
+        still_used = set(PieceJointe.objects.filter(chemin_storage__in=legacy_names)
+                         .values_list('chemin_storage', flat=True))
+        for name in legacy_names - still_used:
+            FileSystemStorage.delete(attachment_storage, name)
+
+        fixed, removed = self._recount(timedelta(seconds=options['grace']))
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved} attachments ({missing} missing); "
+            f"fixed {fixed} reference counts, removed {removed} unused blobs"
+        ))
+
+    def _recount(self, grace):
+        """Make blob ref_counts match the attachments that point at them.
+
+        A blob acquired within ``grace`` may belong to an upload whose piece
+        row is not saved yet, so it is left alone.
+        """
+        counts = Counter()
+        for field in ('chemin_storage', 'chemin_original'):
+            counts.update(dict(
+                PieceJointe.objects.exclude(**{field: ''}).order_by().values_list(field).annotate(n=Count('id'))
+            ))
+        settled = AttachmentBlob.objects.filter(
+            Q(last_acquired_at__isnull=True) | Q(last_acquired_at__lt=timezone.now() - grace)
+        )
+        fixed = removed = 0
+        for blob in settled.iterator():
+            actual = counts.get(blob.name, 0)
+            if actual == blob.ref_count:
+                continue
+            if actual == 0:
+                # Leave exactly one reference so release() removes file and row under its lock
+                AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=1)
+                attachment_storage.release(blob.name)
+                removed += 1
+            else:
+                AttachmentBlob.objects.filter(pk=blob.pk).update(ref_count=actual)
+                fixed += 1
+        return fixed, removed
@@ -0,0 +1,41 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dossier_medicale.exports import export_queryset, export_workers, iter_export
+from dossier_medicale.models import DossierMedical
+
+
+class Command(BaseCommand):
+    help = "Export the PDF reports and attachments of matching dossiers into one ZIP archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path of the ZIP archive to write")
+        parser.add_argument('--department')
+        parser.add_argument('--status', choices=[value for value, _ in DossierMedical.STATUS_CHOICES])
+        parser.add_argument('--from', dest='date_from', type=date.fromisoformat, help="YYYY-MM-DD")
+        parser.add_argument('--to', dest='date_to', type=date.fromisoformat, help="YYYY-MM-DD")
+        parser.add_argument('--workers', type=int, help="Rendering processes (default: CPU count)")
+
+    def handle(self, *args, **options):
+        if options['date_from'] and options['date_to'] and options['date_to'] < options['date_from']:
+            raise CommandError("--to must not be earlier than --from")
+
+        dossiers = export_queryset(
+            DossierMedical.objects.all(),
+            department=options['department'],
+            status=options['status'],
+            date_from=options['date_from'],
+            date_to=options['date_to'],
+        )
+
+        def progress(done, total):
+            if done == total or done % 25 == 0:
+                self.stdout.write(f"{done}/{total} dossiers")
+
+        with open(options['output'], 'wb') as output:
+            chunks = iter_export(dossiers, workers=options['workers'] or export_workers(), progress=progress)
+            for chunk in chunks:
+                output.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
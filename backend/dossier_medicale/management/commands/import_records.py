@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dossier_medicale.imports import BATCH_SIZE, FORMATS, KINDS, detect_format, import_rows, read_rows
+from user.models import User
+
+
+class Command(BaseCommand):
+    help = "Bulk import dossiers or prises en charge from a CSV, JSON or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import")
+        parser.add_argument('--kind', choices=list(KINDS), default='dossier')
+        parser.add_argument('--format', choices=FORMATS, help="Default: from the file extension")
+        parser.add_argument('--user', required=True, help="E-mail of the user recorded as creator")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--attachments-dir', help="Directory the rows' attachment paths are relative to")
+        parser.add_argument('--dry-run', action='store_true', help="Validate only")
+
+    def handle(self, *args, **options):
+        format = options['format'] or detect_format(options['path'])
+        if format is None:
+            raise CommandError("Cannot tell the format from the extension; pass --format")
+        user = User.objects.filter(email__iexact=options['user']).first()
+        if user is None:
+            raise CommandError(f"No user with e-mail {options['user']}")
+
+        def progress(rows, created):
+            self.stdout.write(f"{rows} rows read, {created} {'valid' if options['dry_run'] else 'created'}")
+
+        try:
+            stream = open(options['path'], 'rb')
+        except OSError as exc:
+            raise CommandError(str(exc))
+        with stream:
+            result = import_rows(
+                options['kind'], read_rows(stream, format), user,
+                batch_size=options['batch_size'],
+                attachments_dir=options['attachments_dir'],
+                dry_run=options['dry_run'],
+                progress=progress,
+            )
+
+        for error in result.errors:
+            self.stderr.write(f"line {error.line}: {error.message}")
+        summary = (
+            f"{result.rows} rows, {result.created} {'valid' if options['dry_run'] else 'imported'}, "
+            f"{len(result.errors)} rejected"
+        )
+        self.stdout.write(self.style.SUCCESS(summary) if not result.errors else self.style.WARNING(summary))
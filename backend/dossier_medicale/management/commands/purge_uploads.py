@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from dossier_medicale.uploads import purge_uploads
+
+
+class Command(BaseCommand):
+    help = "Delete chunked upload sessions left idle, and their partial files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=getattr(settings, 'CHUNKED_UPLOAD_EXPIRY_HOURS', 24),
+                            help="Hours without a new chunk after which an upload is dropped")
+
+    def handle(self, *args, **options):
+        count = purge_uploads(timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(f"{count} upload sessions purged")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from dossier_medicale import assignment
+from user.models import User
+
+
+class Command(BaseCommand):
+    help = "Resynchronize controller workload rows and recount their open dossiers"
+
+    def handle(self, *args, **options):
+        for user in User.objects.select_related('role'):
+            assignment.sync_controller(user)
+        assignment.rebuild_workloads()
+        self.stdout.write(self.style.SUCCESS("Controller workloads rebuilt"))
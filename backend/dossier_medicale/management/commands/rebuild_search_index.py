@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from dossier_medicale import search
+from dossier_medicale.models import DossierMedical, PriseEnCharge
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index for dossiers and prises en charge"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        for model in (DossierMedical, PriseEnCharge):
+            count = search.rebuild_index(model, batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Indexed {count} {model._meta.verbose_name_plural}"
+            ))
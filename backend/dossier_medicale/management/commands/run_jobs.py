@@ -0,0 +1,74 @@
+import os
+import signal
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from dossier_medicale import jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help="Jobs run at the same time")
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help="Use processes for CPU-bound tasks such as report rendering")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds between queue polls")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is drained")
+
+    def handle(self, *args, **options):
+        jobs._load_tasks()
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        concurrency = options['concurrency']
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        if options['pool'] == 'process':
+            # Children open their own connections; never share the parent's
+            connections.close_all()
+            executor = ProcessPoolExecutor(concurrency, initializer=django.setup)
+        else:
+            executor = ThreadPoolExecutor(concurrency)
+
+        self.stdout.write(f"Worker {worker} running up to {concurrency} jobs ({options['pool']} pool)")
+        heartbeat_interval = getattr(settings, 'JOB_HEARTBEAT_INTERVAL', 60)
+        running = set()
+        last_stale_check = 0.0
+        last_heartbeat = time.monotonic()
+        with executor:
+            while not self.stopping:
+                if running and time.monotonic() - last_heartbeat > heartbeat_interval:
+                    jobs.heartbeat(worker)
+                    last_heartbeat = time.monotonic()
+                if time.monotonic() - last_stale_check > 60:
+                    jobs.requeue_stale()
+                    last_stale_check = time.monotonic()
+
+                claimed = jobs.claim(worker, concurrency - len(running)) if len(running) < concurrency else []
+                if options['pool'] == 'process' and claimed:
+                    connections.close_all()  # before the pool forks more children
+                for job_id in claimed:
+                    running.add(executor.submit(jobs.run_in_worker, job_id))
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                done, running = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception():
+                        self.stderr.write(f"Job bookkeeping failed: {future.exception()!r}")
+
+        self.stdout.write(self.style.SUCCESS(f"Worker {worker} stopped"))
+
+    def _stop(self, signum, frame):
+        # Finish the jobs in hand, claim no more
+        self.stopping = True
@@ -0,0 +1,72 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_fulltext_index(apps, schema_editor):
+    # InnoDB FULLTEXT backs search on MySQL; other backends use the token table.
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(
+            'CREATE FULLTEXT INDEX searchdocument_content_ft '
+            'ON dossier_medicale_searchdocument (content)'
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(
+            'DROP INDEX searchdocument_content_ft ON dossier_medicale_searchdocument'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0016_alter_priseencharge_care_type_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DM', 'Dossier Médical'), ('PEC', 'Prise en Charge')], max_length=3)),
+                ('object_id', models.BigIntegerField()),
+                ('content', models.TextField(blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Search Document',
+                'verbose_name_plural': 'Search Documents',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('DM', 'Dossier Médical'), ('PEC', 'Prise en Charge')], max_length=3)),
+                ('object_id', models.BigIntegerField()),
+                ('token', models.CharField(max_length=64)),
+                ('weight', models.PositiveSmallIntegerField(default=1)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='dossier_medicale.searchdocument')),
+            ],
+            options={
+                'verbose_name': 'Search Token',
+                'verbose_name_plural': 'Search Tokens',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchdocument',
+            constraint=models.UniqueConstraint(fields=('kind', 'object_id'), name='unique_search_document'),
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['kind', 'token'], name='searchtoken_kind_token_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['kind', 'object_id'], name='searchtoken_kind_object_idx'),
+        ),
+        migrations.RunPython(add_fulltext_index, drop_fulltext_index),
+    ]
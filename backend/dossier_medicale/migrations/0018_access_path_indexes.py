@@ -0,0 +1,53 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0017_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['-timestamp'], name='auditlog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['dossier', '-timestamp'], name='auditlog_dossier_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossiermedical',
+            index=models.Index(fields=['-priority', '-created_at', 'id'], name='dossier_list_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossiermedical',
+            index=models.Index(fields=['department', '-priority', '-created_at', 'id'], name='dossier_dept_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossiermedical',
+            index=models.Index(fields=['status', 'priority', 'department'], name='dossier_status_report_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossiermedical',
+            index=models.Index(fields=['-created_at', 'priority'], name='dossier_recent_priority_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priseencharge',
+            index=models.Index(fields=['-created_at', 'id'], name='pec_list_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priseencharge',
+            index=models.Index(fields=['patient', '-created_at'], name='pec_patient_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priseencharge',
+            index=models.Index(fields=['created_by', '-created_at'], name='pec_creator_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='priseencharge',
+            index=models.Index(fields=['status', 'care_type', 'estimated_cost'], name='pec_status_report_idx'),
+        ),
+    ]
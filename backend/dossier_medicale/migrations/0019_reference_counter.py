@@ -0,0 +1,30 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0018_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=10)),
+                ('day', models.DateField()),
+                ('last_value', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Reference Counter',
+                'verbose_name_plural': 'Reference Counters',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='referencecounter',
+            constraint=models.UniqueConstraint(fields=('prefix', 'day'), name='unique_reference_counter'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:33
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def create_workloads(apps, schema_editor):
+    User = apps.get_model('user', 'User')
+    DossierMedical = apps.get_model('dossier_medicale', 'DossierMedical')
+    ControllerWorkload = apps.get_model('dossier_medicale', 'ControllerWorkload')
+    open_counts = dict(
+        DossierMedical.objects.filter(status__in=['SUBMITTED', 'UNDER_REVIEW'], controller__isnull=False)
+        .order_by().values_list('controller').annotate(n=Count('id'))
+    )
+    ControllerWorkload.objects.bulk_create([
+        ControllerWorkload(
+            controller_id=user.pk,
+            department=user.department or '',
+            open_dossiers=open_counts.get(user.pk, 0),
+        )
+        for user in User.objects.filter(role__name='CONTROLLER', is_active=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dossier_medicale', '0019_reference_counter'),
+        ('user', '0006_user_department_alter_role_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ControllerWorkload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('department', models.CharField(blank=True, max_length=100)),
+                ('is_active', models.BooleanField(default=True)),
+                ('open_dossiers', models.PositiveIntegerField(default=0)),
+                ('last_assigned_at', models.DateTimeField(blank=True, null=True)),
+                ('controller', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='workload', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Controller Workload',
+                'verbose_name_plural': 'Controller Workloads',
+                'indexes': [models.Index(fields=['is_active', 'open_dossiers', 'last_assigned_at'], name='workload_pick_idx'), models.Index(fields=['department', 'is_active', 'open_dossiers', 'last_assigned_at'], name='workload_dept_pick_idx')],
+            },
+        ),
+        migrations.RunPython(create_workloads, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:49
+
+from django.db import migrations, models
+import dossier_medicale.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0021_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AttachmentBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.PositiveBigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_acquired_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Attachment Blob',
+                'verbose_name_plural': 'Attachment Blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='piecejointe',
+            name='chemin_storage',
+            field=models.FileField(storage=dossier_medicale.storage.get_attachment_storage, upload_to='pieces_jointes/'),
+        ),
+    ]
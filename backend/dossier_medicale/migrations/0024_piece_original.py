@@ -0,0 +1,19 @@
+# Generated by Django 4.2.27 on 2026-10-18 01:56
+
+from django.db import migrations, models
+import dossier_medicale.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0023_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='piecejointe',
+            name='chemin_original',
+            field=models.FileField(blank=True, storage=dossier_medicale.storage.get_attachment_storage, upload_to='pieces_jointes/originaux/'),
+        ),
+    ]
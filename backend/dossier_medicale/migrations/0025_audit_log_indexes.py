@@ -0,0 +1,67 @@
+# Generated by Django 4.2.27 on 2026-10-18 02:27
+
+from django.db import migrations, models
+
+
+# Virtual columns cost no storage; only their indexes are materialized.
+DETAIL_COLUMNS = [
+    ('detail_new_status', 20, 'new_status', 'auditlog_new_status_idx'),
+    ('detail_filename', 255, 'filename', 'auditlog_filename_idx'),
+]
+
+
+def add_detail_columns(apps, schema_editor):
+    # Indexed generated columns over ``details`` keys (see AuditLogQuerySet.filter_details)
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for column, length, key, index in DETAIL_COLUMNS:
+        schema_editor.execute(
+            f'ALTER TABLE dossier_medicale_dossierauditlog '
+            f'ADD COLUMN {column} VARCHAR({length}) '
+            f"AS (LEFT(JSON_UNQUOTE(JSON_EXTRACT(details, '$.{key}')), {length})) VIRTUAL, "
+            f'ADD INDEX {index} ({column}, timestamp DESC, id DESC)'
+        )
+
+
+def drop_detail_columns(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    for column, _, _, index in DETAIL_COLUMNS:
+        schema_editor.execute(
+            f'ALTER TABLE dossier_medicale_dossierauditlog DROP INDEX {index}, DROP COLUMN {column}'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0024_piece_original'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='dossierauditlog',
+            name='auditlog_timestamp_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='dossierauditlog',
+            name='auditlog_dossier_time_idx',
+        ),
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['-timestamp', '-id'], name='auditlog_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['dossier', '-timestamp', '-id'], name='auditlog_dossier_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['action', '-timestamp', '-id'], name='auditlog_action_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dossierauditlog',
+            index=models.Index(fields=['user', '-timestamp', '-id'], name='auditlog_user_time_idx'),
+        ),
+        migrations.RunPython(add_detail_columns, drop_detail_columns),
+    ]
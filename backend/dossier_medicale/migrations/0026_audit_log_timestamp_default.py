@@ -0,0 +1,19 @@
+# Generated by Django 4.2.27 on 2026-10-18 02:35
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0025_audit_log_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dossierauditlog',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
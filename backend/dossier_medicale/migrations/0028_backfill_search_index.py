@@ -0,0 +1,114 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+# The tokenizer of dossier_medicale.search as of this migration, frozen here
+# so later changes to the app code cannot change what it does
+MAX_TOKEN_LENGTH = 64
+
+FRENCH_STOPWORDS = frozenset("""
+    a au aux avec ce ces dans de des du elle en et eux il je la le les leur lui
+    ma mais me meme mes moi mon ne nos notre nous on ou par pas pour qu que qui
+    sa se ses son sur ta te tes toi ton tu un une vos votre vous c d j l m n s t y
+""".split())
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    folded = ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    return [word[:MAX_TOKEN_LENGTH] for word in _WORD_RE.findall(folded) if word not in FRENCH_STOPWORDS]
+
+
+def dossier_fields(dossier):
+    employer = dossier.employer
+    return [
+        (dossier.reference, 5),
+        (employer.full_name, 4),
+        (employer.first_name, 4),
+        (employer.last_name, 4),
+        (dossier.diagnosis, 3),
+        (dossier.doctor, 2),
+        (dossier.treatment_plan, 1),
+        (dossier.comments, 1),
+        (dossier.reason, 1),
+        (dossier.department, 1),
+    ]
+
+
+def pec_fields(pec):
+    return [
+        (pec.reference, 5),
+        (pec.patient.full_name, 4),
+        (pec.institution, 3),
+        (pec.diagnosis, 3),
+        (pec.physician, 2),
+        (pec.comments, 1),
+        (pec.department, 1),
+    ]
+
+
+def document_content(fields):
+    weights = defaultdict(int)
+    words = []
+    for text, weight in fields:
+        for token in tokenize(text):
+            weights[token] += weight
+            words.append(token)
+    return ' '.join(words), weights
+
+
+def backfill_search_index(apps, schema_editor):
+    # Search reads only the index, so rows saved before 0017 must be indexed
+    # before they can be found; objects indexed since are left alone
+    SearchDocument = apps.get_model('dossier_medicale', 'SearchDocument')
+    SearchToken = apps.get_model('dossier_medicale', 'SearchToken')
+    for model_name, kind, person, fields in (
+        ('DossierMedical', 'DM', 'employer', dossier_fields),
+        ('PriseEnCharge', 'PEC', 'patient', pec_fields),
+    ):
+        model = apps.get_model('dossier_medicale', model_name)
+        rows = model.objects.select_related(person).order_by('pk')
+        last = 0
+        while True:
+            batch = list(rows.filter(pk__gt=last)[:BATCH_SIZE])
+            if not batch:
+                break
+            last = batch[-1].pk
+            indexed = set(
+                SearchDocument.objects.filter(kind=kind, object_id__in=[row.pk for row in batch])
+                .values_list('object_id', flat=True)
+            )
+            documents = {row.pk: document_content(fields(row)) for row in batch if row.pk not in indexed}
+            if not documents:
+                continue
+            SearchDocument.objects.bulk_create([
+                SearchDocument(kind=kind, object_id=object_id, content=content)
+                for object_id, (content, _) in documents.items()
+            ])
+            document_ids = dict(
+                SearchDocument.objects.filter(kind=kind, object_id__in=list(documents))
+                .values_list('object_id', 'id')
+            )
+            SearchToken.objects.bulk_create([
+                SearchToken(document_id=document_ids[object_id], kind=kind, object_id=object_id,
+                            token=token, weight=weight)
+                for object_id, (_, weights) in documents.items()
+                for token, weight in weights.items()
+            ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0027_cache_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.27 on 2026-10-18 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dossier_medicale', '0028_backfill_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('ACTIVE', 'En cours'), ('COMPLETING', 'En finalisation'), ('COMPLETE', 'Terminé')], default='ACTIVE', max_length=20),
+        ),
+    ]
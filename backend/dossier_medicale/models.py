@@ -1,7 +1,101 @@
-from django.db import models
+import uuid
+
+from django.db import connections, models
+from django.db.models.expressions import RawSQL
 from user.models import User
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
+from .permissions import capabilities_for
+from .storage import get_attachment_storage
+
+class VisibilityQuerySet(models.QuerySet):
+    """Role rules of ``user_can_view``/``user_can_edit`` as SQL filters.
+
+    ``related_prefix`` points at the dossier-like object that carries the
+    ownership columns, and ``owner_fields`` lists the columns that make an
+    agent a party to it.
+    """
+    related_prefix = ''
+    owner_fields = ('created_by',)
+
+    def visible_to(self, user):
+        caps = capabilities_for(user)
+        if caps.can_view_all:
+            return self
+        if caps.role == 'AGENT':
+            condition = models.Q()
+            for field in self.owner_fields:
+                condition |= models.Q(**{f'{self.related_prefix}{field}_id': user.id})
+            return self.filter(condition)
+        return self.none()
+
+    def editable_by(self, user):
+        caps = capabilities_for(user)
+        if caps.can_edit_any:
+            return self
+        if caps.role == 'AGENT':
+            return self.filter(**{f'{self.related_prefix}created_by_id': user.id}).exclude(
+                **{f'{self.related_prefix}status': 'APPROVED'}
+            )
+        return self.none()
+
+
+class DossierQuerySet(VisibilityQuerySet):
+    owner_fields = ('created_by', 'employer')
+
+
+class PriseEnChargeQuerySet(VisibilityQuerySet):
+    owner_fields = ('created_by', 'patient')
+
+
+class PieceJointeQuerySet(DossierQuerySet):
+    related_prefix = 'dossier__'
+
+
+class AuditLogQuerySet(models.QuerySet):
+    # ``details`` keys backed by an indexed generated column on MySQL/MariaDB
+    # (migration 0025); elsewhere they are read from the JSON
+    DETAIL_COLUMNS = {
+        'new_status': 'detail_new_status',
+        'filename': 'detail_filename',
+    }
+
+    def filter_details(self, **conditions):
+        """``filter(details__<key>[__lookup]=value)``, through the key's indexed column when it has one.
+
+        MariaDB does not match a JSON expression to the generated column
+        computing it, so the column has to be named for its index to be used.
+        """
+        queryset = self
+        connection = connections[self.db]
+        for condition, value in conditions.items():
+            key, _, lookup = condition.partition('__')
+            column = self.DETAIL_COLUMNS.get(key)
+            if column is None or connection.vendor != 'mysql':
+                queryset = queryset.filter(**{f'details__{condition}': value})
+                continue
+            qualified = f'{connection.ops.quote_name(self.model._meta.db_table)}.{column}'
+            queryset = queryset.annotate(
+                **{column: RawSQL(qualified, [], output_field=models.CharField())}
+            ).filter(**{f'{column}__{lookup or "exact"}': value})
+        return queryset
+
+
+class ReferenceCounter(models.Model):
+    """Last reference number handed out per prefix and day (see references.py)."""
+    prefix = models.CharField(max_length=10)
+    day = models.DateField()
+    last_value = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Reference Counter"
+        verbose_name_plural = "Reference Counters"
+        constraints = [
+            models.UniqueConstraint(fields=['prefix', 'day'], name='unique_reference_counter'),
+        ]
+
+    def __str__(self):
+        return f"{self.prefix}-{self.day:%Y%m%d}: {self.last_value}"
 
 class MedicalDossierBase(models.Model):
     """Abstract base class for all medical dossier functionality"""
@@ -105,51 +199,83 @@ class DossierMedical(MedicalDossierBase):
         verbose_name='Assigned Employer',
        
     )
+
+    objects = DossierQuerySet.as_manager()
     
     class Meta:
         verbose_name = "Dossier Médical"
         verbose_name_plural = "Dossiers Médicaux"
         ordering = ['-priority', '-created_at']
+        indexes = [
+            # List pages: keyset order, optionally narrowed to one department
+            models.Index(fields=['-priority', '-created_at', 'id'], name='dossier_list_order_idx'),
+            models.Index(fields=['department', '-priority', '-created_at', 'id'], name='dossier_dept_order_idx'),
+            # Status stats and report GROUP BY, covered by the index
+            models.Index(fields=['status', 'priority', 'department'], name='dossier_status_report_idx'),
+            # Critical dossiers, newest first
+            models.Index(fields=['-created_at', 'priority'], name='dossier_recent_priority_idx'),
+        ]
         permissions = [
             ('can_review', "Can review medical dossiers"),
             ('can_approve', "Can approve medical dossiers"),
             ('view_confidential', "Can view confidential dossiers"),
         ]
+    # (controller_id, status) as last read from or written to the database,
+    # or None when the instance was loaded with either field deferred
+    _workload_state = (None, None)
+    WORKLOAD_FIELDS = ('controller', 'controller_id', 'status')
+
     def __str__(self):
         return f"{self.reference} - {self.employer} ({self.get_status_display()})"
     def save(self, *args, **kwargs):
         if not self.reference:
             # Generate reference: DM-YYYYMMDD-XXXX
-            date_part = timezone.now().strftime('%Y%m%d')
-            prefix = f'DM-{date_part}-'
-            # Get all references for today and find the max suffix
-            last_dossier = DossierMedical.objects.filter(
-                reference__startswith=prefix
-            ).only('reference').order_by('-reference').first()
-            
-            if last_dossier:
-                try:
-                    last_num = int(last_dossier.reference.split('-')[-1])
-                    new_num = last_num + 1
-                except (ValueError, IndexError):
-                    new_num = 1
-            else:
-                new_num = 1
-                
-            self.reference = f"{prefix}{new_num:04d}"
+            from .references import allocate_references
+            self.reference = allocate_references(DossierMedical, 'DM')[0]
         
         # Auto-fetch department from employer
         if self.employer and not self.department:
             self.department = self.employer.department or "Non spécifié"
 
         # Automatically set controller if submitted by agent
-        if self.status == 'SUBMITTED' and not self.controller:
-            if self.created_by.role.name == 'AGENT':
-                self.controller = User.objects.filter(
-                    role__name='CONTROLLER'
-                ).first()
-        
+        self.assign_due_controller()
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & set(self.WORKLOAD_FIELDS):
+            self.load_workload_state()
+
         super().save(*args, **kwargs)
+
+    def assign_due_controller(self):
+        """Give an agent's submission without a controller the least-loaded one.
+
+        Picking locks the workload rows, so views call this before opening
+        their transaction; ``save()`` does it for the other callers.
+        """
+        if self.status == 'SUBMITTED' and not self.controller_id:
+            if self.created_by.role.name == 'AGENT':
+                from .assignment import assign_controller
+                if self.employer_id and not self.department:
+                    self.department = self.employer.department or "Non spécifié"
+                self.controller_id = assign_controller(self.department)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the loaded assignment so workload counters can be adjusted on save
+        if {'controller_id', 'status'} & instance.get_deferred_fields():
+            instance._workload_state = None
+        else:
+            instance._workload_state = (instance.controller_id, instance.status)
+        return instance
+
+    def load_workload_state(self):
+        """Read the stored assignment of an instance loaded without it."""
+        if self._workload_state is None:
+            self._workload_state = (
+                type(self)._base_manager.filter(pk=self.pk)
+                .values_list('controller_id', 'status').first()
+            ) or (None, None)
     
     def get_absolute_url(self):
         from django.urls import reverse
@@ -158,19 +284,123 @@ class DossierMedical(MedicalDossierBase):
     #new
     def user_can_view(self, user):
         """Check if user can view this dossier"""
-        if user.role.name == 'AGENT':
-            return self.created_by == user or self.employer == user
+        if capabilities_for(user).role == 'AGENT':
+            return user.id in (self.created_by_id, self.employer_id)
         return True # Admin/controller can usually view
 
     def user_can_edit(self, user):
         """Check if user can edit this dossier"""
-        if user.role.name == 'ADMIN':
-            return True
-        if user.role.name == 'CONTROLLER':
+        caps = capabilities_for(user)
+        if caps.can_edit_any:
             return True
-        if user.role.name == 'AGENT':
-            return self.created_by == user and self.status != 'APPROVED'
+        if caps.role == 'AGENT':
+            return self.created_by_id == user.id and self.status != 'APPROVED'
         return False
+class ControllerWorkload(models.Model):
+    """Open dossier count per controller, maintained incrementally (see assignment.py)."""
+    controller = models.OneToOneField(User, on_delete=models.CASCADE, related_name='workload')
+    department = models.CharField(max_length=100, blank=True)
+    is_active = models.BooleanField(default=True)
+    open_dossiers = models.PositiveIntegerField(default=0)
+    last_assigned_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Controller Workload"
+        verbose_name_plural = "Controller Workloads"
+        indexes = [
+            models.Index(fields=['is_active', 'open_dossiers', 'last_assigned_at'], name='workload_pick_idx'),
+            models.Index(fields=['department', 'is_active', 'open_dossiers', 'last_assigned_at'], name='workload_dept_pick_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.controller} - {self.open_dossiers} open"
+
+class AttachmentBlob(models.Model):
+    """One stored attachment file, shared by every PieceJointe with the same content (see storage.py)."""
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_acquired_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Attachment Blob"
+        verbose_name_plural = "Attachment Blobs"
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+class Job(models.Model):
+    """Background job, claimed and run by ``manage.py run_jobs`` (see jobs.py)."""
+    STATUS_CHOICES = [
+        ('QUEUED', 'En attente'),
+        ('RUNNING', 'En cours'),
+        ('SUCCEEDED', 'Terminé'),
+        ('FAILED', 'Échoué'),
+    ]
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='QUEUED')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    progress = models.JSONField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Job"
+        verbose_name_plural = "Jobs"
+        indexes = [
+            # Claiming: due queued jobs in run_at order; stale running jobs
+            models.Index(fields=['status', 'run_at'], name='job_claim_idx'),
+            models.Index(fields=['status', 'locked_at'], name='job_stale_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.get_status_display()})"
+
+class UploadSession(models.Model):
+    """Resumable upload of one attachment, sent in chunks (see uploads.py)."""
+    STATUS_CHOICES = [
+        ('ACTIVE', 'En cours'),
+        ('COMPLETING', 'En finalisation'),
+        ('COMPLETE', 'Terminé'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    dossier = models.ForeignKey('DossierMedical', on_delete=models.CASCADE, related_name='upload_sessions')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    nom_fichier = models.CharField(max_length=255)
+    type = models.CharField(max_length=50)
+    description = models.TextField(blank=True)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    # Expected SHA-256 of the whole file, checked once the last chunk is in
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='ACTIVE')
+    piece = models.ForeignKey('PieceJointe', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Upload Session"
+        verbose_name_plural = "Upload Sessions"
+        indexes = [
+            models.Index(fields=['status', 'updated_at'], name='upload_stale_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size})"
+
 class MedicalAttachment(models.Model):
     TYPE_CHOICES = [
         ('PRESCRIPTION', 'Ordonnance'),
@@ -228,13 +458,25 @@ class DossierAuditLog(models.Model):
     )
     action = models.CharField(max_length=20, choices=ACTION_CHOICES)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the event is recorded, which may precede the write (see audit.py)
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     details = models.JSONField(default=dict)
+
+    objects = AuditLogQuerySet.as_manager()
     
     class Meta:
         verbose_name = "Dossier Audit Log"
         verbose_name_plural = "Dossier Audit Logs"
         ordering = ['-timestamp']
+        indexes = [
+            # Keyset pages of the audit log viewer, unfiltered or per filter.
+            # The id is spelled out so engines honouring DESC keys read the
+            # (timestamp, id) order straight off the index, without a sort.
+            models.Index(fields=['-timestamp', '-id'], name='auditlog_timestamp_idx'),
+            models.Index(fields=['dossier', '-timestamp', '-id'], name='auditlog_dossier_time_idx'),
+            models.Index(fields=['action', '-timestamp', '-id'], name='auditlog_action_time_idx'),
+            models.Index(fields=['user', '-timestamp', '-id'], name='auditlog_user_time_idx'),
+        ]
     
     def __str__(self):
         return f"{self.dossier.reference} - {self.get_action_display()} by {self.user}"
@@ -244,7 +486,9 @@ class DossierAuditLog(models.Model):
 class PieceJointe(models.Model):
    
     nom_fichier = models.CharField(max_length=255)
-    chemin_storage = models.FileField(upload_to='pieces_jointes/')
+    chemin_storage = models.FileField(upload_to='pieces_jointes/', storage=get_attachment_storage)
+    # Upload as received, when UPLOAD_IMAGE_POLICY normalized it and keeps originals
+    chemin_original = models.FileField(upload_to='pieces_jointes/originaux/', storage=get_attachment_storage, blank=True)
     type = models.CharField(max_length=50)
     taille_ko = models.IntegerField()
     date_upload = models.DateTimeField(auto_now_add=True)
@@ -258,6 +502,8 @@ class PieceJointe(models.Model):
         related_name='uploaded_pieces'
     )   
     description = models.TextField(blank=True)
+
+    objects = PieceJointeQuerySet.as_manager()
     
     def __str__(self):
         return self.nom_fichier 
@@ -289,31 +535,27 @@ class PriseEnCharge(MedicalDossierBase):
     department = models.CharField(max_length=100, blank=True, verbose_name="Département")
     comments = models.TextField(blank=True, verbose_name="Commentaires")
 
+    objects = PriseEnChargeQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Prise en Charge"
         verbose_name_plural = "Prises en Charge"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', 'id'], name='pec_list_order_idx'),
+            models.Index(fields=['patient', '-created_at'], name='pec_patient_created_idx'),
+            models.Index(fields=['created_by', '-created_at'], name='pec_creator_created_idx'),
+            models.Index(fields=['status', 'care_type', 'estimated_cost'], name='pec_status_report_idx'),
+        ]
 
     def __str__(self):
         return f"{self.reference} - {self.patient.full_name} ({self.institution})"
 
     def save(self, *args, **kwargs):
         if not self.reference:
-            date_part = timezone.now().strftime('%Y%m%d')
-            prefix = f'PEC-{date_part}-'
-            last_pec = PriseEnCharge.objects.filter(
-                reference__startswith=prefix
-            ).only('reference').order_by('-reference').first()
-            
-            if last_pec:
-                try:
-                    last_num = int(last_pec.reference.split('-')[-1])
-                    new_num = last_num + 1
-                except (ValueError, IndexError):
-                    new_num = 1
-            else:
-                new_num = 1
-            self.reference = f"{prefix}{new_num:04d}"
+            # Generate reference: PEC-YYYYMMDD-XXXX
+            from .references import allocate_references
+            self.reference = allocate_references(PriseEnCharge, 'PEC')[0]
             
         # Auto-fetch department from patient
         if self.patient and not self.department:
@@ -322,13 +564,56 @@ class PriseEnCharge(MedicalDossierBase):
         super().save(*args, **kwargs)
 
     def user_can_view(self, user):
-        if user.role.name == 'AGENT':
-            return self.created_by == user or self.patient == user
+        if capabilities_for(user).role == 'AGENT':
+            return user.id in (self.created_by_id, self.patient_id)
         return True
 
     def user_can_edit(self, user):
-        if user.role.name in ['ADMIN', 'CONTROLLER']:
+        caps = capabilities_for(user)
+        if caps.can_edit_any:
             return True
-        if user.role.name == 'AGENT':
-            return self.created_by == user and self.status != 'APPROVED'
-        return False
\ No newline at end of file
+        if caps.role == 'AGENT':
+            return self.created_by_id == user.id and self.status != 'APPROVED'
+        return False
+
+class SearchDocument(models.Model):
+    """Normalized, searchable text of one dossier or prise en charge."""
+    KIND_CHOICES = [
+        ('DM', 'Dossier Médical'),
+        ('PEC', 'Prise en Charge'),
+    ]
+
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    content = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Search Document"
+        verbose_name_plural = "Search Documents"
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='unique_search_document'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.object_id}"
+
+
+class SearchToken(models.Model):
+    """One weighted token of a SearchDocument, the inverted index used for lookups."""
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='tokens')
+    kind = models.CharField(max_length=3, choices=SearchDocument.KIND_CHOICES)
+    object_id = models.BigIntegerField()
+    token = models.CharField(max_length=64)
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        verbose_name = "Search Token"
+        verbose_name_plural = "Search Tokens"
+        indexes = [
+            models.Index(fields=['kind', 'token'], name='searchtoken_kind_token_idx'),
+            models.Index(fields=['kind', 'object_id'], name='searchtoken_kind_object_idx'),
+        ]
+
+    def __str__(self):
+        return self.token
@@ -0,0 +1,145 @@
+import base64
+import json
+from datetime import datetime
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+
+class KeysetPage:
+    """A page of results addressed by cursors instead of page numbers.
+
+    Exposes the same ``has_previous``/``has_next`` interface as Django's
+    ``Page`` so the list templates can keep their pagination block.
+    """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """Seek pagination over a fixed ordering.
+
+    ``keys`` is a list of ``(field_name, descending)`` pairs and must end with
+    a unique column so that every row has a distinct position. Each page is a
+    single indexed range query of ``per_page + 1`` rows, so page 5000 costs
+    the same as page 1.
+    """
+
+    def __init__(self, queryset, keys, per_page=25):
+        self.queryset = queryset
+        self.keys = keys
+        self.per_page = per_page
+
+    def _ordering(self, reverse=False):
+        return [
+            f"-{field}" if descending != reverse else field
+            for field, descending in self.keys
+        ]
+
+    def _seek(self, values, reverse=False):
+        """Build the row-value comparison ``(k1, k2, ...) > (v1, v2, ...)``."""
+        condition = Q()
+        equal = {}
+        for (field, descending), value in zip(self.keys, values):
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= Q(**equal, **{f"{field}__{lookup}": value})
+            equal[field] = value
+        return condition
+
+    def encode_cursor(self, obj):
+        # DjangoJSONEncoder cuts datetimes to milliseconds, which would skip
+        # the rows sharing the cursor row's millisecond; keep microseconds
+        values = [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in (getattr(obj, field) for field, _ in self.keys)
+        ]
+        raw = json.dumps(values, cls=DjangoJSONEncoder).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def _to_python(self, field, value):
+        try:
+            return self.queryset.model._meta.get_field(field).to_python(value)
+        except FieldDoesNotExist:
+            # Annotations such as a search rank are stored as plain JSON values
+            return value
+
+    def decode_cursor(self, cursor):
+        """Return the key values stored in ``cursor``, or None if it is invalid."""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                return None
+            return [self._to_python(field, value) for (field, _), value in zip(self.keys, values)]
+        except (ValueError, TypeError, ValidationError):
+            return None
+
+    def iter_values(self, fields, chunk_size=2000):
+        """Yield ``values_list(*fields)`` tuples of every row, in key order.
+
+        Rows are read one range query of ``chunk_size`` at a time, seeking
+        past the last key like ``get_page``. Unlike ``.iterator()``, which
+        the MySQL drivers answer by buffering the whole result, memory stays
+        bounded on every backend however many rows there are.
+        """
+        keys = [field for field, _ in self.keys]
+        ordered = self.queryset.order_by(*self._ordering())
+        last = None
+        while True:
+            queryset = ordered if last is None else ordered.filter(self._seek(last))
+            rows = list(queryset.values_list(*fields, *keys)[:chunk_size])
+            for row in rows:
+                yield row[:len(fields)]
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1][len(fields):]
+
+    def get_page(self, after=None, before=None):
+        """Return the page following ``after`` or preceding ``before``.
+
+        Invalid or missing cursors fall back to the first page.
+        """
+        size = self.per_page
+        before_values = self.decode_cursor(before) if before else None
+        if before_values is not None:
+            rows = list(
+                self.queryset.filter(self._seek(before_values, reverse=True))
+                .order_by(*self._ordering(reverse=True))[:size + 1]
+            )
+            has_previous = len(rows) > size
+            rows = rows[:size][::-1]
+            has_next = True
+        else:
+            after_values = self.decode_cursor(after) if after else None
+            queryset = self.queryset
+            if after_values is not None:
+                queryset = queryset.filter(self._seek(after_values))
+            rows = list(queryset.order_by(*self._ordering())[:size + 1])
+            has_next = len(rows) > size
+            rows = rows[:size]
+            has_previous = after_values is not None
+
+        return KeysetPage(
+            rows,
+            next_cursor=self.encode_cursor(rows[-1]) if rows and has_next else None,
+            previous_cursor=self.encode_cursor(rows[0]) if rows and has_previous else None,
+        )
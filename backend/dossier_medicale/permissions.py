@@ -0,0 +1,115 @@
+"""Role capability matrix shared by views, models and templates.
+
+The matrix is plain immutable data built once per process; a user's row is
+looked up from the role name already joined onto ``request.user`` (see
+``user.backends.RoleModelBackend``), so permission checks never query.
+"""
+from functools import lru_cache
+from types import MappingProxyType
+from typing import NamedTuple
+
+from django.urls import reverse
+
+
+class RoleCapabilities(NamedTuple):
+    role: str
+    can_view_all: bool = False      # sees every dossier/PEC, admin templates
+    can_create: bool = False
+    can_edit_any: bool = False      # otherwise only own, non-approved dossiers
+    can_upload: bool = False
+    can_scan: bool = False
+    can_approve: bool = False
+    can_report_any: bool = False    # otherwise only own dossiers
+    can_download_all: bool = False  # otherwise only own dossiers
+    can_view_audit: bool = False
+    can_delete_any_pec: bool = False
+    actions: tuple = ('view',)
+
+
+ROLE_CAPABILITIES = MappingProxyType({
+    'AGENT': RoleCapabilities(
+        role='AGENT',
+        can_create=True,
+        can_upload=True,
+        can_scan=True,
+        can_download_all=True,
+        actions=('view', 'upload', 'update', 'scan'),
+    ),
+    'CONTROLLER': RoleCapabilities(
+        role='CONTROLLER',
+        can_view_all=True,
+        can_create=True,
+        can_edit_any=True,
+        can_upload=True,
+        can_scan=True,
+        can_approve=True,
+        can_report_any=True,
+        can_download_all=True,
+        can_view_audit=True,
+        actions=('view', 'upload', 'approve', 'reject', 'generate_report', 'edit'),
+    ),
+    'ADMIN': RoleCapabilities(
+        role='ADMIN',
+        can_view_all=True,
+        can_create=True,
+        can_edit_any=True,
+        can_upload=True,
+        can_approve=True,
+        can_report_any=True,
+        can_view_audit=True,
+        can_delete_any_pec=True,
+        actions=('view', 'upload', 'approve', 'reject', 'generate_report', 'edit'),
+    ),
+})
+
+NO_CAPABILITIES = RoleCapabilities(role='')
+
+# name -> (label, URL name taking the dossier id, or None for an in-page anchor)
+ACTION_DEFINITIONS = MappingProxyType({
+    'view': ('View Details', None),
+    'upload': ('Upload Document', 'upload_document'),
+    'update': ('Update Information', 'edit_dossier'),
+    'scan': ('Scan Document', 'scan_document'),
+    'approve': ('Approve Dossier', 'approve_dossier'),
+    'reject': ('Reject Dossier', 'reject_dossier'),
+    'generate_report': ('Generate Report', 'generate_report'),
+    'edit': ('Edit Dossier', 'edit_dossier'),
+})
+
+_ID_PLACEHOLDER = 2147483647
+
+
+def capabilities_for(user):
+    """Return the RoleCapabilities of ``user``, memoized on the user object."""
+    caps = getattr(user, '_capabilities', None)
+    if caps is None:
+        role = getattr(user, 'role', None) if user.is_authenticated else None
+        caps = ROLE_CAPABILITIES.get(role.name, NO_CAPABILITIES) if role else NO_CAPABILITIES
+        user._capabilities = caps
+    return caps
+
+
+@lru_cache(maxsize=None)
+def _action_url_templates():
+    """Reverse every action URL once, leaving a ``{id}`` slot for the dossier."""
+    templates = {}
+    for name, (_, url_name) in ACTION_DEFINITIONS.items():
+        if url_name is None:
+            templates[name] = '#details'
+        else:
+            url = reverse(url_name, args=[_ID_PLACEHOLDER])
+            templates[name] = url.replace(str(_ID_PLACEHOLDER), '{id}')
+    return MappingProxyType(templates)
+
+
+def role_actions(user, dossier):
+    """Actions offered to ``user`` on ``dossier``, as name/label/url dicts."""
+    templates = _action_url_templates()
+    return [
+        {
+            'name': name,
+            'label': ACTION_DEFINITIONS[name][0],
+            'url': templates[name].format(id=dossier.id),
+        }
+        for name in capabilities_for(user).actions
+    ]
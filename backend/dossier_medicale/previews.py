@@ -0,0 +1,147 @@
+"""Thumbnails and low-resolution previews of attachments.
+
+Images are downscaled with Pillow (JPEGs are decoded directly at a reduced
+scale, so a 40-megapixel scan never has to be expanded in memory) and PDFs
+are previewed by their first page, rasterized with ``pdftoppm`` when
+poppler is installed. Every variant is a JPEG kept in ``preview_cache``
+under the hash of the stored file name; attachment names are derived from
+the content (see storage.py), so an entry never goes stale and can be
+served with a long ``max-age``.
+
+Previews are queued as a background job when an attachment is uploaded,
+and rendered on demand by the preview view if no worker got to it first.
+"""
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.urls import reverse
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .filecache import FileCache
+from .jobs import enqueue, task
+from .models import PieceJointe
+
+# Bump when the rendering changes so stale cache entries stop matching
+PREVIEW_FORMAT = 1
+
+# Longest side, in pixels, of each variant
+VARIANTS = {
+    'thumb': 128,
+    'preview': 1280,
+}
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'}
+
+preview_cache = FileCache('previews', default_max_bytes=512 * 1024 ** 2, evict_interval=60)
+
+
+def _pdftoppm():
+    return shutil.which(getattr(settings, 'PREVIEW_PDFTOPPM', 'pdftoppm'))
+
+
+def preview_kind(name):
+    """'image', 'pdf' or None for the stored file ``name``."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if extension == '.pdf' and _pdftoppm():
+        return 'pdf'
+    return None
+
+
+def preview_key(name):
+    return hashlib.sha256(b'preview-v%d:%s' % (PREVIEW_FORMAT, name.encode())).hexdigest()
+
+
+def preview_name(name, variant):
+    return f'{preview_key(name)}-{variant}.jpg'
+
+
+def preview_url(piece, variant):
+    """URL of a variant of ``piece``, or None when it cannot be previewed.
+
+    The URL carries the preview key, so it changes with the file and the
+    response can be cached for good.
+    """
+    name = piece.chemin_storage.name
+    if not name or not preview_kind(name):
+        return None
+    url = reverse('attachment_preview', args=[piece.pk, variant])
+    return f'{url}?v={preview_key(name)[:16]}'
+
+
+def _open_image(field_file, size):
+    with field_file.open('rb') as source:
+        image = Image.open(source)
+        # JPEG only: let the decoder skip straight to a scale >= ``size``
+        image.draft('RGB', (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        return image
+
+
+def _open_pdf_page(field_file, size):
+    # pdftoppm wants a file; PDF scans are rasterized straight at the
+    # target size rather than at full resolution
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = os.path.join(directory, 'source.pdf')
+        with field_file.open('rb') as source, open(source_path, 'wb') as copy:
+            shutil.copyfileobj(source, copy)
+        subprocess.run(
+            [_pdftoppm(), '-f', '1', '-l', '1', '-singlefile', '-scale-to', str(size), '-jpeg',
+             source_path, os.path.join(directory, 'page')],
+            check=True, capture_output=True, timeout=getattr(settings, 'PREVIEW_TIMEOUT', 30),
+        )
+        with Image.open(os.path.join(directory, 'page.jpg')) as page:
+            page.load()
+            return page.copy()
+
+
+def render_preview(field_file, variant):
+    """JPEG bytes of ``variant`` of the stored file, or None if it cannot be read."""
+    size = VARIANTS[variant]
+    try:
+        if preview_kind(field_file.name) == 'pdf':
+            image = _open_pdf_page(field_file, size)
+        else:
+            image = _open_image(field_file, size)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError,
+            subprocess.SubprocessError):
+        return None
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def attachment_preview(piece, variant):
+    """Path of a cached variant of ``piece``, rendering it on a miss; None if unavailable."""
+    name = preview_name(piece.chemin_storage.name, variant)
+    path = preview_cache.get(name)
+    if path is None:
+        data = render_preview(piece.chemin_storage, variant)
+        if data is None:
+            return None
+        path = preview_cache.store(name, data)
+    return path
+
+
+@task('render_previews')
+def render_previews_job(job, piece_id):
+    piece = PieceJointe.objects.filter(pk=piece_id).first()
+    if piece is None or not piece.chemin_storage.name:
+        return None
+    rendered = [variant for variant in VARIANTS if attachment_preview(piece, variant)]
+    return {'piece': piece_id, 'variants': rendered}
+
+
+def queue_previews(piece):
+    """Queue the previews of a new attachment if ``PREVIEW_ON_UPLOAD`` is set and it has any."""
+    if getattr(settings, 'PREVIEW_ON_UPLOAD', True) and preview_kind(piece.chemin_storage.name or ''):
+        enqueue('render_previews', piece_id=piece.pk)
@@ -0,0 +1,292 @@
+"""PDF reports of dossiers and prises en charge, cached on disk.
+
+Reports are described declaratively by a ReportLayout (summary table rows,
+text sections, an optional item list) and rendered by ``render_report``
+with paragraph and table styles compiled once per process, so the only
+per-report work is laying out the record's own data.
+
+A rendered report only depends on its record, the person it concerns and,
+for dossiers, the attachment list, so it is stored in ``report_cache``
+under a hash of those and served as a file until one of them changes.
+Superseded entries are never looked up again and age out of the LRU.
+"""
+import hashlib
+import io
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, NamedTuple, Optional
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.utils import timezone
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import inch
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from .archives import piece_identity
+from .filecache import FileCache
+from .jobs import enqueue, task
+from .models import DossierMedical, PieceJointe
+
+# Bump when the report layout changes so stale cache entries stop matching
+REPORT_FORMAT = 3
+
+report_cache = FileCache('reports', default_max_bytes=256 * 1024 ** 2, evict_interval=60)
+
+# Page streams are already zlib-compressed; without the C accelerator the
+# extra ASCII85 text encoding costs ~10% of a render and inflates the file.
+# ReportLab only has a process-wide switch for it, so it is set around each
+# build and restored for the library's other users
+STREAM_A85 = False
+
+PAGE_OPTIONS = {'pagesize': A4, 'rightMargin': 50, 'leftMargin': 50, 'topMargin': 50, 'bottomMargin': 50}
+SUMMARY_COLUMNS = [1.5 * inch, 4 * inch]
+# Reports are cached, so the footer dates the data rather than the render
+FOOTER = "Données à jour au {:%d/%m/%Y à %H:%M} - Système de Gestion Dossiers Médicaux"
+
+
+class Field(NamedTuple):
+    label: str
+    value: Callable          # record -> str
+    optional: bool = False   # omitted when the value is empty
+
+
+class Section(NamedTuple):
+    title: str
+    fields: tuple
+
+
+class ItemList(NamedTuple):
+    title: str
+    item: Callable           # item -> str
+
+
+class ReportLayout(NamedTuple):
+    title: str
+    summary_title: str
+    summary: tuple           # of Field, rendered as a two-column table
+    sections: tuple = ()
+    items: Optional[ItemList] = None
+
+
+def _display(field):
+    return lambda record: getattr(record, f'get_{field}_display')()
+
+
+def _date(field):
+    return lambda record: f'{getattr(record, field):%d/%m/%Y}' if getattr(record, field) else ''
+
+
+DOSSIER_LAYOUT = ReportLayout(
+    title="RAPPORT MÉDICAL",
+    summary_title="INFORMATION GÉNÉRALE",
+    summary=(
+        Field("Employé", attrgetter('employer.full_name')),
+        Field("Département", attrgetter('department')),
+        Field("Médecin", attrgetter('doctor')),
+        Field("Date de début", _date('start_date')),
+        Field("Statut", _display('status')),
+        Field("Priorité", _display('priority')),
+    ),
+    sections=(
+        Section("DÉTAILS MÉDICAUX", (
+            Field("Diagnostic", attrgetter('diagnosis')),
+            Field("Plan de Traitement", attrgetter('treatment_plan')),
+            Field("Raison", attrgetter('reason'), optional=True),
+            Field("Commentaires additionnels", attrgetter('comments'), optional=True),
+        )),
+    ),
+    items=ItemList("PIÈCES JOINTES", lambda piece: f"• {piece.nom_fichier} ({piece.type})"),
+)
+
+PEC_LAYOUT = ReportLayout(
+    title="PRISE EN CHARGE",
+    summary_title="INFORMATION GÉNÉRALE",
+    summary=(
+        Field("Patient", attrgetter('patient.full_name')),
+        Field("Département", attrgetter('department')),
+        Field("Établissement", attrgetter('institution')),
+        Field("Type de soin", _display('care_type')),
+        Field("Médecin", attrgetter('physician')),
+        Field("Date de début", _date('start_date')),
+        Field("Date de fin", _date('end_date')),
+        Field("Coût estimé", lambda pec: f"{pec.estimated_cost:.2f} €"),
+        Field("Couverture", lambda pec: f"{pec.coverage_percentage} %"),
+        Field("Statut", _display('status')),
+    ),
+    sections=(
+        Section("DÉTAILS MÉDICAUX", (
+            Field("Diagnostic", attrgetter('diagnosis')),
+            Field("Commentaires", attrgetter('comments'), optional=True),
+        )),
+    ),
+)
+
+
+class _Styles(NamedTuple):
+    normal: ParagraphStyle
+    italic: ParagraphStyle
+    title: ParagraphStyle
+    section: ParagraphStyle
+    summary: TableStyle
+
+
+@lru_cache(maxsize=None)
+def _styles():
+    sheet = getSampleStyleSheet()
+    return _Styles(
+        normal=sheet['Normal'],
+        italic=sheet['Italic'],
+        title=ParagraphStyle(
+            'TitleStyle',
+            parent=sheet['Heading1'],
+            fontSize=20,
+            textColor=colors.HexColor("#0ea5e9"),
+            alignment=1,
+            spaceAfter=30,
+        ),
+        section=ParagraphStyle(
+            'SectionStyle',
+            parent=sheet['Heading2'],
+            fontSize=14,
+            textColor=colors.HexColor("#1e293b"),
+            spaceBefore=20,
+            spaceAfter=10,
+            borderPadding=5,
+            backgroundColor=colors.HexColor("#f1f5f9"),
+        ),
+        summary=TableStyle([
+            ('SPAN', (0, 0), (1, 0)),
+            ('BACKGROUND', (0, 0), (1, 0), colors.HexColor("#0ea5e9")),
+            ('TEXTCOLOR', (0, 0), (1, 0), colors.whitesmoke),
+            ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
+            ('BOTTOMPADDING', (0, 0), (1, 0), 12),
+            ('BACKGROUND', (0, 1), (0, -1), colors.HexColor("#f8fafc")),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('FONTSIZE', (0, 0), (-1, -1), 10),
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('TOPPADDING', (0, 1), (-1, -1), 8),
+            ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
+            ('LEFTPADDING', (0, 0), (-1, -1), 12),
+        ]),
+    )
+
+
+def render_report(layout, record, items=()):
+    """Render ``record`` (and ``items``) following ``layout``; returns PDF bytes."""
+    styles = _styles()
+    content = [
+        Paragraph(layout.title, styles.title),
+        Paragraph(f"Référence: {escape(record.reference)}", styles.normal),
+        Spacer(1, 0.2 * inch),
+    ]
+
+    rows = [[layout.summary_title, ""]]
+    rows.extend([f"{field.label}:", field.value(record)] for field in layout.summary)
+    table = Table(rows, colWidths=SUMMARY_COLUMNS)
+    table.setStyle(styles.summary)
+    content.append(table)
+
+    for section in layout.sections:
+        content.append(Paragraph(section.title, styles.section))
+        first = True
+        for field in section.fields:
+            value = field.value(record)
+            if field.optional and not value:
+                continue
+            if not first:
+                content.append(Spacer(1, 0.1 * inch))
+            first = False
+            content.append(Paragraph(f"<b>{field.label}:</b>", styles.normal))
+            content.append(Paragraph(escape(str(value)), styles.normal))
+
+    if layout.items and items:
+        content.append(Paragraph(layout.items.title, styles.section))
+        content.extend(Paragraph(escape(layout.items.item(item)), styles.normal) for item in items)
+
+    content.append(Spacer(1, 0.5 * inch))
+    content.append(Paragraph(report_footer(record, items), styles.italic))
+
+    buffer = io.BytesIO()
+    with stream_encoding(STREAM_A85):
+        SimpleDocTemplate(buffer, **PAGE_OPTIONS).build(content)
+    return buffer.getvalue()
+
+
+@contextmanager
+def stream_encoding(a85):
+    """Run the block with ReportLab's ASCII85 stream encoding on or off."""
+    previous = rl_config.useA85
+    rl_config.useA85 = int(a85)
+    try:
+        yield
+    finally:
+        rl_config.useA85 = previous
+
+
+def report_footer(record, items=()):
+    """Footer dated by the last change to ``record`` or its attachments."""
+    changes = [record.updated_at, *(getattr(item, 'date_upload', None) for item in items)]
+    changes = [changed for changed in changes if changed]
+    return FOOTER.format(timezone.localtime(max(changes)) if changes else timezone.localtime())
+
+
+def render_dossier_report(dossier, pieces):
+    return render_report(DOSSIER_LAYOUT, dossier, pieces)
+
+
+def render_pec_report(pec):
+    return render_report(PEC_LAYOUT, pec)
+
+
+def _report_key(record, person, pieces=()):
+    digest = hashlib.sha256(b'report-v%d' % REPORT_FORMAT)
+    digest.update(repr((
+        record._meta.label, record.pk, record.updated_at.isoformat() if record.updated_at else '',
+        person.full_name,
+    )).encode())
+    for piece in sorted(pieces, key=lambda piece: piece.pk):
+        digest.update(repr(piece_identity(piece)).encode())
+    return digest.hexdigest()
+
+
+def report_name(dossier, pieces):
+    return f'{dossier.pk}-{_report_key(dossier, dossier.employer, pieces)}.pdf'
+
+
+def _cached(name, render):
+    path = report_cache.get(name)
+    if path is None:
+        path = report_cache.store(name, render())
+    return path
+
+
+def dossier_report(dossier, pieces):
+    """Path of the cached report of ``dossier``, rendering it on a miss."""
+    pieces = list(pieces)
+    return _cached(report_name(dossier, pieces), lambda: render_dossier_report(dossier, pieces))
+
+
+def pec_report(pec):
+    """Path of the cached report of ``pec``, rendering it on a miss."""
+    name = f'pec-{pec.pk}-{_report_key(pec, pec.patient)}.pdf'
+    return _cached(name, lambda: render_pec_report(pec))
+
+
+@task('render_dossier_report')
+def render_report_job(job, dossier_id):
+    dossier = DossierMedical.objects.select_related('employer').filter(pk=dossier_id).first()
+    if dossier is None:
+        return None
+    dossier_report(dossier, PieceJointe.objects.filter(dossier=dossier))
+    return {'dossier': dossier_id}
+
+
+def prerender_report(dossier):
+    """Queue a cache warm-up for ``dossier`` if ``REPORT_PRERENDER_ON_APPROVE`` is set."""
+    if getattr(settings, 'REPORT_PRERENDER_ON_APPROVE', False):
+        enqueue('render_dossier_report', dossier_id=dossier.pk)
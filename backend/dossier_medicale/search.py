@@ -0,0 +1,251 @@
+"""Indexed full-text search over dossiers and prises en charge.
+
+Every saved DossierMedical/PriseEnCharge gets a SearchDocument holding its
+normalized text and a set of weighted SearchToken rows. Lookups are prefix
+range scans on the ``(kind, token)`` index; on MySQL the InnoDB FULLTEXT
+index on ``SearchDocument.content`` is used instead, unless a term is too
+short for InnoDB to have indexed it (``DM``, a two-letter name).
+"""
+import re
+import unicodedata
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Case, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import DossierMedical, PriseEnCharge, SearchDocument, SearchToken
+
+MAX_TOKEN_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+# User fields copied into the documents of their dossiers and PECs
+INDEXED_USER_FIELDS = ('full_name', 'first_name', 'last_name')
+
+FRENCH_STOPWORDS = frozenset("""
+    a au aux avec ce ces dans de des du elle en et eux il je la le les leur lui
+    ma mais me meme mes moi mon ne nos notre nous on ou par pas pour qu que qui
+    sa se ses son sur ta te tes toi ton tu un une vos votre vous c d j l m n s t y
+""".split())
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def normalize(text):
+    """Lowercase ``text`` and strip accents (``Hôpital`` -> ``hopital``)."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def tokenize(text):
+    """Split ``text`` into accent-insensitive search tokens, dropping stopwords."""
+    return [
+        word[:MAX_TOKEN_LENGTH]
+        for word in _WORD_RE.findall(normalize(text))
+        if word not in FRENCH_STOPWORDS
+    ]
+
+
+def dossier_fields(dossier):
+    employer = dossier.employer
+    return [
+        (dossier.reference, 5),
+        (employer.full_name, 4),
+        (employer.first_name, 4),
+        (employer.last_name, 4),
+        (dossier.diagnosis, 3),
+        (dossier.doctor, 2),
+        (dossier.treatment_plan, 1),
+        (dossier.comments, 1),
+        (dossier.reason, 1),
+        (dossier.department, 1),
+    ]
+
+
+def pec_fields(pec):
+    return [
+        (pec.reference, 5),
+        (pec.patient.full_name, 4),
+        (pec.institution, 3),
+        (pec.diagnosis, 3),
+        (pec.physician, 2),
+        (pec.comments, 1),
+        (pec.department, 1),
+    ]
+
+
+INDEXED_MODELS = {
+    DossierMedical: ('DM', dossier_fields),
+    PriseEnCharge: ('PEC', pec_fields),
+}
+
+
+def document_content(fields):
+    """(content, {token: weight}) of the weighted ``(text, weight)`` fields."""
+    weights = defaultdict(int)
+    words = []
+    for text, weight in fields:
+        for token in tokenize(text):
+            weights[token] += weight
+            words.append(token)
+    return ' '.join(words), weights
+
+
+def _document(instance):
+    """(kind, content, {token: weight}) of the search entries of ``instance``."""
+    kind, fields = INDEXED_MODELS[type(instance)]
+    return (kind, *document_content(fields(instance)))
+
+
+def index_instance(instance):
+    """(Re)build the search entries of a dossier or prise en charge."""
+    kind, content, weights = _document(instance)
+
+    # Write before reading so concurrent writers queue on the row (or, on
+    # SQLite, the database) lock instead of failing a read-to-write upgrade.
+    documents = SearchDocument.objects.filter(kind=kind, object_id=instance.pk)
+    with transaction.atomic():
+        if documents.update(content=content, updated_at=timezone.now()):
+            document = documents.get()
+            SearchToken.objects.filter(document=document).delete()
+        else:
+            document = SearchDocument.objects.create(
+                kind=kind, object_id=instance.pk, content=content
+            )
+        SearchToken.objects.bulk_create([
+            SearchToken(document=document, kind=kind, object_id=instance.pk, token=token, weight=weight)
+            for token, weight in weights.items()
+        ])
+
+
+def index_new_instances(instances):
+    """Index freshly created objects of one model in bulk (they have no entries yet)."""
+    if not instances:
+        return
+    documents = {instance.pk: _document(instance) for instance in instances}
+    kind = next(iter(documents.values()))[0]
+    SearchDocument.objects.bulk_create([
+        SearchDocument(kind=kind, object_id=object_id, content=content)
+        for object_id, (_, content, _) in documents.items()
+    ])
+    # Ids are not returned by every backend's bulk insert; read them back
+    document_ids = dict(
+        SearchDocument.objects.filter(kind=kind, object_id__in=list(documents))
+        .values_list('object_id', 'id')
+    )
+    # A dozen tokens per object: a plain executemany skips building a model
+    # instance per token, which dominates the cost of a bulk import
+    table = SearchToken._meta.db_table
+    connection = connections[SearchToken.objects.db]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {connection.ops.quote_name(table)} '
+            '(document_id, kind, object_id, token, weight) VALUES (%s, %s, %s, %s, %s)',
+            [
+                (document_ids[object_id], kind, object_id, token, weight)
+                for object_id, (_, _, weights) in documents.items()
+                for token, weight in weights.items()
+            ],
+        )
+
+
+def reindex_person(user):
+    """Rebuild the entries of the dossiers and PECs about ``user``, whose name they index."""
+    for model, field in ((DossierMedical, 'employer'), (PriseEnCharge, 'patient')):
+        kind, _ = INDEXED_MODELS[model]
+        instances = list(model.objects.filter(**{field: user}).select_related(field))
+        if not instances:
+            continue
+        with transaction.atomic():
+            SearchDocument.objects.filter(kind=kind, object_id__in=[instance.pk for instance in instances]).delete()
+            index_new_instances(instances)
+
+
+def remove_instance(instance):
+    kind, _ = INDEXED_MODELS[type(instance)]
+    SearchDocument.objects.filter(kind=kind, object_id=instance.pk).delete()
+
+
+def query_terms(query):
+    """Distinct tokens of a user query, capped to keep the lookup bounded.
+
+    Empty when the query holds only stopwords: callers then list everything,
+    as for an empty query.
+    """
+    return list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+
+
+def _use_fulltext(queryset, terms):
+    # InnoDB leaves words shorter than innodb_ft_min_token_size out of the
+    # FULLTEXT index; the token table has every word
+    min_size = getattr(settings, 'SEARCH_FULLTEXT_MIN_TOKEN_SIZE', 3)
+    return connections[queryset.db].vendor == 'mysql' and all(len(term) >= min_size for term in terms)
+
+
+def _boolean_query(terms):
+    return ' '.join(f'+{term}*' for term in terms)
+
+
+def _match_sql(terms):
+    return RawSQL('MATCH(content) AGAINST (%s IN BOOLEAN MODE)', [_boolean_query(terms)])
+
+
+def filter_matching(queryset, terms):
+    """Restrict ``queryset`` to objects whose document contains every term as a prefix."""
+    if not terms:
+        return queryset.none()
+    kind, _ = INDEXED_MODELS[queryset.model]
+
+    if _use_fulltext(queryset, terms):
+        matches = (
+            SearchDocument.objects.filter(kind=kind)
+            .annotate(score=_match_sql(terms)).filter(score__gt=0)
+            .values('object_id')
+        )
+    else:
+        term_q = reduce(or_, (Q(token__startswith=term) for term in terms))
+        hits = {
+            f'hit_{i}': Max(Case(When(token__startswith=term, then=1), default=0, output_field=IntegerField()))
+            for i, term in enumerate(terms)
+        }
+        matches = (
+            SearchToken.objects.filter(term_q, kind=kind)
+            .values('object_id').annotate(**hits)
+            .filter(**{name: 1 for name in hits})
+            .values('object_id')
+        )
+    return queryset.filter(pk__in=matches)
+
+
+def annotate_rank(queryset, terms):
+    """Annotate ``queryset`` with a ``search_rank`` relevance score for ``terms``."""
+    if not terms:
+        return queryset.annotate(search_rank=Value(0, output_field=IntegerField()))
+    kind, _ = INDEXED_MODELS[queryset.model]
+
+    if _use_fulltext(queryset, terms):
+        rank = (
+            SearchDocument.objects.filter(kind=kind, object_id=OuterRef('pk'))
+            .annotate(score=_match_sql(terms)).values('score')[:1]
+        )
+    else:
+        term_q = reduce(or_, (Q(token__startswith=term) for term in terms))
+        rank = (
+            SearchToken.objects.filter(term_q, kind=kind, object_id=OuterRef('pk'))
+            .order_by().values('object_id').annotate(score=Sum('weight')).values('score')
+        )
+    return queryset.annotate(search_rank=Subquery(rank))
+
+
+def rebuild_index(model, batch_size=500):
+    """Reindex every row of ``model``; returns the number of indexed objects."""
+    related = 'employer' if model is DossierMedical else 'patient'
+    count = 0
+    for instance in model.objects.select_related(related).order_by('pk').iterator(chunk_size=batch_size):
+        index_instance(instance)
+        count += 1
+    return count
@@ -0,0 +1,98 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from user.models import User
+
+from . import assignment, previews, search
+from .archives import invalidate_dossier_archives
+from .models import DossierMedical, PieceJointe, PriseEnCharge
+from .stats import invalidate_dossier_stats, invalidate_report_snapshot
+
+
+@receiver([post_save, post_delete], sender=DossierMedical)
+def dossier_changed(sender, **kwargs):
+    # Once committed: before, a reader would recompute the old counts
+    transaction.on_commit(invalidate_dossier_stats)
+    transaction.on_commit(invalidate_report_snapshot)
+
+
+@receiver([post_save, post_delete], sender=PriseEnCharge)
+def pec_changed(sender, **kwargs):
+    transaction.on_commit(invalidate_report_snapshot)
+
+
+@receiver([post_save, post_delete], sender=PieceJointe)
+def piece_changed(sender, instance, **kwargs):
+    invalidate_dossier_archives(instance.dossier_id)
+
+
+@receiver(post_save, sender=PieceJointe)
+def queue_attachment_previews(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        previews.queue_previews(instance)
+
+
+@receiver(post_delete, sender=PieceJointe)
+def release_attachment_blob(sender, instance, **kwargs):
+    for field_file in (instance.chemin_storage, instance.chemin_original):
+        if field_file.name:
+            name, storage = field_file.name, field_file.storage
+            transaction.on_commit(lambda name=name, storage=storage: storage.release(name))
+
+
+@receiver(post_save, sender=DossierMedical)
+@receiver(post_save, sender=PriseEnCharge)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_instance(instance)
+
+
+@receiver(post_save, sender=User)
+def reindex_user_records(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Dossiers and PECs are indexed under their employer's/patient's name;
+    # saves that cannot have renamed the user (e.g. last_login) are skipped
+    if raw or created:
+        return
+    if update_fields is not None and not set(update_fields) & set(search.INDEXED_USER_FIELDS):
+        return
+    search.reindex_person(instance)
+
+
+@receiver(post_delete, sender=DossierMedical)
+@receiver(post_delete, sender=PriseEnCharge)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.remove_instance(instance)
+
+
+@receiver(post_save, sender=DossierMedical)
+def update_controller_workload(sender, instance, raw=False, update_fields=None, **kwargs):
+    # A save that wrote neither field leaves the assignment as it was; reading
+    # them here would load them if they were deferred
+    if update_fields is not None and not set(update_fields) & set(DossierMedical.WORKLOAD_FIELDS):
+        return
+    new_state = (instance.controller_id, instance.status)
+    if not raw:
+        assignment.track_transition(instance._workload_state, new_state)
+    instance._workload_state = new_state
+
+
+@receiver(pre_delete, sender=DossierMedical)
+def load_controller_workload(sender, instance, **kwargs):
+    # Read while the row still exists, for release_controller_workload
+    instance.load_workload_state()
+
+
+@receiver(post_delete, sender=DossierMedical)
+def release_controller_workload(sender, instance, **kwargs):
+    assignment.track_transition(instance._workload_state, (None, None))
+
+
+@receiver(post_save, sender=User)
+def sync_controller_workload(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Saves that cannot change the workload row (e.g. last_login) are skipped
+    if raw:
+        return
+    if update_fields is not None and not set(update_fields) & set(assignment.CONTROLLER_USER_FIELDS):
+        return
+    assignment.sync_controller(instance)
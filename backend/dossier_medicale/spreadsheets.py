@@ -0,0 +1,279 @@
+"""Streaming CSV and XLSX writers for the dossier and PEC list exports.
+
+Both writers yield the file chunk by chunk while rows are still being read,
+so the response starts at once and memory does not grow with the export.
+
+XLSX is written by hand as SpreadsheetML into a streamed ZIP (the drain
+buffer of archives.py): strings are stored inline in the cells, so there is
+no shared-string table to accumulate until the end, as a spreadsheet library
+would. Rows past Excel's sheet limit continue on a new worksheet; the
+workbook part listing the sheets is written last.
+
+CSV text that a spreadsheet program could read as a formula is prefixed
+with an apostrophe. XLSX text needs no such prefix: an inline string cell is
+never evaluated, and the apostrophe would show as part of the value.
+"""
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.utils import timezone
+
+from .archives import _drained, _DrainBuffer
+from .pagination import KeysetPaginator
+
+# Bytes of output gathered before a chunk is yielded
+FLUSH_SIZE = 64 * 1024
+
+# Rows per worksheet, header included (Excel's limit)
+XLSX_MAX_ROWS = 1048576
+
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+# Control characters XML 1.0 cannot carry
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Leading characters that make a spreadsheet program read a cell as a formula
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# Style indexes of styles.xml's cellXfs
+_DATE_STYLE, _DATETIME_STYLE, _HEADER_STYLE = 1, 2, 3
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}</Types>'
+)
+_SHEET_CONTENT_TYPE = (
+    '<Override PartName="/xl/worksheets/sheet{n}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/></Relationships>'
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets></workbook>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{sheets}<Relationship Id="rIdStyles" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/></Relationships>'
+)
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm"/></numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+_SHEET_START = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<sheetData>'
+)
+_SHEET_END = '</sheetData></worksheet>'
+
+
+def iter_csv(header, rows):
+    """Yield a UTF-8 CSV (with a BOM, for Excel) of ``header`` and ``rows``."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(['' if value is None else _csv_value(value) for value in row])
+        if buffer.tell() >= FLUSH_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.localtime(value)
+        return value.strftime('%Y-%m-%d %H:%M')
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        # Keep spreadsheet programs from evaluating user-entered text as a formula
+        return "'" + value
+    return value
+
+
+def _excel_serial(value):
+    if isinstance(value, datetime):
+        if timezone.is_aware(value):
+            value = timezone.make_naive(value)
+        delta = value - EXCEL_EPOCH
+        return delta.days + delta.seconds / 86400
+    return (value - EXCEL_EPOCH.date()).days
+
+
+def _cell(value, style=0):
+    if value is None or value == '':
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, datetime):
+        return f'<c s="{_DATETIME_STYLE}"><v>{_excel_serial(value)}</v></c>'
+    if isinstance(value, date):
+        return f'<c s="{_DATE_STYLE}"><v>{_excel_serial(value)}</v></c>'
+    # A raw carriage return would be read back as a line feed
+    text = escape(_XML_ILLEGAL.sub('', str(value)), {'\r': '&#13;'})
+    style = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _row(values, style=0):
+    return '<row>' + ''.join(_cell(value, style) for value in values) + '</row>'
+
+
+def iter_xlsx(header, rows, sheet_name='Export', max_rows=XLSX_MAX_ROWS):
+    """Yield an XLSX workbook of ``header`` and ``rows``, chunk by chunk."""
+    buffer = _DrainBuffer()
+    header_row = _row(header, _HEADER_STYLE)
+    sheets = 0
+    rows = iter(rows)
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        more = True
+        while more:
+            sheets += 1
+            with archive.open(f'xl/worksheets/sheet{sheets}.xml', 'w', force_zip64=True) as sheet:
+                pending = [_SHEET_START, header_row]
+                size = 0
+                written = 1
+                more = False
+                for row in rows:
+                    xml = _row(row)
+                    pending.append(xml)
+                    size += len(xml)
+                    written += 1
+                    if size >= FLUSH_SIZE:
+                        sheet.write(''.join(pending).encode())
+                        pending.clear()
+                        size = 0
+                        yield from _drained(buffer)
+                    if written == max_rows:
+                        more = True
+                        break
+                pending.append(_SHEET_END)
+                sheet.write(''.join(pending).encode())
+            yield from _drained(buffer)
+            if more:
+                # Only start another sheet if any row is left for it
+                try:
+                    first = next(rows)
+                except StopIteration:
+                    break
+                rows = _prepend(first, rows)
+
+        names = [sheet_name if n == 1 else f'{sheet_name} ({n})' for n in range(1, sheets + 1)]
+        archive.writestr('[Content_Types].xml', _CONTENT_TYPES.format(sheets=''.join(
+            _SHEET_CONTENT_TYPE.format(n=n) for n in range(1, sheets + 1)
+        )))
+        archive.writestr('_rels/.rels', _ROOT_RELS)
+        archive.writestr('xl/workbook.xml', _WORKBOOK.format(sheets=''.join(
+            f'<sheet name="{escape(name[:31])}" sheetId="{n}" r:id="rId{n}"/>'
+            for n, name in enumerate(names, 1)
+        )))
+        archive.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS.format(sheets=''.join(
+            f'<Relationship Id="rId{n}" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            f'Target="worksheets/sheet{n}.xml"/>'
+            for n in range(1, sheets + 1)
+        )))
+        archive.writestr('xl/styles.xml', _STYLES)
+    yield from _drained(buffer)
+
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
+
+
+# (header, values_list field) of each list export
+DOSSIER_COLUMNS = [
+    ('Référence', 'reference'),
+    ('Statut', 'status'),
+    ('Employé', 'employer__full_name'),
+    ('E-mail', 'employer__email'),
+    ('Département', 'department'),
+    ('Catégorie', 'category'),
+    ('Priorité', 'priority'),
+    ('Médecin', 'doctor'),
+    ('Diagnostic', 'diagnosis'),
+    ('Date de début', 'start_date'),
+    ('Date de fin', 'end_date'),
+    ('Contrôleur', 'controller__full_name'),
+    ('Créé par', 'created_by__full_name'),
+    ('Créé le', 'created_at'),
+]
+
+PEC_COLUMNS = [
+    ('Référence', 'reference'),
+    ('Statut', 'status'),
+    ('Patient', 'patient__full_name'),
+    ('E-mail', 'patient__email'),
+    ('Département', 'department'),
+    ('Établissement', 'institution'),
+    ('Type de soin', 'care_type'),
+    ('Coût estimé', 'estimated_cost'),
+    ('Taux de couverture', 'coverage_percentage'),
+    ('Médecin traitant', 'physician'),
+    ('Diagnostic', 'diagnosis'),
+    ('Date de début', 'start_date'),
+    ('Date de fin', 'end_date'),
+    ('Créé par', 'created_by__full_name'),
+    ('Créé le', 'created_at'),
+]
+
+
+def list_rows(queryset, keys, columns, chunk_size=2000):
+    """Rows of ``columns`` for every object of ``queryset``, in ``keys`` order.
+
+    Read in keyset chunks; choice fields are given their display labels.
+    """
+    fields = [field for _, field in columns]
+    labels = {}
+    for index, name in enumerate(fields):
+        if '__' not in name:
+            field = queryset.model._meta.get_field(name)
+            if field.choices:
+                labels[index] = dict(field.flatchoices)
+    for row in KeysetPaginator(queryset, keys).iter_values(fields, chunk_size):
+        if labels:
+            row = list(row)
+            for index, choices in labels.items():
+                row[index] = choices.get(row[index], row[index])
+        yield row
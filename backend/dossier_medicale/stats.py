@@ -0,0 +1,178 @@
+import hashlib
+import json
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+
+from .models import DossierMedical, PriseEnCharge
+
+PENDING_STATUSES = ['SUBMITTED', 'UNDER_REVIEW']
+
+STATS_GENERATION_KEY = 'dossier_stats:generation'
+REPORT_SNAPSHOT_KEY = 'global_report:snapshot'
+
+
+def status_aggregates():
+    """Aggregate expressions computing the status summary in one query."""
+    return {
+        'total': Count('id'),
+        'approved': Count('id', filter=Q(status='APPROVED')),
+        'pending': Count('id', filter=Q(status__in=PENDING_STATUSES)),
+        'rejected': Count('id', filter=Q(status='REJECTED')),
+    }
+
+
+def invalidate_dossier_stats():
+    """Make every cached stats block stale by moving to a new generation.
+
+    A generation is a random token rather than a counter: two writers never
+    end up on the same value, whichever cache backend (``incr`` is not
+    atomic on DatabaseCache). Call it once the change has committed, or a
+    reader could cache the old counts under the new generation.
+    """
+    cache.set(STATS_GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def dossier_status_stats(queryset, scope, query=''):
+    """Return the list header stats for ``queryset``, cached per scope and search.
+
+    ``scope`` identifies the role-dependent base queryset (e.g. ``'all'``) so
+    users who see different rows never share an entry. Each entry holds the
+    generation it was computed in, so a hit is a single ``get_many`` of the
+    entry and the current generation.
+    """
+    digest = hashlib.md5(query.encode()).hexdigest()
+    key = f'dossier_stats:{scope}:{digest}'
+    found = cache.get_many([STATS_GENERATION_KEY, key])
+    generation = found.get(STATS_GENERATION_KEY)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        cache.add(STATS_GENERATION_KEY, generation, timeout=None)
+    elif found.get(key, (None,))[0] == generation:
+        return found[key][1]
+    stats = queryset.aggregate(**status_aggregates())
+    cache.set(key, (generation, stats), getattr(settings, 'DOSSIER_STATS_CACHE_TIMEOUT', 60))
+    return stats
+
+
+def invalidate_report_snapshot():
+    """Drop the global report; call it once the change has committed."""
+    cache.delete(REPORT_SNAPSHOT_KEY)
+
+
+def _summary(counts):
+    return {
+        'total': sum(counts.values()),
+        'approved': counts['APPROVED'],
+        'pending': sum(counts[s] for s in PENDING_STATUSES),
+        'rejected': counts['REJECTED'],
+    }
+
+
+def build_global_report():
+    """Compute the global report context from two GROUP BY queries."""
+    status_labels = dict(DossierMedical.STATUS_CHOICES)
+    priority_labels = dict(DossierMedical.PRIORITY_LEVELS)
+    care_type_labels = dict(PriseEnCharge.CARE_TYPES)
+
+    # --- Dossier Stats ---
+    status_counts, priority_counts, dept_counts = Counter(), Counter(), Counter()
+    dossier_rows = (
+        DossierMedical.objects.order_by()
+        .values('status', 'priority', 'department')
+        .annotate(count=Count('id'))
+    )
+    for row in dossier_rows:
+        status_counts[row['status']] += row['count']
+        priority_counts[row['priority']] += row['count']
+        dept_counts[row['department']] += row['count']
+
+    statuses = [code for code, _ in DossierMedical.STATUS_CHOICES if status_counts[code]]
+    priorities = [level for level, _ in DossierMedical.PRIORITY_LEVELS if priority_counts[level]]
+    departments = sorted(dept_counts)
+
+    chart_dossier_status = {
+        'labels': [status_labels[s] for s in statuses],
+        'data': [status_counts[s] for s in statuses],
+        'colors': [DossierMedical.get_status_hex_by_status(s) for s in statuses],
+    }
+    chart_dossier_priority = {
+        'labels': [priority_labels[p] for p in priorities],
+        'data': [priority_counts[p] for p in priorities],
+    }
+    chart_dossier_dept = {
+        'labels': departments,
+        'data': [dept_counts[d] for d in departments],
+    }
+
+    # --- Prise en Charge Stats ---
+    pec_status_counts, type_counts, type_costs = Counter(), Counter(), Counter()
+    pec_rows = (
+        PriseEnCharge.objects.order_by()
+        .values('status', 'care_type')
+        .annotate(count=Count('id'), cost=Sum('estimated_cost'))
+    )
+    for row in pec_rows:
+        pec_status_counts[row['status']] += row['count']
+        type_counts[row['care_type']] += row['count']
+        type_costs[row['care_type']] += row['cost'] or Decimal('0')
+
+    pec_stats = _summary(pec_status_counts)
+    pec_stats['total_cost'] = sum(type_costs.values()) or 0
+
+    pec_statuses = [code for code, _ in PriseEnCharge.STATUS_CHOICES if pec_status_counts[code]]
+    care_types = [code for code, _ in PriseEnCharge.CARE_TYPES if type_counts[code]]
+    chart_pec_status = {
+        'labels': [status_labels[s] for s in pec_statuses],
+        'data': [pec_status_counts[s] for s in pec_statuses],
+        'colors': [PriseEnCharge.get_status_hex_by_status(s) for s in pec_statuses],
+    }
+    chart_pec_type = {
+        'labels': [care_type_labels[t] for t in care_types],
+        'data': [type_counts[t] for t in care_types],
+    }
+
+    # Data for Tables
+    dossier_table = [
+        {'label': label, 'count': status_counts[code]}
+        for code, label in DossierMedical.STATUS_CHOICES
+    ]
+    pec_table = [
+        {'label': label, 'count': type_counts[code], 'cost': type_costs[code] or 0}
+        for code, label in PriseEnCharge.CARE_TYPES
+    ]
+
+    # Recent & Critical lists
+    critical_dossiers = list(
+        DossierMedical.objects.filter(priority__gte=3)
+        .select_related('employer').order_by('-created_at')[:5]
+    )
+    recent_pecs = list(PriseEnCharge.objects.select_related('patient').order_by('-created_at')[:5])
+
+    return {
+        'dossier_stats': _summary(status_counts),
+        'pec_stats': pec_stats,
+        'dossier_table': dossier_table,
+        'pec_table': pec_table,
+        'critical_dossiers': critical_dossiers,
+        'recent_pecs': recent_pecs,
+        'chart_dossier_status': json.dumps(chart_dossier_status),
+        'chart_dossier_priority': json.dumps(chart_dossier_priority),
+        'chart_dossier_dept': json.dumps(chart_dossier_dept),
+        'chart_pec_status': json.dumps(chart_pec_status),
+        'chart_pec_type': json.dumps(chart_pec_type),
+    }
+
+
+def global_report_snapshot():
+    """Return the cached global report, rebuilding it when missing or expired.
+
+    Dossier and PEC writes drop the snapshot; ``GLOBAL_REPORT_CACHE_TIMEOUT``
+    bounds its age for changes made outside the ORM.
+    """
+    timeout = getattr(settings, 'GLOBAL_REPORT_CACHE_TIMEOUT', 300)
+    return cache.get_or_set(REPORT_SNAPSHOT_KEY, build_global_report, timeout)
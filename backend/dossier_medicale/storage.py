@@ -0,0 +1,159 @@
+"""Content-addressed, deduplicated storage for attachments.
+
+Uploads are stored once per SHA-256 under two fan-out levels,
+``<upload_to>/ab/cd/abcd...<ext>``, so identical files share one blob and
+no directory grows past a few hundred entries. Each blob has an
+AttachmentBlob row counting the PieceJointe rows that use it.
+
+The row is locked while a blob is acquired (``_save``) or released, and the
+file itself is always checked for and, if needed, rewritten under that lock.
+A HashedFile (an assembled chunked upload) skips the hashing and is renamed
+into place rather than copied.
+Acquiring happens before the piece row is inserted and releasing only once
+its deletion has committed, so a failed transaction can at worst leave a
+blob counted too high; ``manage.py dedupe_attachments`` recounts blobs that
+have not been acquired recently.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.apps import apps
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Now
+
+CONTENT_ADDRESSED_NAME = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}(\.\w+)?$')
+
+
+def content_name(directory, digest, extension):
+    return '/'.join(filter(None, [directory, digest[:2], digest[2:4], digest + extension.lower()]))
+
+
+def is_content_addressed(name):
+    return bool(CONTENT_ADDRESSED_NAME.search(name))
+
+
+def _blobs():
+    return apps.get_model('dossier_medicale', 'AttachmentBlob').objects
+
+
+class HashedFile(File):
+    """A local file whose SHA-256 is already known, stored by moving it.
+
+    Saving it skips hashing the content again and renames the file into
+    place instead of copying it; the file is gone afterwards unless its
+    blob already existed.
+    """
+
+    def __init__(self, path, sha256):
+        super().__init__(open(path, 'rb'), name=path)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save
+        return name
+
+    def _save(self, name, content):
+        if isinstance(content, HashedFile):
+            digest, size = content.sha256, content.size
+        else:
+            digest = hashlib.sha256()
+            size = 0
+            for chunk in content.chunks():
+                digest.update(chunk)
+                size += len(chunk)
+            digest = digest.hexdigest()
+        name = content_name(os.path.dirname(name), digest, os.path.splitext(name)[1])
+
+        with transaction.atomic():
+            blob, _ = _blobs().select_for_update().get_or_create(
+                name=name, defaults={'sha256': digest, 'size': size},
+            )
+            _blobs().filter(pk=blob.pk).update(ref_count=F('ref_count') + 1, last_acquired_at=Now())
+            if not self.exists(name):
+                self._write(name, content)
+        return name
+
+    def _write(self, name, content):
+        """Write ``content`` to ``name`` atomically (temp file + rename)."""
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(directory, self.directory_permissions_mode)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            if isinstance(content, HashedFile):
+                os.close(fd)
+                content.close()
+                file_move_safe(content.temporary_file_path(), tmp, allow_overwrite=True)
+            else:
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in content.chunks():
+                        out.write(chunk)
+            os.chmod(tmp, self.file_permissions_mode or 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def release(self, name):
+        """Drop one reference to ``name``, deleting the blob with the last one.
+
+        Files without a blob row (stored before deduplication) are left alone.
+        """
+        with transaction.atomic():
+            blob = _blobs().select_for_update().filter(name=name).first()
+            if blob is None:
+                return
+            if blob.ref_count > 1:
+                _blobs().filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                return
+            super().delete(name)
+            blob.delete()
+
+
+def store_files(instances):
+    """Write the new files of the unsaved ``instances`` to storage now.
+
+    Lets a caller store attachments before opening its transaction, which
+    then only inserts rows; the stored files are returned so that
+    ``release_files`` can give them back if the transaction fails.
+    """
+    stored = []
+    try:
+        for instance in instances:
+            for field in instance._meta.concrete_fields:
+                if isinstance(field, models.FileField):
+                    file = getattr(instance, field.attname)
+                    if file and not file._committed:
+                        file.save(file.name, file.file, save=False)
+                        stored.append(file)
+    except BaseException:
+        release_files(stored)
+        raise
+    return stored
+
+
+def release_files(files):
+    for file in files:
+        file.storage.release(file.name)
+
+
+attachment_storage = ContentAddressedStorage()
+
+
+def get_attachment_storage():
+    return attachment_storage
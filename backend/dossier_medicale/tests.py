@@ -1,3 +1,2116 @@
-from django.test import TestCase
+import csv
+import hashlib
+import importlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import AnonymousUser
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Count, Q, Sum
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.http import FileResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from reportlab import rl_config
+
+from user.models import Role, User
+
+from . import assignment, audit, audit_archive, imaging, imports, jobs, previews, search, uploads
+from .models import (
+    AttachmentBlob, ControllerWorkload, DossierAuditLog, DossierMedical, Job, PieceJointe, PriseEnCharge,
+    SearchDocument, SearchToken, UploadSession,
+)
+from .archives import MISSING_FILES_NAME, iter_zip
+from .exports import export_queryset, iter_export
+from .filecache import FileCache
+from .imports import import_rows
+from .pagination import KeysetPaginator
+from .permissions import NO_CAPABILITIES, capabilities_for, role_actions
+from .references import allocate_references
+from .reports import FOOTER, render_dossier_report, report_footer
+from .spreadsheets import iter_csv, iter_xlsx
+from .stats import build_global_report, dossier_status_stats, global_report_snapshot
+from .storage import is_content_addressed
+from .views import AUDIT_PAGE_SIZE, DOSSIER_PAGE_KEYS, LIST_PAGE_SIZE, PEC_PAGE_KEYS, listed_dossiers
+
+
+def _mysql_plan_problems(node, problems):
+    if isinstance(node, dict):
+        if node.get('access_type') == 'ALL':
+            problems.append(f"full scan of {node.get('table_name')}")
+        if node.get('using_filesort'):
+            problems.append('filesort')
+        if node.get('using_temporary_table'):
+            problems.append('temporary table')
+        for value in node.values():
+            _mysql_plan_problems(value, problems)
+    elif isinstance(node, list):
+        for value in node:
+            _mysql_plan_problems(value, problems)
+    return problems
+
+
+def explain(query):
+    """Query plan of a queryset or of the SQL of a captured query."""
+    if not isinstance(query, str):
+        return query.explain(format='json') if connection.vendor == 'mysql' else query.explain()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('EXPLAIN FORMAT=JSON ' + query)
+            return cursor.fetchone()[0]
+        cursor.execute('EXPLAIN QUERY PLAN ' + query)
+        return '\n'.join(' '.join(map(str, row)) for row in cursor.fetchall())
+
+
+def plan_problems(query):
+    """Return the full scans and sorts found in the query plan of ``query``."""
+    if connection.vendor == 'mysql':
+        return _mysql_plan_problems(json.loads(explain(query)), [])
+    problems = []
+    for line in explain(query).splitlines():
+        # Django prefixes each step with SQLite's "id parent notused" columns
+        step = re.sub(r'^\d+ \d+ \d+ ', '', line.strip())
+        if re.match(r'SCAN \S+$', step):
+            problems.append(f'full scan: {step}')
+        elif step.startswith('USE TEMP B-TREE'):
+            problems.append(f'sort: {step}')
+    return problems
+
+
+class QueryPlanTests(TestCase):
+    """The main list/report querysets must be served from indexes.
+
+    A failure here means a query started scanning a whole table or sorting
+    its result set; add or adjust an index in the model's ``Meta.indexes``.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        agent_role = Role.objects.create(name='AGENT')
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=agent_role, department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def assertIndexed(self, queryset, allow_sort=False):
+        problems = plan_problems(queryset)
+        if allow_sort:
+            problems = [p for p in problems if not p.startswith(('sort', 'filesort', 'temporary'))]
+        self.assertEqual(problems, [], f"{queryset if isinstance(queryset, str) else queryset.query}\n"
+                                       f"{explain(queryset)}")
+
+    def page_query(self, queryset, keys):
+        ordering = KeysetPaginator(queryset, keys)._ordering()
+        return queryset.order_by(*ordering)[:LIST_PAGE_SIZE + 1]
+
+    def test_dossier_admin_list(self):
+        self.assertIndexed(self.page_query(DossierMedical.objects.all(), DOSSIER_PAGE_KEYS))
+
+    def test_dossier_admin_list_next_page(self):
+        paginator = KeysetPaginator(DossierMedical.objects.all(), DOSSIER_PAGE_KEYS)
+        values = paginator.decode_cursor(paginator.encode_cursor(self.dossier))
+        queryset = DossierMedical.objects.filter(paginator._seek(values))
+        self.assertIndexed(self.page_query(queryset, DOSSIER_PAGE_KEYS))
+
+    def test_dossier_agent_list(self):
+        queryset = DossierMedical.objects.filter(department='IT')
+        self.assertIndexed(self.page_query(queryset, DOSSIER_PAGE_KEYS))
+
+    def test_dossier_status_stats(self):
+        # The query the list header actually runs, as stats.py builds it
+        admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN')
+        )
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            dossier_status_stats(listed_dossiers(admin), scope='all')
+        table = DossierMedical._meta.db_table
+        [sql] = [query['sql'] for query in queries if table in query['sql']]
+        self.assertIndexed(sql)
+
+    def test_dossier_report_grouping(self):
+        queryset = (
+            DossierMedical.objects.order_by()
+            .values('status', 'priority', 'department').annotate(count=Count('id'))
+        )
+        self.assertIndexed(queryset)
+
+    def test_critical_dossiers(self):
+        # Without table statistics SQLite prefers the priority range and sorts
+        # the critical rows; MySQL walks dossier_recent_priority_idx instead.
+        queryset = DossierMedical.objects.filter(priority__gte=3).order_by('-created_at')[:5]
+        self.assertIndexed(queryset, allow_sort=connection.vendor == 'sqlite')
+
+    def test_pec_admin_list(self):
+        self.assertIndexed(self.page_query(PriseEnCharge.objects.all(), PEC_PAGE_KEYS))
+
+    def test_pec_patient_list(self):
+        # The patient/creator OR merges two index lookups, so only that one
+        # user's rows get sorted; a table scan is still a regression.
+        queryset = PriseEnCharge.objects.filter(Q(patient=self.agent) | Q(created_by=self.agent))
+        self.assertIndexed(self.page_query(queryset, PEC_PAGE_KEYS), allow_sort=True)
+
+    def test_pec_report_grouping(self):
+        queryset = (
+            PriseEnCharge.objects.order_by()
+            .values('status', 'care_type')
+            .annotate(count=Count('id'), cost=Sum('estimated_cost'))
+        )
+        self.assertIndexed(queryset)
+
+    def test_audit_log(self):
+        self.assertIndexed(DossierAuditLog.objects.order_by('-timestamp')[:50])
+
+    def test_dossier_audit_timeline(self):
+        self.assertIndexed(self.dossier.audit_logs.order_by('-timestamp'))
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        # Six rows inside one millisecond: cursors must keep the microseconds
+        start = timezone.now().replace(microsecond=123000)
+        for n in range(6):
+            pec = PriseEnCharge.objects.create(
+                patient=cls.agent, created_by=cls.agent, institution='Hôpital Central', estimated_cost=100,
+                diagnosis='Grippe', physician='Dr. Smith', care_type='CONSULTATION',
+            )
+            PriseEnCharge.objects.filter(pk=pec.pk).update(created_at=start + timedelta(microseconds=n * 100))
+
+    def test_pages_keep_rows_sharing_a_millisecond(self):
+        paginator = KeysetPaginator(PriseEnCharge.objects.all(), PEC_PAGE_KEYS, per_page=2)
+        expected = list(PriseEnCharge.objects.order_by('-created_at', 'id').values_list('id', flat=True))
+        seen, pages = [], []
+        page = paginator.get_page()
+        while True:
+            pages.append(page)
+            seen.extend(pec.pk for pec in page)
+            if not page.has_next():
+                break
+            page = paginator.get_page(after=page.next_cursor)
+        self.assertEqual(seen, expected)
+
+        back = paginator.get_page(before=pages[-1].previous_cursor)
+        self.assertEqual([pec.pk for pec in back], [pec.pk for pec in pages[-2]])
+
+    def test_pec_list_counts_on_the_first_page_only(self):
+        self.client.force_login(self.agent)
+        first = self.client.get(reverse('pec_list'))
+        self.assertEqual(first.context['pec_count'], 6)
+        after = KeysetPaginator(PriseEnCharge.objects.all(), PEC_PAGE_KEYS).encode_cursor(first.context['pecs'][0])
+        self.assertIsNone(self.client.get(reverse('pec_list'), {'after': after}).context['pec_count'])
+
+
+class DossierStatsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.admin, created_by=cls.admin, start_date=date.today(), status='SUBMITTED',
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def stats(self):
+        self.client.force_login(self.admin)
+        return self.client.get(reverse('dossier_list')).context['stats']
+
+    def test_stats_follow_status_changes(self):
+        self.assertEqual(self.stats(), {'total': 1, 'approved': 0, 'pending': 1, 'rejected': 0})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('approve_dossier', args=[self.dossier.id]))
+        self.assertEqual(self.stats(), {'total': 1, 'approved': 1, 'pending': 0, 'rejected': 0})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('reject_dossier', args=[self.dossier.id]))
+        self.assertEqual(self.stats(), {'total': 1, 'approved': 0, 'pending': 0, 'rejected': 1})
+
+    def test_cached_until_a_write(self):
+        self.stats()
+        # An update that bypasses the signals is only seen once the entry expires
+        DossierMedical.objects.update(status='APPROVED')
+        self.assertEqual(self.stats()['approved'], 0)
+        # A hit reads the entry and the generation together
+        with self.assertNumQueries(1):
+            dossier_status_stats(DossierMedical.objects.all(), scope='all')
+        with self.captureOnCommitCallbacks() as callbacks:
+            DossierMedical.objects.get().save()
+        self.assertEqual(self.stats()['approved'], 0)  # not before the commit
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.stats()['approved'], 1)
+
+    def test_cache_is_shared_between_workers(self):
+        # Invalidation in one process must reach the others
+        self.assertNotIsInstance(cache, LocMemCache)
+
+
+class GlobalReportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN'), department='IT'
+        )
+        statuses = ['SUBMITTED', 'APPROVED', 'REJECTED', 'UNDER_REVIEW', 'DRAFT']
+        for n in range(17):
+            DossierMedical.objects.create(
+                employer=cls.admin, created_by=cls.admin, start_date=date.today(), status=statuses[n % 5],
+                priority=1 + n % 4, department=['IT', 'RH', 'Finance'][n % 3],
+                doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+            )
+        for n in range(11):
+            PriseEnCharge.objects.create(
+                patient=cls.admin, created_by=cls.admin, institution='Hôpital Central',
+                estimated_cost=Decimal('100.50') * (n + 1), status=statuses[n % 3],
+                care_type=['CONSULTATION', 'PHARMACY', 'SURGERY'][n % 3],
+                diagnosis='Grippe', physician='Dr. Smith',
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def per_row_report(self):
+        """The numbers of the original view, one query per figure."""
+        dossiers, pecs = DossierMedical.objects.all(), PriseEnCharge.objects.all()
+
+        def summary(queryset):
+            return {
+                'total': queryset.count(),
+                'approved': queryset.filter(status='APPROVED').count(),
+                'pending': queryset.filter(status__in=['SUBMITTED', 'UNDER_REVIEW']).count(),
+                'rejected': queryset.filter(status='REJECTED').count(),
+            }
+
+        def chart(queryset, field, labels):
+            rows = queryset.order_by().values(field).annotate(count=Count('id'))
+            return {labels.get(row[field], row[field]): row['count'] for row in rows}
+
+        pec_stats = summary(pecs)
+        pec_stats['total_cost'] = pecs.aggregate(total=Sum('estimated_cost'))['total'] or 0
+        return {
+            'dossier_stats': summary(dossiers),
+            'pec_stats': pec_stats,
+            'dossier_table': [
+                {'label': label, 'count': dossiers.filter(status=code).count()}
+                for code, label in DossierMedical.STATUS_CHOICES
+            ],
+            'pec_table': [
+                {
+                    'label': label, 'count': pecs.filter(care_type=code).count(),
+                    'cost': pecs.filter(care_type=code).aggregate(total=Sum('estimated_cost'))['total'] or 0,
+                }
+                for code, label in PriseEnCharge.CARE_TYPES
+            ],
+            'chart_dossier_status': chart(dossiers, 'status', dict(DossierMedical.STATUS_CHOICES)),
+            'chart_dossier_priority': chart(dossiers, 'priority', dict(DossierMedical.PRIORITY_LEVELS)),
+            'chart_dossier_dept': chart(dossiers, 'department', {}),
+            'chart_pec_status': chart(pecs, 'status', dict(PriseEnCharge.STATUS_CHOICES)),
+            'chart_pec_type': chart(pecs, 'care_type', dict(PriseEnCharge.CARE_TYPES)),
+        }
+
+    def test_matches_the_per_row_numbers(self):
+        with self.assertNumQueries(4):
+            report = build_global_report()
+        expected = self.per_row_report()
+        for key in ('dossier_stats', 'pec_stats', 'dossier_table', 'pec_table'):
+            self.assertEqual(report[key], expected[key], key)
+        for key in ('chart_dossier_status', 'chart_dossier_priority', 'chart_dossier_dept',
+                    'chart_pec_status', 'chart_pec_type'):
+            chart = json.loads(report[key])
+            self.assertEqual(dict(zip(chart['labels'], chart['data'])), expected[key], key)
+        self.assertEqual(
+            [d.pk for d in report['critical_dossiers']],
+            list(DossierMedical.objects.filter(priority__gte=3).order_by('-created_at').values_list('pk', flat=True)[:5]),
+        )
+
+    def test_snapshot_dropped_on_write(self):
+        self.client.force_login(self.admin)
+        stats = lambda: self.client.get(reverse('global_report')).context['dossier_stats']
+        before = stats()
+        dossier = DossierMedical.objects.filter(status='SUBMITTED').first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('approve_dossier', args=[dossier.id]))
+        after = stats()
+        self.assertEqual(after['approved'], before['approved'] + 1)
+        self.assertEqual(after['pending'], before['pending'] - 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PriseEnCharge.objects.filter(status='APPROVED').first().delete()
+        self.assertEqual(
+            self.client.get(reverse('global_report')).context['pec_stats']['approved'],
+            PriseEnCharge.objects.filter(status='APPROVED').count(),
+        )
+
+
+class ReportSnapshotCommitTests(TransactionTestCase):
+
+    def test_reader_before_commit_does_not_outlive_it(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('needs a test database shared between connections')
+        admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN'), department='IT'
+        )
+        dossier = DossierMedical.objects.create(
+            employer=admin, created_by=admin, start_date=date.today(), status='SUBMITTED',
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+        cache.clear()
+        global_report_snapshot()
+        seen = []
+
+        def read():
+            try:
+                seen.append(global_report_snapshot()['dossier_stats']['approved'])
+            finally:
+                connections.close_all()
+
+        with transaction.atomic():
+            dossier.status = 'APPROVED'
+            dossier.save()
+            # Another request, on its own connection, before the commit
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join()
+        self.assertEqual(seen, [0])
+        self.assertEqual(global_report_snapshot()['dossier_stats']['approved'], 1)
+
+
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        role = Role.objects.create(name='ADMIN')
+        cls.admin = User.objects.create_user('admin@example.com', 'pw', full_name='Admin', role=role)
+        cls.helene = User.objects.create_user(
+            'helene@example.com', 'pw', full_name='Hélène Dupont', role=role, department='IT'
+        )
+        cls.paul = User.objects.create_user(
+            'paul@example.com', 'pw', full_name='Paul Martin', role=role, department='IT'
+        )
+        cls.bronchitis = DossierMedical.objects.create(
+            employer=cls.helene, created_by=cls.admin, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Bronchite aiguë', treatment_plan='Repos',
+        )
+        cls.followup = DossierMedical.objects.create(
+            employer=cls.paul, created_by=cls.admin, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Entorse', treatment_plan='Repos', comments='Suite de bronchite',
+        )
+
+    def search(self, query):
+        self.client.force_login(self.admin)
+        return [d.pk for d in self.client.get(reverse('dossier_list'), {'q': query}).context['dossiers']]
+
+    def test_tokenize_folds_accents_and_drops_stopwords(self):
+        self.assertEqual(
+            search.tokenize("L'Hôpital de la Paix, écho-cardiographie"),
+            ['hopital', 'paix', 'echo', 'cardiographie'],
+        )
+        self.assertEqual(search.query_terms('paix PAIX Paix de'), ['paix'])
+
+    def test_prefix_and_accent_insensitive_matching(self):
+        self.assertEqual(self.search('hel bronch'), [self.bronchitis.pk])
+        self.assertEqual(self.search('Hélène AIGUE'), [self.bronchitis.pk])
+        self.assertEqual(self.search('helene entorse'), [])
+
+    def test_short_terms_use_the_token_table_on_mysql(self):
+        self.assertEqual(sorted(self.search('dm ' + self.bronchitis.reference[3:11])),
+                         sorted([self.bronchitis.pk, self.followup.pk]))
+        self.assertEqual(self.search('he'), [self.bronchitis.pk])
+        dossiers = DossierMedical.objects.all()
+        with mock.patch.object(connections[dossiers.db], 'vendor', 'mysql'):
+            self.assertTrue(search._use_fulltext(dossiers, ['bronchite', 'dupont']))
+            # Below innodb_ft_min_token_size: not in the FULLTEXT index
+            self.assertFalse(search._use_fulltext(dossiers, ['bronchite', 'he']))
+
+    def test_ranked_by_field_weight(self):
+        # The diagnosis weighs more than the comments
+        self.assertEqual(self.search('bronchite'), [self.bronchitis.pk, self.followup.pk])
+
+    def test_stopword_query_lists_everything(self):
+        self.assertEqual(sorted(self.search('de la')), sorted([self.bronchitis.pk, self.followup.pk]))
+
+    def test_renamed_person_is_found_under_the_new_name(self):
+        self.helene.full_name = 'Hélène Moreau'
+        self.helene.save()
+        self.assertEqual(self.search('moreau'), [self.bronchitis.pk])
+        self.assertEqual(self.search('dupont'), [])
+
+        with self.assertNumQueries(1):
+            self.paul.save(update_fields=['last_login'])
+
+    def test_migration_backfills_unindexed_rows(self):
+        SearchDocument.objects.filter(object_id=self.followup.pk).delete()
+        self.assertEqual(self.search('entorse'), [])
+        backfill = importlib.import_module('dossier_medicale.migrations.0028_backfill_search_index')
+        backfill.backfill_search_index(django_apps, None)
+        self.assertEqual(self.search('entorse'), [self.followup.pk])
+        self.assertEqual(SearchDocument.objects.filter(object_id=self.bronchitis.pk, kind='DM').count(), 1)
+        # Its frozen tokenizer indexes as the app does today
+        self.assertEqual(
+            dict(SearchToken.objects.filter(object_id=self.followup.pk, kind='DM').values_list('token', 'weight')),
+            dict(search.document_content(search.dossier_fields(self.followup))[1]),
+        )
+
+
+class ReferenceAllocationTests(TransactionTestCase):
+    """Concurrent inserts must never receive the same reference."""
+
+    THREADS = 8
+    PER_THREAD = 15
+
+    def setUp(self):
+        agent_role = Role.objects.create(name='AGENT')
+        self.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=agent_role, department='IT'
+        )
+
+    def run_concurrently(self, target):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('needs a test database shared between connections')
+        errors = []
+        barrier = threading.Barrier(self.THREADS)
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(self.PER_THREAD):
+                    target()
+            except Exception as exc:  # surfaced in the main thread below
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_dossier_inserts_get_unique_references(self):
+        def create():
+            DossierMedical.objects.create(
+                employer=self.agent, created_by=self.agent, start_date=date.today(),
+                doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+            )
+
+        self.run_concurrently(create)
+        references = list(DossierMedical.objects.values_list('reference', flat=True))
+        self.assertEqual(len(references), self.THREADS * self.PER_THREAD)
+        self.assertEqual(len(set(references)), len(references))
+
+    def test_concurrent_block_reservations_do_not_overlap(self):
+        blocks = []
+
+        def reserve():
+            blocks.append(allocate_references(PriseEnCharge, 'PEC', count=10))
+
+        self.run_concurrently(reserve)
+        references = [ref for block in blocks for ref in block]
+        self.assertEqual(len(set(references)), self.THREADS * self.PER_THREAD * 10)
+
+    def test_references_are_reserved_outside_the_creation_transaction(self):
+        in_transaction = []
+
+        def allocate(*args, **kwargs):
+            in_transaction.append(connection.in_atomic_block)
+            return allocate_references(*args, **kwargs)
+
+        self.client.force_login(self.agent)
+        with mock.patch('dossier_medicale.views.allocate_references', allocate):
+            response = self.client.post(reverse('create_dossier'), {
+                'employer': self.agent.pk, 'category': 'GENERAL', 'start_date': date.today(),
+                'doctor': 'Dr. Smith', 'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'priority': 2,
+            })
+        self.assertEqual(response.status_code, 302)
+
+        rows = [
+            (line, {'employer': 'agent@example.com', 'start_date': '2024-01-15', 'doctor': 'Dr. Smith',
+                    'diagnosis': 'Grippe', 'treatment_plan': 'Repos'})
+            for line in (1, 2, 3)
+        ]
+        with mock.patch('dossier_medicale.imports.allocate_references', allocate):
+            result = import_rows('dossier', rows, self.agent, batch_size=2)
+        self.assertEqual(result.created, 3)
+        self.assertEqual(in_transaction, [False, False, False])
+
+    def test_counter_continues_after_existing_references(self):
+        today = date.today()
+        DossierMedical.objects.create(
+            reference=f"DM-{today:%Y%m%d}-0041", employer=self.agent, created_by=self.agent,
+            start_date=today, doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+        self.assertEqual(
+            allocate_references(DossierMedical, 'DM', count=2, day=today),
+            [f"DM-{today:%Y%m%d}-0042", f"DM-{today:%Y%m%d}-0043"],
+        )
+
+
+class ControllerAssignmentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        agent_role = Role.objects.create(name='AGENT')
+        controller_role = Role.objects.create(name='CONTROLLER')
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=agent_role, department='IT'
+        )
+        cls.controllers = [
+            User.objects.create_user(
+                f'controller{i}@example.com', 'pw', full_name=f'Controller {i}',
+                role=controller_role, department=department,
+            )
+            for i, department in enumerate(['IT', 'RH', 'RH'])
+        ]
+
+    def submit(self, department='IT'):
+        return DossierMedical.objects.create(
+            employer=self.agent, created_by=self.agent, department=department,
+            status='SUBMITTED', start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def open_counts(self):
+        return [
+            ControllerWorkload.objects.get(controller=controller).open_dossiers
+            for controller in self.controllers
+        ]
+
+    def test_submissions_are_spread_within_department(self):
+        for _ in range(4):
+            self.submit(department='RH')
+        self.assertEqual(self.open_counts(), [0, 2, 2])
+
+    def test_falls_back_to_any_controller(self):
+        for _ in range(3):
+            self.submit(department='FINANCE')
+        self.assertEqual(self.open_counts(), [1, 1, 1])
+
+    def test_counters_follow_review_and_deletion(self):
+        dossier = self.submit()
+        self.assertEqual(dossier.controller, self.controllers[0])
+        self.assertEqual(self.open_counts(), [1, 0, 0])
+
+        dossier.status = 'APPROVED'
+        dossier.save()
+        self.assertEqual(self.open_counts(), [0, 0, 0])
+
+        reopened = DossierMedical.objects.get(pk=dossier.pk)
+        reopened.status = 'UNDER_REVIEW'
+        reopened.controller = self.controllers[1]
+        reopened.save()
+        self.assertEqual(self.open_counts(), [0, 1, 0])
+
+        reopened.delete()
+        self.assertEqual(self.open_counts(), [0, 0, 0])
+
+    def test_inactive_controller_is_skipped(self):
+        self.controllers[0].is_active = False
+        self.controllers[0].save()
+        self.assertNotEqual(self.submit().controller, self.controllers[0])
+
+    def test_deferred_loads_do_not_count_twice(self):
+        dossier = self.submit()
+        self.assertEqual(self.open_counts(), [1, 0, 0])
+
+        partial = DossierMedical.objects.only('id', 'comments').get(pk=dossier.pk)
+        partial.comments = 'Vu'
+        partial.save()
+        self.assertEqual(self.open_counts(), [1, 0, 0])
+
+        partial = DossierMedical.objects.defer('status').get(pk=dossier.pk)
+        partial.status = 'APPROVED'
+        partial.save()
+        self.assertEqual(self.open_counts(), [0, 0, 0])
+
+        reopened = DossierMedical.objects.get(pk=dossier.pk)
+        reopened.status = 'SUBMITTED'
+        reopened.save()
+        DossierMedical.objects.only('id').get(pk=dossier.pk).delete()
+        self.assertEqual(self.open_counts(), [0, 0, 0])
+
+    def test_unrelated_user_saves_leave_workloads_alone(self):
+        with self.assertNumQueries(1):
+            self.controllers[0].save(update_fields=['last_login'])
+
+        self.controllers[0].department = 'RH'
+        self.controllers[0].save(update_fields=['department'])
+        self.assertEqual(ControllerWorkload.objects.get(controller=self.controllers[0]).department, 'RH')
+
+
+class VisibilityQuerySetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        roles = {name: Role.objects.create(name=name) for name in ('AGENT', 'CONTROLLER', 'ADMIN')}
+        cls.controller = User.objects.create_user(
+            'controller@example.com', 'pw', full_name='Controller', role=roles['CONTROLLER']
+        )
+        cls.author, cls.employee, cls.outsider = [
+            User.objects.create_user(f'{name}@example.com', 'pw', full_name=name, role=roles['AGENT'])
+            for name in ('author', 'employee', 'outsider')
+        ]
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.employee, created_by=cls.author, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+        cls.piece = PieceJointe.objects.create(
+            dossier=cls.dossier, nom_fichier='scan.pdf', chemin_storage='pieces_jointes/scan.pdf',
+            type='PDF', taille_ko=1,
+        )
+
+    def test_visibility_matches_model_rules(self):
+        for user in (self.controller, self.author, self.employee, self.outsider):
+            with self.subTest(user=user.email):
+                visible = DossierMedical.objects.visible_to(user).filter(pk=self.dossier.pk).exists()
+                self.assertEqual(visible, self.dossier.user_can_view(user))
+                editable = DossierMedical.objects.editable_by(user).filter(pk=self.dossier.pk).exists()
+                self.assertEqual(editable, self.dossier.user_can_edit(user))
+                pieces = PieceJointe.objects.visible_to(user).filter(pk=self.piece.pk).exists()
+                self.assertEqual(pieces, visible)
+
+    def test_approved_dossier_is_not_editable_by_author(self):
+        DossierMedical.objects.filter(pk=self.dossier.pk).update(status='APPROVED')
+        self.assertFalse(DossierMedical.objects.editable_by(self.author).exists())
+        self.assertTrue(DossierMedical.objects.editable_by(self.controller).exists())
+
+    def test_visibility_adds_no_queries(self):
+        with self.assertNumQueries(1):
+            list(PieceJointe.objects.visible_to(self.author).filter(dossier=self.dossier))
+
+
+class RoleCapabilityTests(TestCase):
+    """The capability matrix grants what the views' former role checks did."""
+
+    # capability -> roles the views allowed by name before the matrix
+    ROLE_RULES = {
+        'can_view_all': {'ADMIN', 'CONTROLLER'},
+        'can_create': {'AGENT', 'CONTROLLER', 'ADMIN'},
+        'can_edit_any': {'ADMIN', 'CONTROLLER'},
+        'can_upload': {'AGENT', 'CONTROLLER', 'ADMIN'},
+        'can_scan': {'AGENT', 'CONTROLLER'},
+        'can_approve': {'CONTROLLER', 'ADMIN'},
+        'can_report_any': {'CONTROLLER', 'ADMIN'},
+        'can_download_all': {'AGENT', 'CONTROLLER'},
+        'can_view_audit': {'ADMIN', 'CONTROLLER'},
+        'can_delete_any_pec': {'ADMIN'},
+    }
+    ROLE_ACTIONS = {
+        'AGENT': ['view', 'upload', 'update', 'scan'],
+        'CONTROLLER': ['view', 'upload', 'approve', 'reject', 'generate_report', 'edit'],
+        'ADMIN': ['view', 'upload', 'approve', 'reject', 'generate_report', 'edit'],
+        'VISITOR': ['view'],
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {
+            name: User.objects.create_user(
+                f'{name.lower()}@example.com', 'pw', full_name=name, role=Role.objects.create(name=name),
+            )
+            for name in ('AGENT', 'CONTROLLER', 'ADMIN', 'VISITOR')
+        }
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.users['AGENT'], created_by=cls.users['AGENT'], start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def test_capabilities_match_role_rules(self):
+        for name, user in self.users.items():
+            caps = capabilities_for(user)
+            for capability, roles in self.ROLE_RULES.items():
+                with self.subTest(role=name, capability=capability):
+                    self.assertEqual(getattr(caps, capability), name in roles)
+
+    def test_actions_match_role_rules(self):
+        for name, user in self.users.items():
+            with self.subTest(role=name):
+                actions = role_actions(user, self.dossier)
+                self.assertEqual([action['name'] for action in actions], self.ROLE_ACTIONS[name])
+                for action in actions[1:]:
+                    self.assertIn(f'/{self.dossier.pk}/', action['url'])
+
+    def test_anonymous_user_has_no_capabilities(self):
+        self.assertEqual(capabilities_for(AnonymousUser()), NO_CAPABILITIES)
+
+    def test_views_enforce_capabilities(self):
+        for name, user in self.users.items():
+            self.client.force_login(user)
+            with self.subTest(role=name):
+                response = self.client.get(reverse('audit_log'))
+                self.assertEqual(response.status_code == 200, name in self.ROLE_RULES['can_view_audit'])
+                response = self.client.post(reverse('approve_dossier', args=[self.dossier.pk]))
+                self.assertEqual(response.status_code != 403, name in self.ROLE_RULES['can_approve'])
+
+    def test_capability_checks_do_not_query(self):
+        user = User.objects.select_related('role').get(pk=self.users['CONTROLLER'].pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(capabilities_for(user).can_approve)
+            role_actions(user, self.dossier)
+
+
+class MediaTestCase(TestCase):
+    """TestCase writing uploads and file caches to a throwaway directory."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_override = override_settings(
+            MEDIA_ROOT=cls.media_root, FILE_CACHE_ROOT=os.path.join(cls.media_root, 'cache'),
+            CHUNKED_UPLOAD_ROOT=os.path.join(cls.media_root, 'uploads'),
+        )
+        cls.media_override.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.media_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+class DownloadAllTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        agent_role = Role.objects.create(name='AGENT')
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=agent_role, department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+        cls.files = {'notes.txt': b'compte rendu ' * 5000, 'scan.pdf': b'%PDF-1.4 ' + bytes(range(256)) * 40}
+        for name, data in cls.files.items():
+            PieceJointe.objects.create(
+                dossier=cls.dossier, nom_fichier=name, chemin_storage=ContentFile(data, name=name),
+                type=name.rsplit('.', 1)[-1].upper(), taille_ko=len(data) // 1024,
+            )
+
+    def test_streamed_archive_round_trips(self):
+        self.client.force_login(self.agent)
+        response = self.client.get(reverse('download_all', args=[self.dossier.id]))
+        self.assertTrue(response.streaming)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual({name: archive.read(name) for name in archive.namelist()}, self.files)
+        self.assertEqual(archive.getinfo('scan.pdf').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+
+    def test_chunks_stay_bounded(self):
+        pieces = self.dossier.pieces_jointes.all()
+        entries = [(p.nom_fichier, p.chemin_storage, p.date_upload) for p in pieces]
+        chunks = list(iter_zip(entries, chunk_size=1024))
+        self.assertGreater(len(chunks), 10)
+        self.assertLess(max(len(chunk) for chunk in chunks), 4 * 1024)
+
+    def test_repeat_download_served_from_cache(self):
+        self.client.force_login(self.agent)
+        url = reverse('download_all', args=[self.dossier.id])
+        first = b''.join(self.client.get(url).streaming_content)
+
+        cached = self.client.get(url)
+        self.assertIsInstance(cached, FileResponse)
+        self.assertEqual(b''.join(cached.streaming_content), first)
+
+        PieceJointe.objects.create(
+            dossier=self.dossier, nom_fichier='extra.txt', chemin_storage=ContentFile(b'x', name='extra.txt'),
+            type='TXT', taille_ko=0,
+        )
+        rebuilt = self.client.get(url)
+        self.assertNotIsInstance(rebuilt, FileResponse)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(rebuilt.streaming_content)))
+        self.assertIn('extra.txt', archive.namelist())
+
+    def test_archive_missing_files_says_so_and_is_not_cached(self):
+        self.client.force_login(self.agent)
+        url = reverse('download_all', args=[self.dossier.id])
+        self.dossier.pieces_jointes.filter(nom_fichier='scan.pdf').update(chemin_storage='pieces_jointes/lost.pdf')
+
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertNotIsInstance(response, FileResponse)
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(archive.namelist(), ['notes.txt', MISSING_FILES_NAME])
+            self.assertIn(b'- scan.pdf', archive.read(MISSING_FILES_NAME))
+
+
+class ReportCacheTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.controller = User.objects.create_user(
+            'ctrl@example.com', 'pw', full_name='Controller',
+            role=Role.objects.create(name='CONTROLLER'), department='IT',
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.controller, created_by=cls.controller, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.controller)
+        render = mock.patch('dossier_medicale.reports.render_dossier_report', wraps=render_dossier_report)
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def download(self):
+        response = self.client.get(reverse('generate_report', args=[self.dossier.id]))
+        self.assertIsInstance(response, FileResponse)
+        return b''.join(response.streaming_content)
+
+    def test_report_rendered_once_per_version(self):
+        pdf = self.download()
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertEqual(self.download(), pdf)
+        self.assertEqual(self.render.call_count, 1)
+
+        self.dossier.diagnosis = 'Angine'
+        self.dossier.save()
+        self.download()
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_markup_in_free_text_is_escaped(self):
+        self.dossier.diagnosis = 'Douleur <thorax> & fièvre'
+        self.dossier.save()
+        self.assertTrue(self.download().startswith(b'%PDF'))
+
+    def test_footer_dates_the_data_not_the_render(self):
+        updated = timezone.localtime(self.dossier.updated_at)
+        self.assertEqual(report_footer(self.dossier), FOOTER.format(updated))
+        piece = PieceJointe(date_upload=self.dossier.updated_at + timedelta(hours=2))
+        self.assertEqual(report_footer(self.dossier, [piece]), FOOTER.format(updated + timedelta(hours=2)))
+
+    def test_benchmark_compares_under_the_same_stream_encoding(self):
+        output = io.StringIO()
+        call_command('benchmark_reports', iterations=2, a85=True, stdout=output)
+        self.assertRegex(output.getvalue(), r'engine/inline: [\d.]+x CPU')
+        self.assertRegex(output.getvalue(), r'engine/inline \(ASCII85\): [\d.]+x CPU')
+
+    def test_stream_encoding_is_only_set_for_the_build(self):
+        previous = rl_config.useA85
+        rl_config.useA85 = 1
+        try:
+            pdf = render_dossier_report(self.dossier, [])
+            self.assertEqual(rl_config.useA85, 1)
+        finally:
+            rl_config.useA85 = previous
+        self.assertNotIn(b'ASCII85Decode', pdf)
+
+    def test_pec_report(self):
+        pec = PriseEnCharge.objects.create(
+            patient=self.controller, created_by=self.controller, institution='Clinique du Nord',
+            estimated_cost=Decimal('120.50'), diagnosis='Bilan', physician='Dr. Smith',
+        )
+        response = self.client.get(reverse('pec_report', args=[pec.id]))
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+        self.assertEqual(self.render.call_count, 0)
+
+    @override_settings(REPORT_PRERENDER_ON_APPROVE=True)
+    def test_approval_queues_report_prerender(self):
+        self.client.get(reverse('approve_dossier', args=[self.dossier.id]))
+        self.assertEqual(self.render.call_count, 0)
+        for job_id in jobs.claim('test', 10):
+            jobs.run(job_id)
+        self.assertEqual(self.render.call_count, 1)
+        self.download()
+        self.assertEqual(self.render.call_count, 1)
+
+
+class BulkExportTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.controller = User.objects.create_user(
+            'ctrl@example.com', 'pw', full_name='Controller',
+            role=Role.objects.create(name='CONTROLLER'), department='IT',
+        )
+        cls.dossiers = [
+            DossierMedical.objects.create(
+                employer=cls.controller, created_by=cls.controller, start_date=date.today(),
+                doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos', department=department,
+            )
+            for department in ('IT', 'IT', 'RH')
+        ]
+        PieceJointe.objects.create(
+            dossier=cls.dossiers[0], nom_fichier='notes.txt', chemin_storage=ContentFile(b'notes', name='notes.txt'),
+            type='TXT', taille_ko=0,
+        )
+
+    def test_view_streams_filtered_export_without_a_process_pool(self):
+        self.client.force_login(self.controller)
+        with mock.patch('dossier_medicale.exports.ProcessPoolExecutor') as pool:
+            response = self.client.get(reverse('bulk_export'), {'department': 'IT'})
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        pool.assert_not_called()
+        first, second = (dossier.reference for dossier in self.dossiers[:2])
+        self.assertEqual(sorted(archive.namelist()), sorted([
+            f'{first}/rapport_{first}.pdf', f'{first}/notes.txt', f'{second}/rapport_{second}.pdf',
+        ]))
+        self.assertEqual(archive.read(f'{first}/notes.txt'), b'notes')
+
+    @mock.patch('dossier_medicale.exports.WINDOW', 1)
+    def test_export_renders_window_by_window_and_reuses_cached_reports(self):
+        dossiers = export_queryset(DossierMedical.objects.all())
+        progress = []
+        render = mock.patch('dossier_medicale.exports.render_dossier_report', wraps=render_dossier_report)
+        with render as rendered:
+            first = b''.join(iter_export(dossiers, progress=lambda done, total: progress.append((done, total))))
+            self.assertEqual(rendered.call_count, 3)
+            second = b''.join(iter_export(dossiers))
+            self.assertEqual(rendered.call_count, 3)
+        self.assertEqual(progress, [(0, 3), (1, 3), (2, 3), (3, 3)])
+        names = zipfile.ZipFile(io.BytesIO(first)).namelist()
+        self.assertEqual(sorted(zipfile.ZipFile(io.BytesIO(second)).namelist()), sorted(names))
+        self.assertEqual(len([name for name in names if name.endswith('.pdf')]), 3)
+
+    def test_reports_rendered_by_process_pool(self):
+        dossiers = export_queryset(DossierMedical.objects.all())
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(iter_export(dossiers, workers=2))))
+        reports = [name for name in archive.namelist() if name.endswith('.pdf')]
+        self.assertEqual(len(reports), 3)
+        for name in reports:
+            self.assertTrue(archive.read(name).startswith(b'%PDF'))
+
+
+class JobQueueTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.controller = User.objects.create_user(
+            'ctrl@example.com', 'pw', full_name='Controller',
+            role=Role.objects.create(name='CONTROLLER'), department='IT',
+        )
+        DossierMedical.objects.create(
+            employer=cls.controller, created_by=cls.controller, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def test_claimed_jobs_are_not_handed_out_twice(self):
+        first, second = jobs.enqueue('noop'), jobs.enqueue('noop')
+        self.assertEqual(jobs.claim('w1', 1), [first.pk])
+        self.assertEqual(jobs.claim('w2', 5), [second.pk])
+        self.assertEqual(jobs.claim('w3', 5), [])
+
+    @mock.patch.dict(jobs.TASKS, {'flaky': mock.Mock(side_effect=RuntimeError('boom'))})
+    def test_failures_retry_with_backoff_then_fail(self):
+        job = jobs.enqueue('flaky', max_attempts=2)
+        jobs.run(*jobs.claim('w', 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('QUEUED', 1))
+        self.assertGreater(job.run_at, timezone.now())
+        self.assertEqual(jobs.claim('w', 1), [])  # not due yet
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        jobs.run(*jobs.claim('w', 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('FAILED', 2))
+        self.assertIn('RuntimeError: boom', job.error)
+
+    def test_stale_running_jobs_are_requeued(self):
+        job = jobs.enqueue('noop')
+        jobs.claim('dead-worker', 1)
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.claim('w', 1), [job.pk])
+
+    def test_heartbeat_keeps_long_jobs_from_being_requeued(self):
+        job = jobs.enqueue('noop')
+        jobs.claim('w', 1)
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(days=1))
+        self.assertEqual(jobs.heartbeat('w'), 1)
+        self.assertEqual(jobs.requeue_stale(), 0)
+
+    def test_outcome_of_a_job_taken_over_is_not_recorded(self):
+        def taken_over(job):
+            # Requeued as stale and claimed by another worker meanwhile
+            Job.objects.filter(pk=job.pk).update(locked_by='w2')
+            return 'done'
+
+        job = jobs.enqueue('taken_over')
+        with mock.patch.dict(jobs.TASKS, {'taken_over': taken_over}):
+            jobs.run(*jobs.claim('w1', 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by, job.result), ('RUNNING', 'w2', None))
+
+    def test_background_export(self):
+        self.client.force_login(self.controller)
+        response = self.client.get(reverse('bulk_export'), {'background': 'on'})
+        job = response.context['job']
+        self.assertEqual(self.client.get(reverse('job_status', args=[job.pk])).json()['status'], 'QUEUED')
+
+        jobs.run(*jobs.claim('w', 1))
+        state = self.client.get(reverse('job_status', args=[job.pk])).json()
+        self.assertEqual(state['status'], 'SUCCEEDED')
+        self.assertEqual(state['progress'], {'done': 1, 'total': 1})
+
+        download = self.client.get(reverse('bulk_export_download', args=[job.pk]))
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(download.streaming_content)))
+        self.assertEqual(len(archive.namelist()), 1)
+
+
+class AttachmentStorageTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def attach(self, data, name='scan.png'):
+        return PieceJointe.objects.create(
+            dossier=self.dossier, nom_fichier=name, chemin_storage=ContentFile(data, name=name),
+            type='PNG', taille_ko=len(data) // 1024,
+        )
+
+    def test_identical_uploads_share_one_blob(self):
+        first, second = self.attach(b'same bytes'), self.attach(b'same bytes', name='copy.PNG')
+        self.assertEqual(first.chemin_storage.name, second.chemin_storage.name)
+        self.assertRegex(first.chemin_storage.name, r'^pieces_jointes/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(AttachmentBlob.objects.get().ref_count, 2)
+        self.assertNotEqual(self.attach(b'other bytes').chemin_storage.name, first.chemin_storage.name)
+
+    def test_blob_removed_with_last_reference(self):
+        first, second = self.attach(b'same bytes'), self.attach(b'same bytes')
+        path = first.chemin_storage.path
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+    def test_dedupe_command_migrates_legacy_files(self):
+        legacy = FileSystemStorage()
+        names = [legacy.save('pieces_jointes/scan.png', ContentFile(b'legacy')) for _ in range(2)]
+        pieces = [self.attach(b'placeholder %d' % i) for i in range(2)]
+        for piece, name in zip(pieces, names):
+            PieceJointe.objects.filter(pk=piece.pk).update(chemin_storage=name)
+
+        call_command('dedupe_attachments', '--grace', '0', stdout=io.StringIO())
+
+        migrated = set(PieceJointe.objects.values_list('chemin_storage', flat=True))
+        self.assertEqual(len(migrated), 1)
+        self.assertTrue(is_content_addressed(migrated.pop()))
+        self.assertFalse(any(legacy.exists(name) for name in names))
+        # The placeholders lost their pieces and were released by the recount
+        self.assertEqual(list(AttachmentBlob.objects.values_list('ref_count', flat=True)), [2])
+
+
+
+class ChunkedUploadTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.agent)
+        self.data = os.urandom(200 * 1024)
+        self.upload_root = os.path.join(self.media_root, 'uploads')
+        shutil.rmtree(self.upload_root, ignore_errors=True)
+
+    def start(self, **fields):
+        fields = {'filename': 'scan.dcm', 'size': len(self.data), 'type': 'SCAN', **fields}
+        response = self.client.post(reverse('upload_session_create', args=[self.dossier.id]), fields)
+        self.assertEqual(response.status_code, 201)
+        return response['Location']
+
+    def send(self, url, offset, chunk, **headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.patch(url, chunk, content_type='application/offset+octet-stream',
+                                     HTTP_UPLOAD_OFFSET=str(offset), **headers)
+
+    def test_chunks_assemble_into_attachment(self):
+        url = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        step = 64 * 1024
+        for offset in range(0, len(self.data), step):
+            chunk = self.data[offset:offset + step]
+            response = self.send(url, offset, chunk,
+                                 HTTP_UPLOAD_CHECKSUM='sha256 ' + hashlib.sha256(chunk).hexdigest())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(int(response['Upload-Offset']), offset + len(chunk))
+
+        self.assertEqual(response.json()['status'], 'COMPLETE')
+        piece = PieceJointe.objects.get(pk=response.json()['piece'])
+        self.assertEqual((piece.dossier, piece.type, piece.taille_ko), (self.dossier, 'SCAN', 200))
+        with piece.chemin_storage.open() as stored:
+            self.assertEqual(stored.read(), self.data)
+        self.assertTrue(DossierAuditLog.objects.filter(dossier=self.dossier, action='ATTACHMENT_ADD').exists())
+        self.assertEqual(os.listdir(self.upload_root), [])
+
+    def test_completed_upload_is_moved_into_storage_outside_the_session_lock(self):
+        url = self.start(sha256=hashlib.sha256(self.data).hexdigest())
+        self.send(url, 0, self.data[:100_000])
+        session = UploadSession.objects.get()
+        inode = os.stat(uploads.temp_path(session)).st_ino
+
+        depth = len(connection.atomic_blocks)
+        locked = []
+        complete = uploads._complete
+
+        def spy(session):
+            locked.append(len(connection.atomic_blocks) > depth)
+            return complete(session)
+
+        with mock.patch('dossier_medicale.uploads._complete', spy), \
+                mock.patch('dossier_medicale.uploads._file_sha256', wraps=uploads._file_sha256) as hashed:
+            response = self.send(url, 100_000, self.data[100_000:])
+        self.assertEqual(response.json()['status'], 'COMPLETE')
+        self.assertEqual(locked, [False])
+        self.assertEqual(hashed.call_count, 1)
+        piece = PieceJointe.objects.get()
+        self.assertEqual(os.stat(piece.chemin_storage.path).st_ino, inode)
+        self.assertEqual(piece.taille_ko, len(self.data) // 1024)
+
+    def test_upload_completes_once(self):
+        url = self.start()
+        self.send(url, 0, self.data[:100_000])
+        session = UploadSession.objects.get()
+        complete = uploads._complete
+        refused = []
+
+        def concurrent(session):
+            # A retried or concurrent request for the last bytes meanwhile
+            try:
+                uploads.append_chunk(session.pk, len(self.data), io.BytesIO(), 0)
+            except uploads.UploadError as error:
+                refused.append(error.status)
+            return complete(session)
+
+        with mock.patch('dossier_medicale.uploads._complete', concurrent):
+            response = self.send(url, 100_000, self.data[100_000:])
+        self.assertEqual(response.json()['status'], 'COMPLETE')
+        self.assertEqual(refused, [409])
+        # Nor does an empty chunk sent afterwards complete it again
+        self.assertEqual(self.send(url, len(self.data), b'', CONTENT_LENGTH='0').status_code, 409)
+        self.assertEqual(PieceJointe.objects.count(), 1)
+
+    def test_failed_completion_can_be_retried(self):
+        url = self.start()
+        storage = PieceJointe._meta.get_field('chemin_storage').storage
+        with mock.patch.object(storage, 'save', side_effect=OSError('disk full')), \
+                self.assertRaises(OSError):
+            self.send(url, 0, self.data)
+        self.assertEqual(UploadSession.objects.get().status, 'ACTIVE')
+
+        response = self.send(url, len(self.data), b'', CONTENT_LENGTH='0')
+        self.assertEqual(response.json()['status'], 'COMPLETE')
+        self.assertEqual(PieceJointe.objects.count(), 1)
+
+    def test_sessions_only_open_on_visible_dossiers(self):
+        other = User.objects.create_user('other@example.com', 'pw', full_name='Other', role=self.agent.role)
+        self.client.force_login(other)
+        response = self.client.post(reverse('upload_session_create', args=[self.dossier.id]),
+                                    {'filename': 'scan.dcm', 'size': 10})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_interrupted_upload_resumes_from_offset(self):
+        url = self.start()
+        self.send(url, 0, self.data[:100_000])
+        # A chunk cut short by a dropped connection is not counted
+        session = UploadSession.objects.get()
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(session.pk, 100_000, io.BytesIO(self.data[100_000:150_000]), 60_000)
+        self.assertEqual(self.client.head(url)['Upload-Offset'], '100000')
+        self.assertEqual(os.path.getsize(uploads.temp_path(session)), 100_000)
+        # Nor is one sent at the wrong offset
+        response = self.send(url, 50_000, self.data[50_000:])
+        self.assertEqual((response.status_code, response['Upload-Offset']), (409, '100000'))
+
+        response = self.send(url, 100_000, self.data[100_000:])
+        self.assertEqual(response.json()['status'], 'COMPLETE')
+        with PieceJointe.objects.get().chemin_storage.open() as stored:
+            self.assertEqual(stored.read(), self.data)
+
+    def test_checksum_mismatches_are_rejected(self):
+        url = self.start(sha256=hashlib.sha256(b'something else').hexdigest())
+        response = self.send(url, 0, self.data[:1000], HTTP_UPLOAD_CHECKSUM='sha256 ' + '0' * 64)
+        self.assertEqual((response.status_code, response['Upload-Offset']), (460, '0'))
+
+        # The whole file does not match: the upload starts over
+        response = self.send(url, 0, self.data)
+        self.assertEqual((response.status_code, response['Upload-Offset']), (460, '0'))
+        self.assertFalse(PieceJointe.objects.exists())
+
+    def test_sessions_are_private_and_purged(self):
+        url = self.start()
+        other = User.objects.create_user('other@example.com', 'pw', full_name='Other', role=self.agent.role)
+        self.client.force_login(other)
+        self.assertEqual(self.client.head(url).status_code, 404)
+
+        UploadSession.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        call_command('purge_uploads', stdout=io.StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(self.upload_root), [])
+
+
+
+class AttachmentDownloadTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.agent)
+        self.data = bytes(range(256)) * 4
+        self.piece = PieceJointe.objects.create(
+            dossier=self.dossier, nom_fichier='Compte rendu', chemin_storage=ContentFile(self.data, name='cr.pdf'),
+            type='PDF', taille_ko=1,
+        )
+        self.url = reverse('attachment_download', args=[self.piece.pk])
+
+    def test_full_and_conditional_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['ETag'], '"%s"' % hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="Compte rendu.pdf"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(
+            self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304
+        )
+        self.assertTrue(self.client.get(self.url, {'download': 1})['Content-Disposition'].startswith('attachment'))
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, response['Content-Range']), (206, 'bytes 10-19/1024'))
+        self.assertEqual(b''.join(response.streaming_content), self.data[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-4')
+        self.assertEqual(b''.join(response.streaming_content), self.data[-4:])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */1024'))
+        # A range against a version of the file the client no longer matches gets the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_web_server_offload_and_permissions(self):
+        with self.settings(ATTACHMENT_DELIVERY='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.piece.chemin_storage.name)
+        self.assertEqual(response.content, b'')
+        with self.settings(ATTACHMENT_DELIVERY='x-sendfile'):
+            self.assertEqual(self.client.get(self.url)['X-Sendfile'], self.piece.chemin_storage.path)
+
+        other = User.objects.create_user('other@example.com', 'pw', full_name='Other', role=self.agent.role)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+class AttachmentPreviewTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.agent)
+
+    def attach(self, data, name):
+        return PieceJointe.objects.create(
+            dossier=self.dossier, nom_fichier=name, chemin_storage=ContentFile(data, name=name),
+            type='SCAN', taille_ko=len(data) // 1024,
+        )
+
+    def scan(self, size=(2400, 1800)):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'white').save(buffer, 'JPEG')
+        return buffer.getvalue()
+
+    def test_previews_are_downscaled_and_cached_by_the_browser(self):
+        piece = self.attach(self.scan(), 'scan.jpg')
+        url = previews.preview_url(piece, 'thumb')
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumb:
+            self.assertEqual(thumb.size, (128, 96))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        with Image.open(previews.attachment_preview(piece, 'preview')) as preview:
+            self.assertEqual(max(preview.size), 1280)
+
+    def test_upload_queues_preview_rendering(self):
+        piece = self.attach(self.scan((300, 200)), 'scan.png')
+        job = Job.objects.get(task='render_previews')
+        self.assertEqual(jobs.claim('w', 1), [job.pk])
+        jobs.run(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.result, {'piece': piece.pk, 'variants': ['thumb', 'preview']})
+        self.assertIsNotNone(previews.preview_cache.get(previews.preview_name(piece.chemin_storage.name, 'thumb')))
+
+    def test_unsupported_or_unreadable_files_have_no_preview(self):
+        document = self.attach(b'plain text', 'notes.txt')
+        broken = self.attach(b'not an image', 'broken.jpg')
+        self.assertIsNone(previews.preview_url(document, 'thumb'))
+        self.assertFalse(Job.objects.filter(payload__piece_id=document.pk).exists())
+        self.assertEqual(self.client.get(reverse('attachment_preview', args=[broken.pk, 'thumb'])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('attachment_preview', args=[broken.pk, 'huge'])).status_code, 404)
+
+    @skipUnless(shutil.which('pdftoppm'), "poppler is not installed")
+    def test_pdf_first_page_preview(self):
+        piece = self.attach(render_dossier_report(self.dossier, []), 'rapport.pdf')
+        with Image.open(previews.attachment_preview(piece, 'thumb')) as thumb:
+            self.assertEqual(max(thumb.size), 128)
+
+
+class UploadImagePolicyTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def setUp(self):
+        self.client.force_login(self.agent)
+
+    def photo(self, format='JPEG', size=(2000, 1500)):
+        noise = Image.merge('RGB', [Image.effect_noise(size, 30) for _ in range(3)])
+        buffer = io.BytesIO()
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated 90° by the phone
+        exif[0x010F] = 'Phone'
+        noise.save(buffer, format, exif=exif, **({'quality': 95} if format == 'JPEG' else {}))
+        buffer.seek(0)
+        buffer.name = 'photo.' + format.lower()
+        return buffer
+
+    def upload(self, file):
+        self.client.post(reverse('upload_document', args=[self.dossier.id]),
+                         {'chemin_storage': file, 'nom_fichier': 'Photo', 'type': 'SCAN'})
+        return PieceJointe.objects.latest('id')
+
+    @override_settings(UPLOAD_IMAGE_POLICY={'max_side': 1000, 'quality': 80})
+    def test_photos_are_normalized(self):
+        original = self.photo()
+        piece = self.upload(original)
+        self.assertTrue(piece.chemin_storage.name.endswith('.jpg'))
+        with Image.open(piece.chemin_storage.path) as stored:
+            self.assertEqual(stored.size, (750, 1000))  # orientation applied, then downscaled
+            self.assertFalse(stored.getexif())
+        self.assertEqual(piece.taille_ko, piece.chemin_storage.size // 1024)
+        self.assertLess(piece.chemin_storage.size, len(original.getvalue()) / 4)
+        self.assertFalse(piece.chemin_original)
+
+        piece = self.upload(self.photo('PNG', size=(800, 600)))
+        self.assertTrue(piece.chemin_storage.name.endswith('.jpg'))
+
+    @override_settings(UPLOAD_IMAGE_POLICY={'max_side': 1000, 'max_dpi': 300})
+    def test_downscale_keeps_the_printed_size(self):
+        scan = io.BytesIO()
+        Image.merge('RGB', [Image.effect_noise((2000, 1500), 30) for _ in range(3)]).save(
+            scan, 'JPEG', quality=95, dpi=(150, 150))
+        scan.seek(0)
+        scan.name = 'scan.jpg'
+        piece = self.upload(scan)
+        with Image.open(piece.chemin_storage.path) as stored:
+            self.assertEqual(stored.size, (1000, 750))
+            self.assertEqual(tuple(round(value) for value in stored.info['dpi']), (75, 75))
+
+    @override_settings(UPLOAD_IMAGE_POLICY={'max_side': 1000, 'format': 'WEBP'})
+    def test_converted_photos_are_renamed(self):
+        piece = self.upload(self.photo())
+        self.assertTrue(piece.chemin_storage.name.endswith('.webp'))
+        self.assertEqual(piece.nom_fichier, 'Photo')  # no extension to follow
+
+        response = self.client.post(reverse('scan_document', args=[self.dossier.id]),
+                                    {'scanned_doc': self.photo()})
+        self.assertLess(response.status_code, 400)
+        piece = PieceJointe.objects.latest('id')
+        self.assertEqual(piece.nom_fichier, 'Scanned_photo.webp')
+
+        self.assertEqual(imaging.display_name('IMG_1.JPEG', 'IMG_1.jpg'), 'IMG_1.JPEG')
+        self.assertEqual(imaging.display_name('notes.pdf', 'notes.webp'), 'notes.pdf')
+
+    @override_settings(UPLOAD_IMAGE_POLICY={'max_side': 1000, 'keep_original': True})
+    def test_original_kept_when_the_policy_says_so(self):
+        piece = self.upload(self.photo())
+        self.assertTrue(piece.chemin_original.name.endswith('.jpeg'))
+        self.assertNotEqual(piece.chemin_original.name, piece.chemin_storage.name)
+        paths = [piece.chemin_storage.path, piece.chemin_original.path]
+        with self.captureOnCommitCallbacks(execute=True):
+            piece.delete()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_uploads_untouched_without_policy(self):
+        original = self.photo(size=(400, 300))
+        piece = self.upload(original)
+        with piece.chemin_storage.open() as stored:
+            self.assertEqual(stored.read(), original.getvalue())
+
+    @override_settings(UPLOAD_IMAGE_POLICY={})
+    def test_documents_stay_lossless_and_benchmark_reports_savings(self):
+        screenshot = io.BytesIO()
+        Image.new('RGB', (600, 400), 'white').save(screenshot, 'PNG')
+        screenshot.seek(0)
+        screenshot.name = 'capture.png'
+        self.assertTrue(self.upload(screenshot).chemin_storage.name.endswith('.png'))
+
+        corpus = os.path.join(self.media_root, 'corpus')
+        os.makedirs(corpus)
+        with open(os.path.join(corpus, 'photo.jpg'), 'wb') as out:
+            out.write(self.photo().getvalue())
+        output = io.StringIO()
+        call_command('benchmark_uploads', corpus, stdout=output)
+        self.assertRegex(output.getvalue(), r'storage: .* saved .*\(\d+%\)')
+
+class ImportTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent Import', role=Role.objects.create(name='AGENT'),
+            department='IT',
+        )
+        cls.employer = User.objects.create_user(
+            'Employe@example.com', 'pw', full_name='Jeanne Martin', role=Role.objects.get(name='AGENT'),
+        )
+        cls.controller = User.objects.create_user(
+            'controller@example.com', 'pw', full_name='Controller', role=Role.objects.create(name='CONTROLLER'),
+            department='IT',
+        )
+
+    def import_file(self, content, name, *args):
+        path = os.path.join(self.media_root, name)
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(content)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_records', path, '--user', 'agent@example.com', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_rows_are_created_in_batches_and_bad_rows_reported(self):
+        rows = ['employer,status,start_date,doctor,diagnosis,treatment_plan,priority']
+        for i in range(5):
+            rows.append(f'employe@example.com,SUBMITTED,2024-03-0{i + 1},Dr. Kaci,Lombalgie {i},Repos,3')
+        rows.append('nobody@example.com,DRAFT,2024-03-01,Dr. Kaci,Grippe,Repos,2')
+        rows.append('employe@example.com,DRAFT,not-a-date,Dr. Kaci,Grippe,Repos,9')
+
+        out, err = self.import_file('\n'.join(rows) + '\n', 'dossiers.csv', '--batch-size', '2')
+
+        dossiers = DossierMedical.objects.order_by('reference')
+        self.assertEqual(dossiers.count(), 5)
+        self.assertEqual(len({dossier.reference for dossier in dossiers}), 5)
+        self.assertIn('line 7: employer: Unknown user', err)
+        self.assertIn('line 8: start_date', err)
+        self.assertIn('priority', err)
+        self.assertIn('7 rows, 5 imported, 2 rejected', out)
+
+        dossier = dossiers.first()
+        self.assertEqual(dossier.employer, self.employer)
+        self.assertEqual(dossier.department, 'Non spécifié')
+        self.assertEqual(dossier.start_date, date(2024, 3, 1))
+        self.assertEqual(dossier.priority, 3)
+        self.assertEqual(DossierAuditLog.objects.filter(action='CREATE').count(), 5)
+        # Agent submissions get a controller, counted in its workload
+        self.assertEqual(set(dossiers.values_list('controller', flat=True)), {self.controller.pk})
+        self.assertEqual(ControllerWorkload.objects.get(controller=self.controller).open_dossiers, 5)
+        self.assertEqual(
+            set(SearchDocument.objects.filter(kind='DM').values_list('object_id', flat=True)),
+            set(dossiers.values_list('id', flat=True)),
+        )
+        self.assertTrue(SearchToken.objects.filter(object_id=dossier.pk, token='jeanne').exists())
+
+    def test_ndjson_prises_en_charge_and_dry_run(self):
+        rows = [
+            {'patient': 'employe@example.com', 'institution': 'CHU', 'estimated_cost': '1250.50',
+             'diagnosis': 'Fracture', 'physician': 'Dr. Kaci', 'care_type': 'SURGERY'},
+            {'patient': 'employe@example.com', 'institution': 'CHU', 'estimated_cost': 'abc',
+             'diagnosis': 'Fracture', 'physician': 'Dr. Kaci'},
+        ]
+        content = '\n'.join(json.dumps(row) for row in rows) + '\n{broken\n'
+
+        out, _ = self.import_file(content, 'pec.ndjson', '--kind', 'pec', '--dry-run')
+        self.assertIn('3 rows, 1 valid, 2 rejected', out)
+        self.assertFalse(PriseEnCharge.objects.exists())
+
+        out, err = self.import_file(content, 'pec.ndjson', '--kind', 'pec')
+        self.assertIn('line 2: estimated_cost', err)
+        self.assertIn('line 3: Invalid JSON', err)
+        pec = PriseEnCharge.objects.get()
+        self.assertEqual(pec.estimated_cost, Decimal('1250.50'))
+        self.assertTrue(pec.reference.startswith('PEC-'))
+
+    def test_json_attachments_are_stored(self):
+        attachments = os.path.join(self.media_root, 'scans')
+        os.makedirs(attachments, exist_ok=True)
+        with open(os.path.join(attachments, 'ordonnance.pdf'), 'wb') as output:
+            output.write(b'%PDF-1.4 ordonnance')
+        rows = [
+            {'employer': 'employe@example.com', 'start_date': '2024-03-01', 'doctor': 'Dr. Kaci',
+             'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'attachments': ['ordonnance.pdf']},
+            {'employer': 'employe@example.com', 'start_date': '2024-03-01', 'doctor': 'Dr. Kaci',
+             'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'attachments': ['../outside.pdf']},
+        ]
+
+        out, err = self.import_file(json.dumps(rows), 'dossiers.json', '--attachments-dir', attachments)
+
+        self.assertIn('line 2: attachments: File not found', err)
+        piece = PieceJointe.objects.get()
+        self.assertEqual(piece.nom_fichier, 'ordonnance.pdf')
+        self.assertEqual(piece.type, 'PDF')
+        self.assertEqual(piece.uploaded_by, self.agent)
+        with piece.chemin_storage.open('rb') as stored:
+            self.assertEqual(stored.read(), b'%PDF-1.4 ordonnance')
+
+    def test_attachments_are_stored_before_the_batch_transaction(self):
+        attachments = os.path.join(self.media_root, 'scans')
+        os.makedirs(attachments, exist_ok=True)
+        with open(os.path.join(attachments, 'radio.pdf'), 'wb') as output:
+            output.write(b'%PDF-1.4 radio')
+        rows = [(1, {'employer': 'employe@example.com', 'start_date': '2024-03-01', 'doctor': 'Dr. Kaci',
+                     'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'attachments': 'radio.pdf'})]
+        depths = {}
+        storage = PieceJointe._meta.get_field('chemin_storage').storage
+        save, insert = storage.save, imports._insert_batch
+
+        def spy_save(*args, **kwargs):
+            depths['save'] = len(connection.atomic_blocks)
+            return save(*args, **kwargs)
+
+        def spy_insert(*args, **kwargs):
+            depths['insert'] = len(connection.atomic_blocks)
+            return insert(*args, **kwargs)
+
+        with mock.patch.object(storage, 'save', spy_save), mock.patch.object(imports, '_insert_batch', spy_insert):
+            self.assertEqual(import_rows('dossier', rows, self.agent, attachments_dir=attachments).created, 1)
+        self.assertLess(depths['save'], depths['insert'])
+
+        # A batch that fails gives its blob references back
+        with mock.patch.object(imports, '_insert_batch', side_effect=DatabaseError('boom')):
+            result = import_rows('dossier', rows, self.agent, attachments_dir=attachments)
+        self.assertEqual(result.errors, [imports.RowError(1, 'Not saved: boom')])
+        self.assertEqual(AttachmentBlob.objects.get().ref_count, 1)
+
+    def test_batch_controllers_are_picked_at_once(self):
+        second = User.objects.create_user(
+            'controller2@example.com', 'pw', full_name='Controller 2', role=self.controller.role, department='IT',
+        )
+        User.objects.create_user(
+            'controller3@example.com', 'pw', full_name='Controller 3', role=self.controller.role, department='RH',
+        )
+        rows = [
+            (line, {'employer': 'employe@example.com', 'status': 'SUBMITTED', 'department': 'IT',
+                    'start_date': '2024-03-01', 'doctor': 'Dr. Kaci', 'diagnosis': 'Grippe',
+                    'treatment_plan': 'Repos'})
+            for line in range(1, 6)
+        ]
+        with mock.patch.object(assignment, 'assign_controller', side_effect=AssertionError), \
+                mock.patch.object(assignment, 'assign_controllers', wraps=assignment.assign_controllers) as picks:
+            self.assertEqual(import_rows('dossier', rows, self.agent).created, 5)
+        picks.assert_called_once()
+        counts = Counter(DossierMedical.objects.values_list('controller', flat=True))
+        self.assertEqual(sorted(counts.values()), [2, 3])
+        self.assertEqual(set(counts), {self.controller.pk, second.pk})
+        self.assertEqual(
+            dict(ControllerWorkload.objects.filter(open_dossiers__gt=0).values_list('controller', 'open_dossiers')),
+            dict(counts),
+        )
+
+    def test_admin_import_page(self):
+        admin = User.objects.create_superuser('admin@example.com', 'pw', full_name='Admin')
+        self.client.force_login(admin)
+        url = reverse('admin:dossier_medicale_dossiermedical_import')
+        content = (
+            'employer,start_date,doctor,diagnosis,treatment_plan\n'
+            'employe@example.com,2024-03-01,Dr. Kaci,Grippe,Repos\n'
+            'employe@example.com,2024-03-01,Dr. Kaci,,Repos\n'
+        ).encode()
+
+        response = self.client.post(url, {'file': ContentFile(content, name='dossiers.csv')})
+
+        # Imported by a worker, not by the request
+        job = Job.objects.get(task='import_records')
+        self.assertRedirects(response, f'{url}?job={job.pk}', fetch_redirect_response=False)
+        self.assertFalse(DossierMedical.objects.exists())
+        self.assertContains(self.client.get(response.url), 'Import en cours')
+
+        jobs.claim('test-worker', 1)
+        jobs.run(job.pk)
+        self.assertFalse(os.path.exists(job.payload['path']))
+        response = self.client.get(response.url)
+        self.assertContains(response, '2 ligne(s) lue(s)')
+        self.assertContains(response, 'diagnosis')
+        self.assertEqual(DossierMedical.objects.get().created_by, admin)
+
+
+class ListExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        agent_role = Role.objects.create(name='AGENT')
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=agent_role, department='IT'
+        )
+        cls.admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN')
+        )
+        for i, (department, diagnosis) in enumerate([('IT', 'Grippe'), ('IT', 'Entorse'), ('RH', 'Grippe')]):
+            DossierMedical.objects.create(
+                employer=cls.agent, created_by=cls.agent, department=department, priority=i + 1,
+                start_date=date(2024, 3, i + 1), doctor='Dr. Smith', diagnosis=diagnosis, treatment_plan='Repos',
+            )
+        PriseEnCharge.objects.create(
+            patient=cls.agent, created_by=cls.agent, institution='CHU <Nord>', estimated_cost=Decimal('99.90'),
+            diagnosis='Fracture', physician='Dr. Kaci',
+        )
+
+    def export(self, name, format, **params):
+        response = self.client.get(reverse(name, args=[format]), params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def xlsx_rows(self, data, sheet=1):
+        cells = re.compile(r'<c(?: [^>]*)?(?:/>|>(.*?)</c>)')
+        xml = zipfile.ZipFile(io.BytesIO(data)).read(f'xl/worksheets/sheet{sheet}.xml').decode()
+        return [
+            [re.sub(r'<[^>]+>', '', cell) for cell in cells.findall(row)]
+            for row in re.findall(r'<row>(.*?)</row>', xml)
+        ]
+
+    def test_csv_follows_role_scope_and_search(self):
+        self.client.force_login(self.agent)
+        rows = list(csv.reader(io.StringIO(self.export('dossier_list_export', 'csv', q='grippe').decode('utf-8-sig'))))
+
+        self.assertEqual(rows[0][:3], ['Référence', 'Statut', 'Employé'])
+        # Agents only see their department; the search drops the sprain
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][1:5], ['Brouillon', 'Agent', 'agent@example.com', 'IT'])
+        self.assertEqual(rows[1][9], '2024-03-01')
+
+        self.client.force_login(self.admin)
+        rows = list(csv.reader(io.StringIO(self.export('dossier_list_export', 'csv').decode('utf-8-sig'))))
+        self.assertEqual([row[6] for row in rows[1:]], ['High', 'Medium', 'Low'])
+
+    def test_xlsx_workbook(self):
+        self.client.force_login(self.agent)
+        data = self.export('pec_list_export', 'xlsx')
+
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertIn('xl/workbook.xml', archive.namelist())
+        rows = self.xlsx_rows(data)
+        self.assertEqual(rows[0][0], 'Référence')
+        self.assertEqual(rows[1][5], 'CHU &lt;Nord&gt;')
+        self.assertEqual(rows[1][7], '99.90')
+        # Dates are spreadsheet serial numbers
+        self.assertEqual(rows[1][11], str((timezone.localdate() - date(1899, 12, 30)).days))
+
+    def test_formulas_escaped_in_csv_only_and_datetimes_written_alike(self):
+        header = ['texte', 'date']
+        rows = [
+            ['=HYPERLINK("http://x")', datetime(2024, 3, 1, 9, 30)],
+            ['\t=1+1', timezone.make_aware(datetime(2024, 3, 1, 9, 30))],
+            ['\r@SUM(A1)', None],
+            ['a-b', None],
+        ]
+
+        written = list(csv.reader(io.StringIO(b''.join(iter_csv(header, rows)).decode('utf-8-sig'), newline='')))
+        self.assertEqual([row[0] for row in written[1:]],
+                         ['\'=HYPERLINK("http://x")', '\'\t=1+1', '\'\r@SUM(A1)', 'a-b'])
+        self.assertEqual([row[1] for row in written[1:3]], ['2024-03-01 09:30', '2024-03-01 09:30'])
+
+        cells = self.xlsx_rows(b''.join(iter_xlsx(header, rows)))
+        # Inline strings are never evaluated: the text is kept as is
+        self.assertEqual([row[0] for row in cells[1:]],
+                         ['=HYPERLINK("http://x")', '\t=1+1', '&#13;@SUM(A1)', 'a-b'])
+        self.assertNotIn('<f>', zipfile.ZipFile(io.BytesIO(b''.join(iter_xlsx(header, rows))))
+                         .read('xl/worksheets/sheet1.xml').decode())
+        self.assertEqual(cells[1][1], cells[2][1])
+
+    def test_unknown_format_is_404(self):
+        self.client.force_login(self.agent)
+        self.assertEqual(self.client.get(reverse('pec_list_export', args=['pdf'])).status_code, 404)
+
+    def test_rows_past_the_sheet_limit_continue_on_a_new_sheet(self):
+        data = b''.join(iter_xlsx(['n'], ([n] for n in range(5)), max_rows=3))
+
+        self.assertEqual([self.xlsx_rows(data, sheet) for sheet in (1, 2, 3)], [
+            [['n'], ['0'], ['1']], [['n'], ['2'], ['3']], [['n'], ['4']],
+        ])
+        self.assertIn('Export (3)', zipfile.ZipFile(io.BytesIO(data)).read('xl/workbook.xml').decode())
+
+    def test_keyset_iteration_reads_in_chunks(self):
+        paginator = KeysetPaginator(DossierMedical.objects.all(), DOSSIER_PAGE_KEYS)
+        expected = list(DossierMedical.objects.order_by('-priority', '-created_at', 'id').values_list('reference'))
+
+        with self.assertNumQueries(2):
+            self.assertEqual(list(paginator.iter_values(['reference'], chunk_size=2)), expected)
+
+
+class AuditLogViewerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(
+            'admin@example.com', 'pw', full_name='Admin', role=Role.objects.create(name='ADMIN')
+        )
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT')
+        )
+        cls.dossiers = [
+            DossierMedical.objects.create(
+                employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+                doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+            )
+            for _ in range(2)
+        ]
+        now = timezone.now()
+        logs = []
+        for i in range(60):
+            logs.append(DossierAuditLog(
+                dossier=cls.dossiers[i % 2], user=cls.admin if i % 3 else cls.agent,
+                action='STATUS_CHANGE' if i % 2 else 'ATTACHMENT_ADD',
+                details={'old_status': 'SUBMITTED', 'new_status': 'APPROVED' if i % 4 == 1 else 'REJECTED'}
+                if i % 2 else {'filename': f'scan_{i}.pdf', 'type': 'SCAN'},
+            ))
+        DossierAuditLog.objects.bulk_create(logs)
+        for i, log in enumerate(DossierAuditLog.objects.order_by('id')):
+            # Pairs of entries share a timestamp, so the id has to break ties
+            DossierAuditLog.objects.filter(pk=log.pk).update(timestamp=now - timedelta(days=i // 2))
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def page(self, **params):
+        response = self.client.get(reverse('audit_log'), params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_keyset_pages_cover_the_log_newest_first(self):
+        seen = []
+        response = self.page()
+        while True:
+            logs = list(response.context['logs'])
+            seen.extend(log.pk for log in logs)
+            if not response.context['page_obj'].has_next():
+                break
+            response = self.page(after=response.context['page_obj'].next_cursor)
+
+        expected = list(
+            DossierAuditLog.objects.order_by('-timestamp', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+        self.assertEqual(len(self.page().context['logs']), 50)
+
+    def test_batched_entries_are_not_skipped_between_pages(self):
+        # A batch writes entries recorded within the same millisecond
+        DossierAuditLog.objects.all().delete()
+        now = timezone.now().replace(microsecond=500000)
+        with audit.batch():
+            for n in range(AUDIT_PAGE_SIZE + 10):
+                with mock.patch('dossier_medicale.audit.timezone.now', return_value=now + timedelta(microseconds=n)):
+                    audit.record(self.dossiers[0], 'UPDATE', self.admin, {'n': n})
+        first = self.page()
+        second = self.page(after=first.context['page_obj'].next_cursor)
+        seen = [log.details['n'] for log in list(first.context['logs']) + list(second.context['logs'])]
+        self.assertEqual(seen, list(range(AUDIT_PAGE_SIZE + 10))[::-1])
+
+    def test_filters(self):
+        def ids(**params):
+            return {log.pk for log in self.page(**params).context['logs']}
+
+        logs = DossierAuditLog.objects.all()
+        self.assertEqual(ids(action='STATUS_CHANGE'), set(logs.filter(action='STATUS_CHANGE').values_list('id', flat=True)))
+        self.assertEqual(ids(user='AGENT@example.com'), set(logs.filter(user=self.agent).values_list('id', flat=True)))
+        self.assertEqual(ids(user='nobody@example.com'), set())
+        self.assertEqual(
+            ids(reference=self.dossiers[1].reference.lower()),
+            set(logs.filter(dossier=self.dossiers[1]).values_list('id', flat=True)),
+        )
+        self.assertEqual(
+            ids(new_status='APPROVED'),
+            set(logs.filter(details__new_status='APPROVED').values_list('id', flat=True)),
+        )
+        self.assertEqual(
+            {log.details['filename'] for log in logs.filter(pk__in=ids(filename='scan_1'))},
+            {'scan_10.pdf', 'scan_12.pdf', 'scan_14.pdf', 'scan_16.pdf', 'scan_18.pdf'},
+        )
+        today = timezone.localdate()
+        self.assertEqual(len(ids(date_from=today - timedelta(days=1), date_to=today)), 4)
+        self.assertEqual(ids(date_from=today, date_to=today - timedelta(days=1)), set())
+
+    def test_detail_filters_use_the_generated_columns_on_mysql(self):
+        logs = DossierAuditLog.objects.filter_details(new_status='APPROVED', filename__startswith='scan')
+        self.assertIn('JSON_EXTRACT', str(logs.query).upper())
+
+        with mock.patch.object(connection, 'vendor', 'mysql'):
+            logs = DossierAuditLog.objects.filter_details(new_status='APPROVED', filename__startswith='scan')
+            sql = str(logs.query)
+        self.assertIn('.detail_new_status) = APPROVED', sql)
+        self.assertIn('.detail_filename) LIKE', sql)
+        self.assertNotIn('JSON_EXTRACT', sql.upper())
+
+    def test_forbidden_to_agents(self):
+        self.client.force_login(self.agent)
+        self.assertEqual(self.client.get(reverse('audit_log')).status_code, 403)
+
+
+class AuditBatchTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.agent, created_by=cls.agent, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+
+    def audit_inserts(self, queries):
+        table = DossierAuditLog._meta.db_table
+        return [query for query in queries if query['sql'].startswith('INSERT') and table in query['sql']]
+
+    def test_request_events_are_written_in_one_insert(self):
+        self.client.force_login(self.agent)
+        files = []
+        for n in range(3):
+            file = io.BytesIO(b'scan %d' % n)
+            file.name = f'scan{n}.txt'
+            files.append(file)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('create_dossier'), {
+                'employer': self.agent.pk, 'category': 'GENERAL', 'start_date': date.today(),
+                'doctor': 'Dr. Smith', 'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'priority': 2,
+                'attachments': files,
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(self.audit_inserts(queries)), 1)
+        dossier = DossierMedical.objects.latest('id')
+        actions = list(dossier.audit_logs.order_by('id').values_list('action', flat=True))
+        self.assertEqual(actions, ['CREATE'] + ['ATTACHMENT_ADD'] * 3)
+
+    def test_entries_share_the_fate_of_the_transaction(self):
+        with self.assertRaises(RuntimeError):
+            with audit.batch():
+                audit.record(self.dossier, 'UPDATE', self.agent)
+                raise RuntimeError
+        with audit.batch():
+            audit.record(self.dossier, 'UPDATE', self.agent, {'n': 1})
+            with self.assertRaises(RuntimeError):
+                with audit.batch():
+                    audit.record(self.dossier, 'UPDATE', self.agent, {'n': 2})
+                    raise RuntimeError
+            with audit.batch():
+                audit.record(self.dossier, 'UPDATE', self.agent, {'n': 3})
+            self.assertFalse(self.dossier.audit_logs.exists())  # not written before the batch ends
+        details = list(self.dossier.audit_logs.order_by('id').values_list('details', flat=True))
+        self.assertEqual(details, [{'n': 1}, {'n': 3}])
+
+    @override_settings(AUDIT_LOG_ASYNC=True)
+    def test_spooled_entries_keep_their_time(self):
+        with audit.batch():
+            first = audit.record(self.dossier, 'UPDATE', self.agent)
+            audit.record(self.dossier, 'STATUS_CHANGE', self.agent, {'new_status': 'APPROVED'})
+        self.assertFalse(self.dossier.audit_logs.exists())
+        job = Job.objects.get(task='write_audit_log')
+
+        with mock.patch('django.utils.timezone.now', return_value=first.timestamp + timedelta(hours=1)):
+            jobs.run(*jobs.claim('w', 1))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result), ('SUCCEEDED', {'written': 2}))
+        logs = list(self.dossier.audit_logs.order_by('id'))
+        self.assertEqual([log.action for log in logs], ['UPDATE', 'STATUS_CHANGE'])
+        self.assertEqual(logs[0].timestamp, first.timestamp)
+        self.assertEqual(logs[1].details, {'new_status': 'APPROVED'})
+
+
+class DossierCreationTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'), department='IT'
+        )
+        cls.controller = User.objects.create_user(
+            'controller@example.com', 'pw', full_name='Controller', role=Role.objects.create(name='CONTROLLER'),
+            department='IT',
+        )
+
+    def test_workload_row_is_not_locked_while_attachments_are_stored(self):
+        self.client.force_login(self.agent)
+        base = len(connection.atomic_blocks)
+        depths = {}
+        storage = PieceJointe._meta.get_field('chemin_storage').storage
+        save, assign = storage.save, assignment.assign_controller
+
+        def spy_save(*args, **kwargs):
+            depths['store'] = len(connection.atomic_blocks)
+            return save(*args, **kwargs)
+
+        def spy_assign(*args, **kwargs):
+            depths['assign'] = len(connection.atomic_blocks)
+            return assign(*args, **kwargs)
+
+        file = io.BytesIO(b'scan')
+        file.name = 'scan.txt'
+        with mock.patch.object(storage, 'save', spy_save), \
+                mock.patch.object(assignment, 'assign_controller', spy_assign):
+            response = self.client.post(reverse('create_dossier'), {
+                'employer': self.agent.pk, 'category': 'GENERAL', 'start_date': date.today(),
+                'doctor': 'Dr. Smith', 'diagnosis': 'Grippe', 'treatment_plan': 'Repos', 'priority': 2,
+                'attachments': [file],
+            })
+        self.assertEqual(response.status_code, 302)
+        # Neither runs inside the request's transaction, which locks the workload row
+        self.assertEqual(depths, {'store': base, 'assign': base})
+        dossier = DossierMedical.objects.get()
+        self.assertEqual(dossier.controller, self.controller)
+        self.assertEqual(ControllerWorkload.objects.get(controller=self.controller).open_dossiers, 1)
+        self.assertEqual(dossier.pieces_jointes.count(), 1)
+
+
+class AuditArchiveTests(MediaTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.controller = User.objects.create_user(
+            'ctrl@example.com', 'pw', full_name='Controller',
+            role=Role.objects.create(name='CONTROLLER'), department='IT',
+        )
+        cls.dossier = DossierMedical.objects.create(
+            employer=cls.controller, created_by=cls.controller, start_date=date.today(),
+            doctor='Dr. Smith', diagnosis='Grippe', treatment_plan='Repos',
+        )
+        DossierMedical.objects.filter(pk=cls.dossier.pk).update(created_at=timezone.now() - timedelta(days=400))
+        cls.dossier.refresh_from_db()
+        now = timezone.now()
+        for days, action, details in [
+            (400, 'CREATE', {'reference': cls.dossier.reference, 'status': 'SUBMITTED'}),
+            (340, 'ATTACHMENT_ADD', {'filename': 'scan.pdf', 'size_kb': 12}),
+            (200, 'STATUS_CHANGE', {'old_status': 'SUBMITTED', 'new_status': 'APPROVED'}),
+            (1, 'UPDATE', {'changes': 'Dossier updated via edit form'}),
+        ]:
+            DossierAuditLog.objects.create(
+                dossier=cls.dossier, action=action, user=cls.controller, details=details,
+                timestamp=now - timedelta(days=days),
+            )
+
+    def setUp(self):
+        override = override_settings(AUDIT_ARCHIVE_ROOT=os.path.join(self.media_root, 'audit'))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(shutil.rmtree, os.path.join(self.media_root, 'audit'), True)
+
+    def test_old_entries_move_to_monthly_archives(self):
+        expected = [
+            (log.id, log.action, log.timestamp, log.details)
+            for log in self.dossier.audit_logs.order_by('-timestamp', '-id')
+        ]
+        output = io.StringIO()
+        call_command('archive_audit_log', days=30, chunk_size=2, stdout=output)
+        self.assertIn('3 audit log entries archived', output.getvalue())
+        self.assertEqual(list(self.dossier.audit_logs.values_list('action', flat=True)), ['UPDATE'])
+        self.assertEqual(len(audit_archive.partitions()), 3)
+
+        logs = audit_archive.timeline(self.dossier)
+        self.assertEqual([(log.id, log.action, log.timestamp, log.details) for log in logs], expected)
+        self.assertEqual([bool(getattr(log, 'archived', False)) for log in logs], [False, True, True, True])
+        self.assertEqual(logs[-1].user, self.controller)
+
+    def test_interrupted_run_is_archived_once(self):
+        audit_archive.archive_entries(timezone.now() - timedelta(days=30))
+        # As if a run had stopped between archiving a chunk and deleting it
+        archived = audit_archive.archived_entries(self.dossier)[0]
+        DossierAuditLog.objects.bulk_create([archived])
+        self.assertEqual(len(audit_archive.timeline(self.dossier)), 4)
+        self.assertEqual(audit_archive.archive_entries(timezone.now() - timedelta(days=30)), 1)
+        self.assertEqual(len(audit_archive.timeline(self.dossier)), 4)
+
+    def test_timeline_view_reads_the_archives(self):
+        audit_archive.archive_entries(timezone.now())
+        self.assertFalse(self.dossier.audit_logs.exists())
+        self.client.force_login(self.controller)
+        response = self.client.get(reverse('dossier_audit_timeline', args=[self.dossier.id]))
+        self.assertContains(response, 'Archivé', count=4)
+        self.assertContains(response, 'scan.pdf')
+        detail = self.client.get(reverse('dossier_detail', args=[self.dossier.id]))
+        self.assertEqual(detail.context['last_activity'].action, 'UPDATE')
+
+
+class FileCacheTests(MediaTestCase):
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = FileCache('test', default_max_bytes=350)
+        for name in ('a', 'b', 'c'):
+            cache.store(name, b'x' * 100)
+            past = time.time() - {'a': 30, 'b': 20, 'c': 10}[name]
+            os.utime(cache.path(name), (past, past))
+        self.assertIsNotNone(cache.get('a'))  # a is now the most recent
+        cache.store('d', b'x' * 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('d'))
+
+    def test_abandoned_stream_is_not_published(self):
+        cache = FileCache('test', default_max_bytes=1024)
+        stream = cache.store_stream('partial', iter([b'one', b'two']))
+        next(stream)
+        stream.close()
+        self.assertIsNone(cache.get('partial'))
+        self.assertEqual(os.listdir(cache.directory), [])
@@ -0,0 +1,241 @@
+"""Resumable, chunked attachment uploads.
+
+A client opens an UploadSession for a file of known size, then sends its
+bytes in order, one chunk per request, each stating the offset it starts at
+(``Upload-Offset``). A chunk is streamed onto a temporary file under
+``CHUNKED_UPLOAD_ROOT`` in small reads, so memory stays bounded whatever the
+file size, and only counts once it has fully arrived and matched its
+optional SHA-256 (``Upload-Checksum``). The session row is the source of
+truth for the offset: after an interruption the client asks for it and
+re-sends only the remaining bytes, and whatever a broken request left past
+it in the temporary file is overwritten.
+
+The request that writes the last byte claims the session for completion
+(ACTIVE -> COMPLETING) while it still holds the row lock, so a retried or
+concurrent request cannot complete it a second time. Once the session row
+is unlocked, the file is hashed once: the digest is checked against the whole-file SHA-256 given when the
+session was opened (if any) and serves as the file's content address, so
+the attachment storage renames the file into place (atomically, through a
+temporary name) instead of hashing and copying it again.
+Checksum failures answer 460, as in the tus protocol these headers follow.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.db import transaction
+
+from . import audit
+from .models import PieceJointe, UploadSession
+from .storage import HashedFile
+
+READ_SIZE = 64 * 1024
+
+SHA256_HEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(Exception):
+    """A request the session cannot accept; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_root():
+    return getattr(settings, 'CHUNKED_UPLOAD_ROOT', os.path.join(settings.BASE_DIR, 'uploads_tmp'))
+
+
+def max_upload_size():
+    return getattr(settings, 'CHUNKED_UPLOAD_MAX_BYTES', 4 * 1024 ** 3)
+
+
+def max_chunk_size():
+    return getattr(settings, 'CHUNKED_UPLOAD_CHUNK_MAX_BYTES', 16 * 1024 ** 2)
+
+
+def temp_path(session):
+    return os.path.join(upload_root(), f'{session.pk}.part')
+
+
+def parse_checksum(header):
+    """Hex digest of an ``Upload-Checksum: sha256 <hex or base64>`` header."""
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm.lower() != 'sha256':
+        raise UploadError("Unsupported checksum algorithm", status=400)
+    value = value.strip()
+    if SHA256_HEX.match(value.lower()):
+        return value.lower()
+    try:
+        digest = base64.b64decode(value, validate=True)
+    except binascii.Error:
+        digest = b''
+    if len(digest) != 32:
+        raise UploadError("Malformed checksum", status=400)
+    return digest.hex()
+
+
+def start_upload(dossier, user, filename, size, nom_fichier='', type='', description='', sha256=''):
+    """Open a session for a ``size``-byte file and create its empty temporary file."""
+    if size > max_upload_size():
+        raise UploadError("File too large", status=413)
+    session = UploadSession.objects.create(
+        dossier=dossier,
+        created_by=user,
+        filename=os.path.basename(filename),
+        nom_fichier=nom_fichier or os.path.basename(filename),
+        type=type or (os.path.splitext(filename)[1].lstrip('.').upper() or 'OTHER'),
+        description=description,
+        size=size,
+        sha256=sha256.lower(),
+    )
+    os.makedirs(upload_root(), exist_ok=True)
+    open(temp_path(session), 'wb').close()
+    return session
+
+
+def append_chunk(session_id, offset, stream, length, checksum=None):
+    """Append ``length`` bytes read from ``stream`` at ``offset``; returns the session.
+
+    The chunk is refused with 409 unless ``offset`` is exactly what the
+    session has received so far, so a client that lost track of it has to
+    ask again instead of leaving a hole or writing twice.
+    """
+    if length > max_chunk_size():
+        raise UploadError("Chunk too large", status=413)
+    with transaction.atomic():
+        # Serializes chunks of the same session; the lock is held while the
+        # chunk streams in, which a well-behaved client never contends for
+        session = UploadSession.objects.select_for_update().get(pk=session_id)
+        if session.status != 'ACTIVE':
+            raise UploadError("Upload already complete", status=409)
+        if offset != session.received:
+            raise UploadError("Offset mismatch", status=409)
+        if offset + length > session.size:
+            raise UploadError("Chunk exceeds the declared size", status=400)
+
+        digest = hashlib.sha256()
+        with open(temp_path(session), 'r+b') as out:
+            out.seek(offset)
+            remaining = length
+            while remaining:
+                data = stream.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                digest.update(data)
+                out.write(data)
+                remaining -= len(data)
+            # Anything past the accepted offset is garbage from this or an
+            # earlier broken request; drop it so the file always matches
+            # ``received`` once the session is committed
+            if remaining:
+                out.truncate(offset)
+                raise UploadError("Incomplete chunk", status=400)
+            if checksum and digest.hexdigest() != checksum:
+                out.truncate(offset)
+                raise UploadError("Checksum mismatch", status=460)
+            out.truncate(offset + length)
+
+        session.received = offset + length
+        session.save(update_fields=['received', 'updated_at'])
+        completing = session.received == session.size and UploadSession.objects.filter(
+            pk=session.pk, status='ACTIVE',
+        ).update(status='COMPLETING') == 1
+    # Outside the lock: other requests now find the session no longer ACTIVE
+    if completing:
+        session.status = 'COMPLETING'
+        try:
+            completed = _complete(session)
+        except BaseException:
+            # Left to be completed by a retry, e.g. an empty chunk at the end
+            UploadSession.objects.filter(pk=session.pk, status='COMPLETING').update(status='ACTIVE')
+            raise
+        if not completed:
+            raise UploadError("File checksum mismatch", status=460)
+    return session
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _complete(session):
+    """Turn the fully received temporary file into a PieceJointe.
+
+    Returns False, with the session rewound to offset 0, when the file does
+    not match its expected SHA-256.
+    """
+    path = temp_path(session)
+    digest = _file_sha256(path)
+    if session.sha256 and digest != session.sha256:
+        # Corrupted on the way despite the chunk checks (or none were sent):
+        # start over rather than store a bad scan
+        os.truncate(path, 0)
+        session.received = 0
+        session.status = 'ACTIVE'
+        session.save(update_fields=['received', 'status', 'updated_at'])
+        return False
+
+    piece = PieceJointe(
+        dossier=session.dossier,
+        nom_fichier=session.nom_fichier,
+        type=session.type,
+        taille_ko=session.size // 1024,
+        uploaded_by=session.created_by,
+        description=session.description,
+    )
+    with audit.batch():
+        source = HashedFile(path, digest)
+        try:
+            piece.chemin_storage.save(session.filename, source, save=False)
+        finally:
+            source.close()
+        piece.save()
+        audit.record(session.dossier, 'ATTACHMENT_ADD', session.created_by,
+                     {'filename': piece.nom_fichier, 'type': piece.type})
+        session.status = 'COMPLETE'
+        session.piece = piece
+        session.save(update_fields=['status', 'piece', 'updated_at'])
+        # Left behind when the content was already stored
+        transaction.on_commit(lambda: _remove(path))
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def abort_upload(session):
+    _remove(temp_path(session))
+    session.delete()
+
+
+def upload_state(session):
+    """Polling payload for ``session``."""
+    return {
+        'id': str(session.pk),
+        'size': session.size,
+        'offset': session.received,
+        'status': session.status,
+        'piece': session.piece_id,
+    }
+
+
+def purge_uploads(before):
+    """Delete sessions idle since ``before`` and their temporary files; returns the count."""
+    stale = UploadSession.objects.filter(updated_at__lt=before)
+    count = 0
+    for session in stale.iterator():
+        abort_upload(session)
+        count += 1
+    return count
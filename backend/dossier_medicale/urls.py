@@ -10,8 +10,14 @@ urlpatterns = [
     path('dossier/<int:dossier_id>/reject/', views.reject_dossier, name='reject_dossier'),
     path('redirect-home/', views.redirect_home, name='redirect_home'),
     path('dossier/<int:dossier_id>/upload/', views.upload_document, name='upload_document'),
+    path('dossier/<int:dossier_id>/scan/', views.scan_document, name='scan_document'),
+    path('dossier/<int:dossier_id>/uploads/', views.upload_session_create, name='upload_session_create'),
+    path('uploads/<uuid:session_id>/', views.upload_session, name='upload_session'),
+    path('attachments/<int:piece_id>/', views.attachment_download, name='attachment_download'),
+    path('attachments/<int:piece_id>/<slug:variant>/', views.attachment_preview, name='attachment_preview'),
     path('user/dossiers/create/dossier_list', RedirectView.as_view(pattern_name='dossier_list', permanent=False)),
     path('', views.dossier_list, name='dossier_list'),
+    path('dossiers/export/<slug:format>/', views.dossier_list_export, name='dossier_list_export'),
     path('accounts/', include('django.contrib.auth.urls')),
     path('<int:dossier_id>/', views.dossier_detail, name='dossier_detail'),
     path('<int:dossier_id>/download_all/', views.download_all, name='download_all'),
@@ -20,12 +26,18 @@ urlpatterns = [
     path('<int:dossier_id>/report/', views.generate_report, name='generate_report'),
     path('dossiers/create/', views.create_dossier, name='create_dossier'),
     path('audit-log/', views.audit_log, name='audit_log'),
+    path('<int:dossier_id>/audit/', views.dossier_audit_timeline, name='dossier_audit_timeline'),
     path('global-report/', views.global_report, name='global_report'),
+    path('export/', views.bulk_export, name='bulk_export'),
+    path('export/<int:job_id>/download/', views.bulk_export_download, name='bulk_export_download'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
     
     # Prise en Charge
     path('pec/', views.pec_list, name='pec_list'),
+    path('pec/export/<slug:format>/', views.pec_list_export, name='pec_list_export'),
     path('pec/create/', views.pec_create, name='pec_create'),
     path('pec/<int:pec_id>/', views.pec_detail, name='pec_detail'),
+    path('pec/<int:pec_id>/report/', views.pec_generate_report, name='pec_report'),
     path('pec/<int:pec_id>/approve/', views.pec_approve, name='pec_approve'),
     path('pec/<int:pec_id>/reject/', views.pec_reject, name='pec_reject'),
     path('pec/<int:pec_id>/delete/', views.pec_delete, name='pec_delete'),
@@ -1,20 +1,27 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, HttpResponseForbidden, FileResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, FileResponse, JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.urls import reverse
 from django.core.exceptions import PermissionDenied
 from django.contrib import messages
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.units import inch
-import zipfile
-import io
-from .models import DossierMedical, PieceJointe, DossierAuditLog, PriseEnCharge
-from .forms import DossierForm, PieceJointeForm, PriseEnChargeForm
-from django.db.models import Q
+from django.views.decorators.http import require_http_methods
+from .models import DossierMedical, PieceJointe, DossierAuditLog, PriseEnCharge, Job, UploadSession
+from .forms import AuditLogFilterForm, BulkExportForm, DossierForm, PieceJointeForm, PriseEnChargeForm, UploadSessionForm
+from . import audit, audit_archive, downloads, imaging, previews, uploads
+from . import search
+from .archives import dossier_archive
+from .exports import export_cache, export_queryset, iter_export
+from .jobs import enqueue, job_state
+from .pagination import KeysetPaginator
+from .permissions import capabilities_for, role_actions
+from .references import allocate_references
+from .reports import dossier_report, pec_report, prerender_report
+from .spreadsheets import DOSSIER_COLUMNS, PEC_COLUMNS, iter_csv, iter_xlsx, list_rows
+from .stats import dossier_status_stats, global_report_snapshot
+from .storage import release_files, store_files
+from datetime import datetime, timedelta
 from decimal import Decimal
+import os
 
 # Helper Functions
 from django.shortcuts import render
@@ -22,6 +29,24 @@ from .models import DossierMedical
 from django.contrib.auth.decorators import login_required
 
 from django.utils import timezone
+from user.models import User
+
+# Keyset pagination orderings: (field, descending), ending on a unique column
+LIST_PAGE_SIZE = 25
+DOSSIER_PAGE_KEYS = [('priority', True), ('created_at', True), ('id', False)]
+PEC_PAGE_KEYS = [('created_at', True), ('id', False)]
+SEARCH_PAGE_KEYS = [('search_rank', True), ('id', False)]
+AUDIT_PAGE_SIZE = 50
+AUDIT_PAGE_KEYS = [('timestamp', True), ('id', True)]
+
+# List exports: format -> (streaming writer, content type)
+LIST_EXPORT_FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (iter_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# Browser cache lifetime of attachment previews (one year)
+PREVIEW_MAX_AGE = 365 * 24 * 3600
 
 # views.py
 from django.shortcuts import redirect
@@ -41,47 +66,47 @@ def dossier_delete(request, pk):
     messages.error(request, "Suppression non autorisée.")
     return redirect('dossier_list')
 
-@login_required 
+def listed_dossiers(user):
+    """Base queryset of the dossier list for ``user``'s role, before any search."""
+    caps = capabilities_for(user)
+    if caps.can_view_all:
+        return DossierMedical.objects.all()
+    if caps.role == 'AGENT':
+        return DossierMedical.objects.filter(department=user.department)
+    return DossierMedical.objects.none()
+
+@login_required
 def dossier_list(request):
     query = request.GET.get('q', '').strip()
-    user = request.user
-
-    # Base queryset per role
-    # Base queryset per role
-    if user.role.name in ['ADMIN', 'CONTROLLER']:
-        dossiers = DossierMedical.objects.all()
-        template = 'dossier_medicale/list_admin.html'
-    elif user.role.name == 'AGENT':
-        dossiers = DossierMedical.objects.filter(department=user.department)
-        template = 'dossier_medicale/list_agent.html'
-    else:
-        dossiers = DossierMedical.objects.none()
-        template = 'dossier_medicale/list_agent.html'
-
-    # Apply search filter if needed
-    if query:
-        dossiers = dossiers.filter(
-            Q(reference__icontains=query) |
-            Q(employer__first_name__icontains=query) |
-            Q(employer__last_name__icontains=query)
-        )
+    caps = capabilities_for(request.user)
+
+    dossiers = listed_dossiers(request.user)
+    template = 'dossier_medicale/list_admin.html' if caps.can_view_all else 'dossier_medicale/list_agent.html'
+
+    # Apply search filter if needed, ranking results by relevance
+    listing, page_keys = dossiers, DOSSIER_PAGE_KEYS
+    terms = search.query_terms(query)
+    if terms:
+        dossiers = search.filter_matching(dossiers, terms)
+        listing, page_keys = search.annotate_rank(dossiers, terms), SEARCH_PAGE_KEYS
+
+    listing = listing.select_related('employer', 'created_by')
+    page = KeysetPaginator(listing, page_keys, per_page=LIST_PAGE_SIZE).get_page(
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+    )
 
-    import json
-    
     context = {
-        'dossiers': dossiers,
+        'dossiers': page.object_list,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
         'search_query': query,
     }
 
     # Add statistics for Admin/Controller
-    if user.role.name in ['ADMIN', 'CONTROLLER']:
-        # General stats
-        stats = {
-            'total': dossiers.count(),
-            'approved': dossiers.filter(status='APPROVED').count(),
-            'pending': dossiers.filter(status__in=['SUBMITTED', 'UNDER_REVIEW']).count(),
-            'rejected': dossiers.filter(status='REJECTED').count(),
-        }
+    if caps.can_view_all:
+        # General stats: one aggregate query, cached per scope and search
+        stats = dossier_status_stats(dossiers, scope='all', query=query)
         
         context.update({
             'stats': stats,
@@ -91,98 +116,43 @@ def dossier_list(request):
 
 def get_role_actions(user, dossier):
     """Returns available actions based on user role and dossier status"""
-    actions = []
-    
-    # Common actions for all authenticated users
-    actions.append({
-        'name': 'view',
-        'label': 'View Details',
-        'url': '#details'
-    })
-    
-    # No more normal user specific actions info
-    pass
-    
-    # Agent specific actions
-    if user.role.name == 'AGENT':
-        actions.extend([
-            {
-                'name': 'upload',
-                'label': 'Upload Document',
-                'url': reverse('upload_document', args=[dossier.id])
-            },
-            {
-                'name': 'update',
-                'label': 'Update Information',
-                'url': reverse('update_dossier', args=[dossier.id])
-            },
-            {
-                'name': 'scan',
-                'label': 'Scan Document',
-                'url': reverse('scan_document', args=[dossier.id])
-            }
-        ])
-    
-    # Controller and Admin specific actions
-    elif user.role.name in ['CONTROLLER', 'ADMIN']:
-        actions.extend([
-            {
-                'name': 'upload',
-                'label': 'Upload Document',
-                'url': reverse('upload_document', args=[dossier.id])
-            },
-            {
-                'name': 'approve',
-                'label': 'Approve Dossier',
-                'url': reverse('approve_dossier', args=[dossier.id])
-            },
-            {
-                'name': 'reject',
-                'label': 'Reject Dossier',
-                'url': reverse('reject_dossier', args=[dossier.id])
-            },
-            {
-                'name': 'generate_report',
-                'label': 'Generate Report',
-                'url': reverse('generate_report', args=[dossier.id])
-            },
-            {
-                'name': 'edit',
-                'label': 'Edit Dossier',
-                'url': reverse('edit_dossier', args=[dossier.id])
-            }
-        ])
-    
-    return actions
+    return role_actions(user, dossier)
 
 @login_required
 def dossier_detail(request, dossier_id):
-    dossier = get_object_or_404(DossierMedical, pk=dossier_id)
-    attachments = dossier.pieces_jointes.all()
-    # Permission check
-    if not dossier.user_can_view(request.user):
-        raise PermissionDenied("You don't have permission to view this dossier")
+    # Permission check happens in SQL: dossiers the user cannot see are a 404
+    dossier = get_object_or_404(
+        DossierMedical.objects.visible_to(request.user).select_related('employer', 'created_by', 'controller'),
+        pk=dossier_id,
+    )
     
     # Get documents with download permission check
-    documents = []
-    for piece in dossier.pieces_jointes.all():
-        if piece.user_can_download(request.user):
-            documents.append(piece)
+    documents = list(
+        PieceJointe.objects.visible_to(request.user).filter(dossier=dossier).select_related('uploaded_by')
+    )
+    for document in documents:
+        document.thumbnail_url = previews.preview_url(document, 'thumb')
+        document.preview_url = previews.preview_url(document, 'preview')
     
     # Determine template based on user role
-    if request.user.role.name in ['ADMIN', 'CONTROLLER']:
+    caps = capabilities_for(request.user)
+    last_activity = None
+    if caps.can_view_all:
         template = 'dossier_medicale/detail_admin.html'
+        # From the archives too, for dossiers untouched since the retention period
+        last_activity = next(iter(audit_archive.timeline(dossier, limit=1)), None)
     else:  # AGENT or other roles
         template = 'dossier_medicale/detail.html'
     
     context = {
+        'last_activity': last_activity,
         'dossier': dossier,
         'documents': documents,
         'actions': get_role_actions(request.user, dossier),
-        'is_owner': dossier.created_by == request.user,
-        'is_agent': request.user.role.name == 'AGENT',
-        'is_controller': request.user.role.name == 'CONTROLLER',
-        'is_admin': request.user.role.name == 'ADMIN',
+        'is_owner': dossier.created_by_id == request.user.id,
+        'is_agent': caps.role == 'AGENT',
+        'is_controller': caps.role == 'CONTROLLER',
+        'is_admin': caps.role == 'ADMIN',
     }
     return render(request, template, context)
 
@@ -190,46 +160,54 @@ def dossier_detail(request, dossier_id):
 
 def create_dossier(request):
     # Permission check
-    if not hasattr(request.user, 'role') or request.user.role.name not in ['AGENT', 'ADMIN', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_create:
         raise PermissionDenied("You don't have permission to create dossiers")
 
     if request.method == 'POST':
         form = DossierForm(request.POST, request.FILES, user=request.user)
         if form.is_valid():
             try:
-                # Save main dossier
                 dossier = form.save(commit=False)
                 dossier.created_by = request.user
                 dossier.status = 'SUBMITTED'
-                dossier.save()
-
-                # Audit Log: Create
-                DossierAuditLog.objects.create(
-                    dossier=dossier,
-                    action='CREATE',
-                    user=request.user,
-                    details={'reference': dossier.reference, 'status': dossier.status}
-                )
+                # Reserved before the transaction, which would otherwise keep
+                # the day's counter and the controller's workload row locked
+                # while it runs; the attachments are stored before it too
+                dossier.reference = allocate_references(DossierMedical, 'DM')[0]
+                dossier.assign_due_controller()
 
                 # Handle file attachments - UPDATED to match model fields
-                files = request.FILES.getlist('attachments')
-                for file in files:
-                    PieceJointe.objects.create(
+                pieces = [
+                    PieceJointe(
                         dossier=dossier,
-                        chemin_storage=file,  # Using correct field name
-                        nom_fichier=file.name,
                         type=file.content_type.split('/')[-1].upper(),  # Extract file type
-                        taille_ko=file.size // 1024,  # Calculate size in KB
                         uploaded_by=request.user,  # Only if your model has this field
-                        description=f"Attached {file.name}"  # Only if your model has this field
-                    )
-                    # Audit Log: Attachment
-                    DossierAuditLog.objects.create(
-                        dossier=dossier,
-                        action='ATTACHMENT_ADD',
-                        user=request.user,
-                        details={'filename': file.name, 'size_kb': file.size // 1024}
+                        description=f"Attached {file.name}",  # Only if your model has this field
+                        # stored file, its name and its size in KB
+                        **imaging.attachment_fields(file, nom_fichier=file.name),
                     )
+                    for file in request.FILES.getlist('attachments')
+                ]
+                stored = store_files(pieces)
+
+                # One transaction, with its audit entries written in one insert
+                try:
+                    with audit.batch():
+                        # Save main dossier
+                        dossier.save()
+
+                        # Audit Log: Create
+                        audit.record(dossier, 'CREATE', request.user,
+                                     {'reference': dossier.reference, 'status': dossier.status})
+
+                        for piece in pieces:
+                            piece.save()
+                            # Audit Log: Attachment
+                            audit.record(dossier, 'ATTACHMENT_ADD', request.user,
+                                         {'filename': piece.nom_fichier, 'size_kb': piece.taille_ko})
+                except BaseException:
+                    release_files(stored)
+                    raise
 
                 messages.success(request, f'Dossier {dossier.reference} created successfully!')
                 return redirect('dossier_detail', dossier_id=dossier.id)
@@ -264,9 +242,10 @@ def edit_dossier(request, dossier_id):
     dossier = get_object_or_404(DossierMedical, id=dossier_id)
     
     # Updated permissions: Admin, Controller, or the Agent who created it
+    caps = capabilities_for(request.user)
     is_authorized = (
-        request.user.role.name in ['ADMIN', 'CONTROLLER'] or 
-        (request.user.role.name == 'AGENT' and dossier.created_by == request.user)
+        caps.can_edit_any or
+        (caps.role == 'AGENT' and dossier.created_by_id == request.user.id)
     )
     
     if not is_authorized:
@@ -281,37 +260,27 @@ def edit_dossier(request, dossier_id):
         if form.is_valid():
             # Track changes could be implemented here if needed, for now just logging the event
             old_status = dossier.status
-            updated_dossier = form.save()
-            
-            # Audit Log: Update
-            DossierAuditLog.objects.create(
-                dossier=updated_dossier,
-                action='UPDATE',
-                user=request.user,
-                details={'changes': 'Dossier updated via edit form'}
-            )
-            
-            messages.success(request, f'Dossier {updated_dossier.reference} updated successfully!')
-            
-            # Handle additional attachments if any were added during edit
-            files = request.FILES.getlist('attachments')
-            for file in files:
-                PieceJointe.objects.create(
-                    dossier=updated_dossier,
-                    chemin_storage=file,
-                    nom_fichier=file.name,
-                    type=file.content_type.split('/')[-1].upper(),
-                    taille_ko=file.size // 1024,
-                    uploaded_by=request.user,
-                    description=f"Added during update: {file.name}"
-                )
-                DossierAuditLog.objects.create(
-                    dossier=updated_dossier,
-                    action='ATTACHMENT_ADD',
-                    user=request.user,
-                    details={'filename': file.name, 'size_kb': file.size // 1024}
-                )
+            with audit.batch():
+                updated_dossier = form.save()
+
+                # Audit Log: Update
+                audit.record(updated_dossier, 'UPDATE', request.user,
+                             {'changes': 'Dossier updated via edit form'})
 
+                # Handle additional attachments if any were added during edit
+                files = request.FILES.getlist('attachments')
+                for file in files:
+                    piece = PieceJointe.objects.create(
+                        dossier=updated_dossier,
+                        type=file.content_type.split('/')[-1].upper(),
+                        uploaded_by=request.user,
+                        description=f"Added during update: {file.name}",
+                        **imaging.attachment_fields(file, nom_fichier=file.name),
+                    )
+                    audit.record(updated_dossier, 'ATTACHMENT_ADD', request.user,
+                                 {'filename': piece.nom_fichier, 'size_kb': piece.taille_ko})
+
+            messages.success(request, f'Dossier {updated_dossier.reference} updated successfully!')
             return redirect('dossier_detail', dossier_id=dossier.id)
         else:
             for field, errors in form.errors.items():
@@ -331,7 +300,7 @@ def edit_dossier(request, dossier_id):
 def upload_document(request, dossier_id):
     dossier = get_object_or_404(DossierMedical, pk=dossier_id)
     
-    if request.user.role.name not in ['AGENT', 'CONTROLLER','ADMIN']:
+    if not capabilities_for(request.user).can_upload:
         return HttpResponseForbidden()
     
     if request.method == 'POST':
@@ -340,20 +309,16 @@ def upload_document(request, dossier_id):
             piece = form.save(commit=False)
             piece.dossier = dossier
             piece.uploaded_by = request.user
-            # Set file size in KB
-            if piece.chemin_storage and hasattr(piece.chemin_storage, 'size'):
-                piece.taille_ko = round(piece.chemin_storage.size / 1024, 2)
-            else:
-                piece.taille_ko = 0
-            piece.save()
-
-            # Audit Log: Attachment Add
-            DossierAuditLog.objects.create(
-                dossier=dossier,
-                action='ATTACHMENT_ADD',
-                user=request.user,
-                details={'filename': piece.nom_fichier, 'type': piece.type}
-            )
+            # Stored file (normalized per UPLOAD_IMAGE_POLICY), its name and its size in KB
+            fields = imaging.attachment_fields(form.cleaned_data['chemin_storage'], nom_fichier=piece.nom_fichier)
+            for field, value in fields.items():
+                setattr(piece, field, value)
+            with audit.batch():
+                piece.save()
+
+                # Audit Log: Attachment Add
+                audit.record(dossier, 'ATTACHMENT_ADD', request.user,
+                             {'filename': piece.nom_fichier, 'type': piece.type})
 
             messages.success(request, 'Document uploaded successfully!')
             return redirect('dossier_detail', dossier_id=dossier.id)
@@ -370,39 +335,36 @@ def download_all(request, dossier_id):
     dossier = get_object_or_404(DossierMedical, pk=dossier_id)
     
     # Only owner or privileged users can download
-    if not (dossier.created_by == request.user or request.user.role.name in ['AGENT', 'CONTROLLER']):
+    if not (dossier.created_by_id == request.user.id or capabilities_for(request.user).can_download_all):
         return HttpResponseForbidden()
     
-    # Create ZIP file in memory
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for piece in dossier.pieces_jointes.all():
-            if piece.user_can_download(request.user):
-                zip_file.write(piece.chemin_storage.path, piece.nom_fichier)
-    
-    # Prepare response
-    zip_buffer.seek(0)
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="dossier_{dossier.reference}.zip"'
+    # Serve the cached archive when the attachments are unchanged, otherwise
+    # stream the ZIP as it is built (and cache it on the way out)
+    pieces = PieceJointe.objects.visible_to(request.user).filter(dossier=dossier)
+    filename = f'dossier_{dossier.reference}.zip'
+    path, chunks = dossier_archive(dossier.id, pieces)
+    if path is not None:
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename,
+                            content_type='application/zip')
+    response = StreamingHttpResponse(chunks, content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
     return response
 
 @login_required
 def approve_dossier(request, dossier_id):
     dossier = get_object_or_404(DossierMedical, pk=dossier_id)
-    if request.user.role.name not in ['CONTROLLER', 'ADMIN']:
+    if not capabilities_for(request.user).can_approve:
         return HttpResponseForbidden()
     
     old_status = dossier.status
     dossier.status = 'APPROVED'
-    dossier.save()
-    
-    # Audit Log: Status Change
-    DossierAuditLog.objects.create(
-        dossier=dossier,
-        action='STATUS_CHANGE',
-        user=request.user,
-        details={'old_status': old_status, 'new_status': 'APPROVED'}
-    )
+    with audit.batch():
+        dossier.save()
+
+        # Audit Log: Status Change
+        audit.record(dossier, 'STATUS_CHANGE', request.user,
+                     {'old_status': old_status, 'new_status': 'APPROVED'})
+    prerender_report(dossier)
 
     messages.success(request, 'Dossier approved successfully!')
     return redirect('dossier_detail', dossier_id=dossier.id)
@@ -410,180 +372,264 @@ def approve_dossier(request, dossier_id):
 @login_required
 def reject_dossier(request, dossier_id):
     dossier = get_object_or_404(DossierMedical, pk=dossier_id)
-    if request.user.role.name not in ['CONTROLLER', 'ADMIN']:
+    if not capabilities_for(request.user).can_approve:
         return HttpResponseForbidden()
     
     old_status = dossier.status
     dossier.status = 'REJECTED'
-    dossier.save()
-
-    # Audit Log: Status Change
-    DossierAuditLog.objects.create(
-        dossier=dossier,
-        action='STATUS_CHANGE',
-        user=request.user,
-        details={'old_status': old_status, 'new_status': 'REJECTED'}
-    )
+    with audit.batch():
+        dossier.save()
+
+        # Audit Log: Status Change
+        audit.record(dossier, 'STATUS_CHANGE', request.user,
+                     {'old_status': old_status, 'new_status': 'REJECTED'})
 
     messages.warning(request, 'Dossier has been rejected.')
     return redirect('dossier_detail', dossier_id=dossier.id)
 
 @login_required
 def generate_report(request, dossier_id):
-    dossier = get_object_or_404(DossierMedical, pk=dossier_id)
+    dossier = get_object_or_404(DossierMedical.objects.select_related('employer'), pk=dossier_id)
 
     # Permission check
-    if request.user.role.name in ['CONTROLLER', 'ADMIN']:
-        pass
-    elif request.user.role.name == 'AGENT' and dossier.created_by == request.user:
-        pass
-    else:
+    caps = capabilities_for(request.user)
+    if not (caps.can_report_any or (caps.role == 'AGENT' and dossier.created_by_id == request.user.id)):
         return HttpResponseForbidden()
 
-    # Create the PDF response
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="rapport_{dossier.reference}.pdf"'
+    # Served from the report cache; only rendered when the dossier or its
+    # attachments changed since the last download
+    pieces = PieceJointe.objects.visible_to(request.user).filter(dossier=dossier)
+    path = dossier_report(dossier, pieces)
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'rapport_{dossier.reference}.pdf',
+                        content_type='application/pdf')
 
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=50, leftMargin=50, topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-    
-    # Custom Styles
-    title_style = ParagraphStyle(
-        'TitleStyle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        textColor=colors.HexColor("#0ea5e9"),
-        alignment=1,
-        spaceAfter=30
-    )
-    
-    section_style = ParagraphStyle(
-        'SectionStyle',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor("#1e293b"),
-        spaceBefore=20,
-        spaceAfter=10,
-        borderPadding=5,
-        backgroundColor=colors.HexColor("#f1f5f9")
-    )
+@login_required
+def bulk_export(request):
+    if not capabilities_for(request.user).can_report_any:
+        return HttpResponseForbidden()
 
-    content = []
-
-    # Title
-    content.append(Paragraph(f"RAPPORT MÉDICAL", title_style))
-    content.append(Paragraph(f"Référence: {dossier.reference}", styles['Normal']))
-    content.append(Spacer(1, 0.2 * inch))
-
-    # General Information Table
-    data = [
-        ["INFORMATION GÉNÉRALE", ""],
-        ["Employé:", dossier.employer.full_name],
-        ["Département:", dossier.department],
-        ["Médecin:", dossier.doctor],
-        ["Date de début:", dossier.start_date.strftime('%d/%m/%Y')],
-        ["Statut:", dossier.get_status_display()],
-        ["Priorité:", dossier.get_priority_display()]
-    ]
-    
-    t = Table(data, colWidths=[1.5*inch, 4*inch])
-    t.setStyle(TableStyle([
-        ('SPAN', (0, 0), (1, 0)),
-        ('BACKGROUND', (0, 0), (1, 0), colors.HexColor("#0ea5e9")),
-        ('TEXTCOLOR', (0, 0), (1, 0), colors.whitesmoke),
-        ('FONTNAME', (0, 0), (1, 0), 'Helvetica-Bold'),
-        ('BOTTOMPADDING', (0, 0), (1, 0), 12),
-        ('BACKGROUND', (0, 1), (0, -1), colors.HexColor("#f8fafc")),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 1), (-1, -1), 8),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 8),
-        ('LEFTPADDING', (0, 0), (-1, -1), 12),
-    ]))
-    content.append(t)
-
-    # Medical Details
-    content.append(Paragraph("DÉTAILS MÉDICAUX", section_style))
-    
-    content.append(Paragraph("<b>Diagnostic:</b>", styles['Normal']))
-    content.append(Paragraph(dossier.diagnosis, styles['Normal']))
-    content.append(Spacer(1, 0.1 * inch))
-    
-    content.append(Paragraph("<b>Plan de Traitement:</b>", styles['Normal']))
-    content.append(Paragraph(dossier.treatment_plan, styles['Normal']))
-    
-    if dossier.reason:
-        content.append(Spacer(1, 0.1 * inch))
-        content.append(Paragraph("<b>Raison:</b>", styles['Normal']))
-        content.append(Paragraph(dossier.reason, styles['Normal']))
-
-    if dossier.comments:
-        content.append(Spacer(1, 0.1 * inch))
-        content.append(Paragraph("<b>Commentaires additionnels:</b>", styles['Normal']))
-        content.append(Paragraph(dossier.comments, styles['Normal']))
-
-    # Documents
-    if dossier.pieces_jointes.exists():
-        content.append(Paragraph("PIÈCES JOINTES", section_style))
-        for piece in dossier.pieces_jointes.all():
-            content.append(Paragraph(f"• {piece.nom_fichier} ({piece.type})", styles['Normal']))
-
-    # Footer
-    content.append(Spacer(1, 0.5 * inch))
-    footer_text = f"Généré le {timezone.now().strftime('%d/%m/%Y à %H:%M')} - Système de Gestion Dossiers Médicaux"
-    content.append(Paragraph(footer_text, styles['Italic']))
-
-    # Build PDF
-    doc.build(content)
-    
-    pdf = buffer.getvalue()
-    buffer.close()
-    response.write(pdf)
-    
+    form = BulkExportForm(request.GET or None)
+    if not form.is_valid():
+        return render(request, 'dossier_medicale/bulk_export.html', {'form': form})
+
+    filters = dict(form.cleaned_data)
+    if filters.pop('background'):
+        job = enqueue(
+            'bulk_export', user=request.user, user_id=request.user.id,
+            department=filters['department'], status=filters['status'],
+            date_from=filters['date_from'] and filters['date_from'].isoformat(),
+            date_to=filters['date_to'] and filters['date_to'].isoformat(),
+        )
+        messages.success(request, "L'export a été lancé en arrière-plan.")
+        return render(request, 'dossier_medicale/bulk_export.html', {'form': BulkExportForm(), 'job': job})
+
+    # Rendered inline: a pool would fork the server process; large exports
+    # belong in the background job, which also reports its progress
+    dossiers = export_queryset(DossierMedical.objects.visible_to(request.user), **filters)
+    response = StreamingHttpResponse(iter_export(dossiers), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="export_dossiers_{timezone.localdate():%Y%m%d}.zip"'
     return response
 
+@login_required
+def bulk_export_download(request, job_id):
+    job = get_object_or_404(Job, pk=job_id, task='bulk_export', status='SUCCEEDED', created_by=request.user)
+    path = export_cache.get(job.result['file'])
+    if path is None:
+        messages.error(request, "Cet export a expiré, veuillez le relancer.")
+        return redirect('bulk_export')
+    return FileResponse(open(path, 'rb'), as_attachment=True, content_type='application/zip',
+                        filename=f'export_dossiers_{timezone.localtime(job.created_at):%Y%m%d}.zip')
+
+@login_required
+def job_status(request, job_id):
+    job = get_object_or_404(Job, pk=job_id, created_by=request.user)
+    return JsonResponse(job_state(job))
+
 @login_required
 def scan_document(request, dossier_id):
 
     dossier = get_object_or_404(DossierMedical, pk=dossier_id)
     
-    if request.user.role.name not in ['AGENT', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_scan:
         return HttpResponseForbidden()
     
     if request.method == 'POST':
         # Handle scanned document upload
         scanned_file = request.FILES.get('scanned_doc')
         if scanned_file:
-            piece = PieceJointe.objects.create(
-                dossier=dossier,
-                nom_fichier=f"Scanned_{scanned_file.name}",
-                chemin_storage=scanned_file,
-                type='SCAN',
-                uploaded_by=request.user
-            )
-
-            # Audit Log: Scan Attachment
-            DossierAuditLog.objects.create(
-                dossier=dossier,
-                action='ATTACHMENT_ADD',
-                user=request.user,
-                details={'filename': piece.nom_fichier, 'type': 'SCAN'}
-            )
+            with audit.batch():
+                piece = PieceJointe.objects.create(
+                    dossier=dossier,
+                    type='SCAN',
+                    uploaded_by=request.user,
+                    **imaging.attachment_fields(scanned_file, nom_fichier=f"Scanned_{scanned_file.name}"),
+                )
+
+                # Audit Log: Scan Attachment
+                audit.record(dossier, 'ATTACHMENT_ADD', request.user,
+                             {'filename': piece.nom_fichier, 'type': 'SCAN'})
 
             messages.success(request, 'Scanned document uploaded successfully!')
             return redirect('dossier_detail', dossier_id=dossier.id)
     
     return render(request, 'dossier_medicale/scan.html', {'dossier': dossier})
 
+@login_required
+def attachment_download(request, piece_id):
+    piece = get_object_or_404(PieceJointe.objects.visible_to(request.user), pk=piece_id)
+    if not piece.chemin_storage:
+        raise Http404
+    # Shown inline (PDFs open in the browser viewer) unless ?download is given
+    filename = piece.nom_fichier
+    extension = os.path.splitext(piece.chemin_storage.name)[1]
+    if extension and not filename.lower().endswith(extension.lower()):
+        filename += extension
+    try:
+        return downloads.attachment_response(request, piece.chemin_storage, filename,
+                                             as_attachment='download' in request.GET)
+    except FileNotFoundError:
+        raise Http404
+
+@login_required
+def attachment_preview(request, piece_id, variant):
+    if variant not in previews.VARIANTS:
+        raise Http404
+    piece = get_object_or_404(PieceJointe.objects.visible_to(request.user), pk=piece_id)
+    etag = f'"{previews.preview_key(piece.chemin_storage.name)}-{variant}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        path = previews.attachment_preview(piece, variant)
+        if path is None:
+            raise Http404
+        response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+    # The URL changes with the file (see previews.preview_url)
+    response['ETag'] = etag
+    response['Cache-Control'] = f'private, max-age={PREVIEW_MAX_AGE}, immutable'
+    return response
+
+# Chunked uploads (see uploads.py)
+def _upload_response(session, status=200, **extra):
+    response = JsonResponse(dict(uploads.upload_state(session), **extra), status=status)
+    response['Upload-Offset'] = str(session.received)
+    return response
+
+@login_required
+@require_http_methods(['POST'])
+def upload_session_create(request, dossier_id):
+    # Dossiers the user cannot see are a 404, as on the detail page
+    dossier = get_object_or_404(DossierMedical.objects.visible_to(request.user), pk=dossier_id)
+    caps = capabilities_for(request.user)
+    if not (caps.can_upload or caps.can_scan):
+        return HttpResponseForbidden()
+
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    try:
+        session = uploads.start_upload(dossier, request.user, **form.cleaned_data)
+    except uploads.UploadError as error:
+        return JsonResponse({'error': str(error)}, status=error.status)
+    response = _upload_response(session, status=201)
+    response['Location'] = reverse('upload_session', args=[session.pk])
+    return response
+
+@login_required
+@require_http_methods(['GET', 'HEAD', 'PATCH', 'DELETE'])
+def upload_session(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id, created_by=request.user)
+    if request.method == 'DELETE':
+        if session.status == 'ACTIVE':
+            uploads.abort_upload(session)
+        return HttpResponse(status=204)
+    if request.method != 'PATCH':
+        return _upload_response(session)
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.META['CONTENT_LENGTH'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "Upload-Offset and Content-Length are required"}, status=400)
+    try:
+        checksum = request.headers.get('Upload-Checksum')
+        session = uploads.append_chunk(
+            session.pk, offset, request, length,
+            checksum=uploads.parse_checksum(checksum) if checksum else None,
+        )
+    except uploads.UploadError as error:
+        # The current offset tells the client where to resume from
+        session.refresh_from_db()
+        return _upload_response(session, status=error.status, error=str(error))
+    return _upload_response(session)
+
+def _start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+def filter_audit_logs(logs, filters):
+    """Narrow ``logs`` to the audit log viewer filters, keeping every condition index-backed.
+
+    The user and the dossier are resolved to ids first and dates become a
+    timestamp range, so each filter seeks on one of the (column, timestamp)
+    indexes instead of joining or computing per row.
+    """
+    if filters.get('action'):
+        logs = logs.filter(action=filters['action'])
+    if filters.get('user'):
+        user_id = User.objects.filter(email__iexact=filters['user']).values_list('id', flat=True).first()
+        logs = logs.filter(user_id=user_id) if user_id else logs.none()
+    if filters.get('reference'):
+        dossier_id = (
+            DossierMedical.objects.filter(reference=filters['reference'].strip().upper())
+            .values_list('id', flat=True).first()
+        )
+        logs = logs.filter(dossier_id=dossier_id) if dossier_id else logs.none()
+    if filters.get('new_status'):
+        logs = logs.filter_details(new_status=filters['new_status'])
+    if filters.get('filename'):
+        logs = logs.filter_details(filename__startswith=filters['filename'])
+    if filters.get('date_from'):
+        logs = logs.filter(timestamp__gte=_start_of_day(filters['date_from']))
+    if filters.get('date_to'):
+        logs = logs.filter(timestamp__lt=_start_of_day(filters['date_to'] + timedelta(days=1)))
+    return logs
+
 @login_required
 def audit_log(request):
     # Only admins and controllers can see the audit log
-    if request.user.role.name not in ['ADMIN', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_view_audit:
         return HttpResponseForbidden()
-    logs = DossierAuditLog.objects.select_related('dossier', 'user').order_by('-timestamp')
-    return render(request, 'dossier_medicale/audit_log.html', {'logs': logs})
+
+    form = AuditLogFilterForm(request.GET or None)
+    logs = DossierAuditLog.objects.all()
+    if form.is_bound:
+        logs = filter_audit_logs(logs, form.cleaned_data) if form.is_valid() else logs.none()
+
+    # No total count: counting a filtered 50M-row table costs more than the page
+    page = KeysetPaginator(
+        logs.select_related('dossier', 'user__role'), AUDIT_PAGE_KEYS, per_page=AUDIT_PAGE_SIZE,
+    ).get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+
+    filters = request.GET.copy()
+    for cursor in ('after', 'before'):
+        filters.pop(cursor, None)
+    return render(request, 'dossier_medicale/audit_log.html', {
+        'logs': page.object_list,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
+        'form': form,
+        'filter_query': filters.urlencode(),
+        'today': timezone.localdate(),
+    })
+
+@login_required
+def dossier_audit_timeline(request, dossier_id):
+    if not capabilities_for(request.user).can_view_audit:
+        return HttpResponseForbidden()
+    dossier = get_object_or_404(DossierMedical.objects.visible_to(request.user), pk=dossier_id)
+    return render(request, 'dossier_medicale/audit_timeline.html', {
+        'dossier': dossier,
+        'logs': audit_archive.timeline(dossier),
+    })
 
 # Prise en Charge Views
 @login_required
@@ -591,23 +637,51 @@ def pec_list(request):
     query = request.GET.get('q', '').strip()
     user = request.user
 
-    if user.role.name in ['ADMIN', 'CONTROLLER']:
-        pecs = PriseEnCharge.objects.all()
-    else:
-        pecs = PriseEnCharge.objects.filter(Q(patient=user) | Q(created_by=user))
+    pecs = PriseEnCharge.objects.visible_to(user)
 
-    if query:
-        pecs = pecs.filter(
-            Q(reference__icontains=query) |
-            Q(patient__full_name__icontains=query) |
-            Q(institution__icontains=query)
-        )
+    listing, page_keys = pecs, PEC_PAGE_KEYS
+    terms = search.query_terms(query)
+    if terms:
+        pecs = search.filter_matching(pecs, terms)
+        listing, page_keys = search.annotate_rank(pecs, terms), SEARCH_PAGE_KEYS
+
+    listing = listing.select_related('patient', 'created_by')
+    after, before = request.GET.get('after'), request.GET.get('before')
+    page = KeysetPaginator(listing, page_keys, per_page=LIST_PAGE_SIZE).get_page(after=after, before=before)
 
     return render(request, 'dossier_medicale/pec_list.html', {
-        'pecs': pecs,
+        'pecs': page.object_list,
+        # Counted on the first page only, so later pages cost one range query
+        'pec_count': pecs.count() if not (after or before) else None,
+        'page_obj': page,
+        'is_paginated': page.has_other_pages(),
         'search_query': query,
     })
 
+def _list_export(request, queryset, keys, columns, format, name):
+    """Streamed CSV/XLSX of ``queryset`` with the list page's search (``q``) applied."""
+    if format not in LIST_EXPORT_FORMATS:
+        raise Http404
+    query = request.GET.get('q', '').strip()
+    terms = search.query_terms(query)
+    if terms:
+        queryset = search.filter_matching(queryset, terms)
+    writer, content_type = LIST_EXPORT_FORMATS[format]
+    rows = list_rows(queryset, keys, columns)
+    response = StreamingHttpResponse(writer([header for header, _ in columns], rows), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{name}_{timezone.localdate():%Y%m%d}.{format}"'
+    return response
+
+@login_required
+def dossier_list_export(request, format):
+    return _list_export(request, listed_dossiers(request.user), DOSSIER_PAGE_KEYS, DOSSIER_COLUMNS,
+                        format, 'dossiers')
+
+@login_required
+def pec_list_export(request, format):
+    return _list_export(request, PriseEnCharge.objects.visible_to(request.user), PEC_PAGE_KEYS, PEC_COLUMNS,
+                        format, 'prises_en_charge')
+
 @login_required
 def pec_create(request):
     if request.method == 'POST':
@@ -626,9 +700,10 @@ def pec_create(request):
 
 @login_required
 def pec_detail(request, pec_id):
-    pec = get_object_or_404(PriseEnCharge, pk=pec_id)
-    if not pec.user_can_view(request.user):
-        raise PermissionDenied()
+    pec = get_object_or_404(
+        PriseEnCharge.objects.visible_to(request.user).select_related('patient', 'created_by'),
+        pk=pec_id,
+    )
     
     remainder = None
     if pec.estimated_cost:
@@ -637,12 +712,19 @@ def pec_detail(request, pec_id):
     return render(request, 'dossier_medicale/pec_detail.html', {
         'pec': pec,
         'remainder': remainder,
-        'is_admin': request.user.role.name in ['ADMIN', 'CONTROLLER']
+        'is_admin': capabilities_for(request.user).can_view_all
     })
 
+@login_required
+def pec_generate_report(request, pec_id):
+    pec = get_object_or_404(PriseEnCharge.objects.visible_to(request.user).select_related('patient'), pk=pec_id)
+    path = pec_report(pec)
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'pec_{pec.reference}.pdf',
+                        content_type='application/pdf')
+
 @login_required
 def pec_approve(request, pec_id):
-    if request.user.role.name not in ['ADMIN', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_approve:
         return HttpResponseForbidden()
     pec = get_object_or_404(PriseEnCharge, pk=pec_id)
     pec.status = 'APPROVED'
@@ -652,7 +734,7 @@ def pec_approve(request, pec_id):
 
 @login_required
 def pec_reject(request, pec_id):
-    if request.user.role.name not in ['ADMIN', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_approve:
         return HttpResponseForbidden()
     pec = get_object_or_404(PriseEnCharge, pk=pec_id)
     pec.status = 'REJECTED'
@@ -663,7 +745,7 @@ def pec_reject(request, pec_id):
 @login_required
 def pec_delete(request, pec_id):
     pec = get_object_or_404(PriseEnCharge, pk=pec_id)
-    if request.user.role.name != 'ADMIN' and pec.created_by != request.user:
+    if not capabilities_for(request.user).can_delete_any_pec and pec.created_by_id != request.user.id:
         return HttpResponseForbidden()
     pec.delete()
     messages.success(request, 'Prise en charge supprimée.')
@@ -671,94 +753,7 @@ def pec_delete(request, pec_id):
 
 @login_required
 def global_report(request):
-    if request.user.role.name not in ['ADMIN', 'CONTROLLER']:
+    if not capabilities_for(request.user).can_view_all:
         return HttpResponseForbidden()
 
-    from django.db.models import Count, Sum
-    import json
-
-    # --- Dossier Stats ---
-    dossiers = DossierMedical.objects.all()
-    dossier_stats = {
-        'total': dossiers.count(),
-        'approved': dossiers.filter(status='APPROVED').count(),
-        'pending': dossiers.filter(status__in=['SUBMITTED', 'UNDER_REVIEW']).count(),
-        'rejected': dossiers.filter(status='REJECTED').count(),
-    }
-
-    status_counts = list(dossiers.values('status').annotate(count=Count('id')))
-    priority_counts = list(dossiers.values('priority').annotate(count=Count('id')))
-    dept_counts = list(dossiers.values('department').annotate(count=Count('id')))
-
-    chart_dossier_status = {
-        'labels': [dict(DossierMedical.STATUS_CHOICES).get(s['status']) for s in status_counts],
-        'data': [s['count'] for s in status_counts],
-        'colors': [DossierMedical.get_status_hex_by_status(s['status']) for s in status_counts]
-    }
-
-    priority_labels = dict(DossierMedical.PRIORITY_LEVELS)
-    chart_dossier_priority = {
-        'labels': [priority_labels.get(p['priority']) for p in priority_counts],
-        'data': [p['count'] for p in priority_counts]
-    }
-
-    chart_dossier_dept = {
-        'labels': [d['department'] for d in dept_counts],
-        'data': [d['count'] for d in dept_counts]
-    }
-
-    # --- Prise en Charge Stats ---
-    pecs = PriseEnCharge.objects.all()
-    pec_stats = {
-        'total': pecs.count(),
-        'approved': pecs.filter(status='APPROVED').count(),
-        'pending': pecs.filter(status__in=['SUBMITTED', 'UNDER_REVIEW']).count(),
-        'rejected': pecs.filter(status='REJECTED').count(),
-        'total_cost': pecs.aggregate(total=Sum('estimated_cost'))['total'] or 0,
-    }
-
-    pec_status_counts = list(pecs.values('status').annotate(count=Count('id')))
-    pec_type_counts = list(pecs.values('care_type').annotate(count=Count('id')))
-
-    chart_pec_status = {
-        'labels': [dict(PriseEnCharge.STATUS_CHOICES).get(s['status']) for s in pec_status_counts],
-        'data': [s['count'] for s in pec_status_counts],
-        'colors': [PriseEnCharge.get_status_hex_by_status(s['status']) for s in pec_status_counts]
-    }
-
-    chart_pec_type = {
-        'labels': [dict(PriseEnCharge.CARE_TYPES).get(t['care_type']) for t in pec_type_counts],
-        'data': [t['count'] for t in pec_type_counts]
-    }
-
-    # Data for Tables
-    dossier_table = []
-    for status_code, status_label in DossierMedical.STATUS_CHOICES:
-        count = dossiers.filter(status=status_code).count()
-        dossier_table.append({'label': status_label, 'count': count})
-
-    pec_table = []
-    for type_code, type_label in PriseEnCharge.CARE_TYPES:
-        count = pecs.filter(care_type=type_code).count()
-        cost = pecs.filter(care_type=type_code).aggregate(total=Sum('estimated_cost'))['total'] or 0
-        pec_table.append({'label': type_label, 'count': count, 'cost': cost})
-
-    # Recent & Critical lists
-    critical_dossiers = dossiers.filter(priority__gte=3).order_by('-created_at')[:5]
-    recent_pecs = pecs.order_by('-created_at')[:5]
-
-    context = {
-        'dossier_stats': dossier_stats,
-        'pec_stats': pec_stats,
-        'dossier_table': dossier_table,
-        'pec_table': pec_table,
-        'critical_dossiers': critical_dossiers,
-        'recent_pecs': recent_pecs,
-        'chart_dossier_status': json.dumps(chart_dossier_status),
-        'chart_dossier_priority': json.dumps(chart_dossier_priority),
-        'chart_dossier_dept': json.dumps(chart_dossier_dept),
-        'chart_pec_status': json.dumps(chart_pec_status),
-        'chart_pec_type': json.dumps(chart_pec_type),
-    }
-
-    return render(request, 'dossier_medicale/report_global.html', context)
\ No newline at end of file
+    return render(request, 'dossier_medicale/report_global.html', global_report_snapshot())
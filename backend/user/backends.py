@@ -0,0 +1,18 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class RoleModelBackend(ModelBackend):
+    """ModelBackend that loads the user's role in the same query.
+
+    ``request.user.role`` is read by nearly every view and template, so the
+    join saves a query on every authenticated request.
+    """
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        try:
+            user = UserModel._default_manager.select_related('role').get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
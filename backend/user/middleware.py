@@ -0,0 +1,25 @@
+from django.contrib.auth import BACKEND_SESSION_KEY
+
+# Backends no longer configured -> the backend their sessions move to
+REPLACED_BACKENDS = {
+    'django.contrib.auth.backends.ModelBackend': 'user.backends.RoleModelBackend',
+}
+
+
+class ReplacedBackendSessionMiddleware:
+    """Keep sessions logged in under a replaced authentication backend.
+
+    Django only restores a session user through a backend that is still in
+    AUTHENTICATION_BACKENDS, so replacing one would log every user out.
+    Sessions naming a replaced backend are moved to its successor before
+    AuthenticationMiddleware reads them.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        backend = request.session.get(BACKEND_SESSION_KEY)
+        if backend in REPLACED_BACKENDS:
+            request.session[BACKEND_SESSION_KEY] = REPLACED_BACKENDS[backend]
+        return self.get_response(request)
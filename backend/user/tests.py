@@ -1,3 +1,36 @@
+from django.contrib.auth import BACKEND_SESSION_KEY
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from .backends import RoleModelBackend
+from .models import Role, User
+
+
+class RoleModelBackendTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = User.objects.create_user(
+            'agent@example.com', 'pw', full_name='Agent', role=Role.objects.create(name='AGENT'),
+        )
+
+    def test_get_user_loads_the_role_in_the_same_query(self):
+        with self.assertNumQueries(1):
+            user = RoleModelBackend().get_user(self.agent.pk)
+            self.assertEqual(user.role.name, 'AGENT')
+
+    def test_get_user_rejects_unknown_and_inactive_users(self):
+        self.assertIsNone(RoleModelBackend().get_user(self.agent.pk + 1))
+        User.objects.filter(pk=self.agent.pk).update(is_active=False)
+        self.assertIsNone(RoleModelBackend().get_user(self.agent.pk))
+
+    def test_login_uses_the_role_backend(self):
+        self.assertTrue(self.client.login(username='agent@example.com', password='pw'))
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'user.backends.RoleModelBackend')
+
+    def test_sessions_of_the_replaced_backend_stay_logged_in(self):
+        self.client.force_login(self.agent, backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('dossier_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.user, self.agent)
+        self.assertEqual(self.client.session[BACKEND_SESSION_KEY], 'user.backends.RoleModelBackend')